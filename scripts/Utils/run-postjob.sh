@@ -64,9 +64,10 @@ PJargs=`cat RunJobs*.*dag | grep "POST Job${jobId} " | awk 'BEGIN { FS="MAX_RETR
 
 # find the condor clusterId for the job
 jobClusterId=`grep '^ClusterId' finished_jobs/job.${jobId}.${jobRetry} | awk '{print $NF}'`
-# reset PJ count
-echo '{"pre": 1, "post": 0}' > retry_info/job.${jobId}.txt
-rm defer_info/defer_num.${jobId}.0.txt
+# reset PJ count, retry and defer counters are kept in the task bookkeeping database
+resetPJ="PYTHONPATH=\$PWD/CRAB3.zip:\$PWD/WMCore.zip python3 -c \"from TaskWorker.Actions.TaskBookkeeping import TaskBookkeeping, RETRY_INFO, DEFER_NUM; \
+bk = TaskBookkeeping(); bk.put(RETRY_INFO, '${jobId}', {'pre': 1, 'post': 0}); bk.put(DEFER_NUM, '${jobId}.0', 0)\""
+eval "$resetPJ"
 
 # these two are mandatory
 export _CONDOR_JOB_AD=finished_jobs/job.${jobId}.0
@@ -89,6 +90,5 @@ echo "sh dag_bootstrap.sh POSTJOB ${jobClusterId} ${jobReturnCode} ${retryCount}
 
 echo ""
 echo "if you want to run again, execute these lines:"
-echo "echo '{"pre": 1, "post": 0}' > retry_info/job.${jobId}.txt"
-echo "rm defer_info/defer_num.${jobId}.0.txt"
+echo "$resetPJ"
 echo "sh dag_bootstrap.sh POSTJOB ${jobClusterId} ${jobReturnCode} ${retryCount} ${maxRetries} $PJargs"
@@ -31,10 +31,16 @@ import json
 
 from RESTInteractions import CRABRest
 from ServerUtilities import getProxiedWebDir, getColumn, downloadFromS3
+from TaskWorker.Actions.TaskBookkeeping import TaskBookkeeping, STATISTICS_KINDS
 
 import htcondor2 as htcondor
 import classad2 as classad
 
+# saved next to each DAG .nodes.log file by indexPostScriptTerminations
+POST_INDEX_SUFFIX = '.postindex.json'
+POST_INDEX_VERSION = 1
+
+
 def printLog(msg):
     """ Utility function to print the timestamp in the log. Can be replaced
         with anything (e.g.: logging.info if we decided to set up a logger here)
@@ -58,6 +64,87 @@ def setupStreamLogger():
     return logger
 
 
+def indexPostScriptTerminations(filename, rebuild=False):
+    """
+    Find all "POST Script terminated" events in a DAG .nodes.log file, i.e. sequences like
+    ...
+    016 (146493.000.000) 11/11 17:45:46 POST Script terminated.
+        (1) Normal termination (return value [0|2])
+        DAG Node: Job105
+    The file is read as a stream, one line at a time. The events found are saved in
+    filename + '.postindex.json' together with the number of bytes read, so that
+    next time only the part of the file which was appended since is read.
+    :param rebuild: ignore the saved index and read the whole file
+    :return: the index, a dictionary where 'events' is the list of [offset, node, returnValue]
+             for each event, and offset is the position in the file of the (first) digit of
+             the return value. Use savePostScriptTerminationsIndex to save it.
+    """
+    indexFileName = filename + POST_INDEX_SUFFIX
+    stat = os.stat(filename)
+    index = {}
+    if os.path.exists(indexFileName) and not rebuild:
+        try:
+            with open(indexFileName, 'r', encoding='utf-8') as fd:
+                index = json.load(fd)
+        except ValueError:
+            index = {}
+    if index.get('version') != POST_INDEX_VERSION or index.get('inode') != stat.st_ino \
+            or index.get('scanned', 0) > stat.st_size:
+        index = {'version': POST_INDEX_VERSION, 'inode': stat.st_ino, 'scanned': 0, 'events': []}
+    terminator_re = re.compile(rb"^\.\.\.$")
+    # date field has two different format, this is for condor up to version 8.8.8
+    event1_re = re.compile(rb"016 \(-?\d+\.\d+\.\d+\) \d+/\d+ \d+:\d+:\d+ POST Script terminated.")
+    # and this for 8.9.7
+    event2_re = re.compile(rb"016 \(-?\d+\.\d+\.\d+\) \d+-\d+-\d+ \d+:\d+:\d+ POST Script terminated.")
+    retvalue_re = re.compile(rb"Normal termination \(return value (-?\d+)\)")
+    node_re = re.compile(rb"DAG Node: Job(\d+(-\d+)?)")
+    # number of lines matched so far for the current event
+    matched = 0
+    offset = index['scanned']
+    # where to start reading next time: never in the middle of an event or of a line
+    resumeOffset = offset
+    with open(filename, 'rb') as fd:
+        fd.seek(offset)
+        for line in fd:
+            lineOffset = offset
+            offset += len(line)
+            if not line.endswith(b'\n'):
+                # the line is still being written
+                break
+            if matched == 0:
+                if terminator_re.search(line):
+                    matched = 1
+            elif matched == 1:
+                matched = 2 if (event1_re.search(line) or event2_re.search(line)) else 0
+            elif matched == 2:
+                m = retvalue_re.search(line)
+                if m:
+                    matched = 3
+                    valueOffset = lineOffset + m.start(1)
+                    value = m.group(1).decode()
+                else:
+                    matched = 0
+            else:
+                m = node_re.search(line)
+                if m:
+                    index['events'].append([valueOffset, m.group(1).decode(), value])
+                matched = 0
+            if matched == 0:
+                resumeOffset = offset
+    index['scanned'] = resumeOffset
+    return index
+
+
+def savePostScriptTerminationsIndex(filename, index):
+    """
+    save the index returned by indexPostScriptTerminations
+    """
+    indexFileName = filename + POST_INDEX_SUFFIX
+    with open(indexFileName + '.tmp', 'w', encoding='utf-8') as fd:
+        json.dump(index, fd)
+    os.rename(indexFileName + '.tmp', indexFileName)
+
+
 def adjustPostScriptExitStatus(resubmitJobIds, filename):
     """
     Edit the DAG .nodes.log file changing the POST script exit code from 0|2 to 1
@@ -72,6 +159,10 @@ def adjustPostScriptExitStatus(resubmitJobIds, filename):
     ...
     for the job ids in resubmitJobIds and replace the return value to 1.
     If resubmitJobIds = True, only replace return values 2 (not 0) to 1.
+    The events are located with indexPostScriptTerminations and only the byte of
+    the return value is overwritten in place, so the file is neither loaded in memory
+    nor rewritten. This also means that the file size does not change, which matters
+    because the running shadows keep their event log file descriptors open.
 
     Note:
           When DAGMan runs in recovery mode, the DAG .nodes.log file is used to
@@ -85,80 +176,33 @@ def adjustPostScriptExitStatus(resubmitJobIds, filename):
         return []
     printLog(f"Looking for resubmitJobIds {resubmitJobIds} in {filename}")
     resubmitAllFailed = (resubmitJobIds is True)
-    terminator_re = re.compile(r"^\.\.\.$")
-    # date field has two different format, this is for condor up to version 8.8.8
-    event1_re = re.compile(r"016 \(-?\d+\.\d+\.\d+\) \d+/\d+ \d+:\d+:\d+ POST Script terminated.")
-    # and this for 8.9.7
-    event2_re = re.compile(r"016 \(-?\d+\.\d+\.\d+\) \d+-\d+-\d+ \d+:\d+:\d+ POST Script terminated.")
     if resubmitAllFailed:
-        retvalue_re = re.compile(r"Normal termination \(return value 2\)")
+        valuesToAdjust = ['2']
     else:
-        retvalue_re = re.compile(r"Normal termination \(return value [0|2]\)")
-    node_re = re.compile(r"DAG Node: Job(\d+(-\d+)?)")
-    ra_buffer = []
-    alt = None
-    output = ''
+        valuesToAdjust = ['0', '2']
+        resubmitJobIds = set(resubmitJobIds)
     adjustedJobIds = []
-    for line in open(filename, 'r', encoding='utf-8').readlines():
-        if len(ra_buffer) == 0:
-            m = terminator_re.search(line)
-            if m:
-                ra_buffer.append(line)
-            else:
-                output += line
-        elif len(ra_buffer) == 1:
-            m1 = event1_re.search(line)
-            m2 = event2_re.search(line)
-            if m1 or m2:
-                ra_buffer.append(line)
-            else:
-                for l in ra_buffer:
-                    output += l
-                output += line
-                ra_buffer = []
-        elif len(ra_buffer) == 2:
-            m = retvalue_re.search(line)
-            if m:
-                ra_buffer.append("        (1) Normal termination (return value 1)\n")
-                alt = line
-            else:
-                for l in ra_buffer:
-                    output += l
-                output += line
-                ra_buffer = []
-        elif len(ra_buffer) == 3:
-            m = node_re.search(line)
-            printLog(f"Matching the line '{line.strip()}' to groups: {m.groups()}")
-            if m and (resubmitAllFailed or (m.groups()[0] in resubmitJobIds)):
-                printLog(f"Successful match: {m.groups()[0]}, adjusting status and appending to adjustedJobIds")
-                adjustedJobIds.append(m.groups()[0])
-                for l in ra_buffer:
-                    output += l
-            else:
-                for l in ra_buffer[:-1]:
-                    output += l
-                output += alt
-            output += line
-            ra_buffer = []
-        else:
-            output += line
-    if ra_buffer:
-        for l in ra_buffer:
-            output += l
-    # This is a curious dance!  If the user is out of quota, we don't want
-    # to fail halfway into writing the file.  OTOH, we can't write into a temp
-    # file and an atomic rename because the running shadows keep their event log
-    # file descriptors open.  Accordingly, we write the file once (to see if we)
-    # have enough quota space, then rewrite "the real file" after deleting the
-    # temporary one.  There's a huge race condition here, but it seems to be the
-    # best we can do given the constraints.  Note that we don't race with the
-    # shadow as we have a write lock on the file itself.
-    tmpfilename = filename + ".tmp"
-    with  open(tmpfilename, "w", encoding='utf-8') as output_fd:
-        output_fd.write(output)
-    os.unlink(tmpfilename)
-    with open(filename, "w", encoding='utf-8') as output_fd:
-        output_fd.write(output)
+    index = indexPostScriptTerminations(filename)
+    with open(filename, 'r+b') as fd:
+        toAdjust = [event for event in index['events'] if event[2] in valuesToAdjust
+                    and (resubmitAllFailed or event[1] in resubmitJobIds)]
+        # make sure that the saved index is still in sync with the file before changing anything
+        for offset, _, value in toAdjust:
+            fd.seek(offset)
+            if fd.read(len(value)) != value.encode():
+                printLog(f"Index of {filename} is out of date, rebuilding it")
+                index = indexPostScriptTerminations(filename, rebuild=True)
+                toAdjust = [event for event in index['events'] if event[2] in valuesToAdjust
+                            and (resubmitAllFailed or event[1] in resubmitJobIds)]
+                break
+        for event in toAdjust:
+            offset, node, _ = event
+            printLog(f"Successful match: {node}, adjusting status and appending to adjustedJobIds")
+            fd.seek(offset)
+            fd.write(b'1')
+            event[2] = '1'
+            adjustedJobIds.append(node)
+    savePostScriptTerminationsIndex(filename, index)
     return adjustedJobIds
 
 
@@ -440,6 +484,13 @@ def clearAutomaticBlacklist():
             os.unlink(filename)
         except Exception as e:  # pylint: disable=broad-except
             printLog(f"ERROR when clearing statistics: {e}")
+    try:
+        bookkeeping = TaskBookkeeping()
+        with bookkeeping.transaction():
+            for kind in STATISTICS_KINDS:
+                bookkeeping.delete(kind)
+    except Exception as e:  # pylint: disable=broad-except
+        printLog(f"ERROR when clearing statistics: {e}")
 
 
 def setupLog():
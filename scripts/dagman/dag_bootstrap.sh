@@ -155,5 +155,10 @@ if [ "X$_CONDOR_JOB_AD" != "X" ]; then
   cat $_CONDOR_JOB_AD
 fi
 echo "Now running the job in `pwd`..."
+# when enabled for this task, run in the per-task TaskManagerServer which has all python modules
+# already loaded. The shim falls back to TaskManagerBootstrap if the server is not running
+if [ "X$CRAB_TASKMANAGER_SERVER" = "X1" ]; then
+  exec nice -n 19 python3 -m TaskWorker.TaskManagerShim "$@"
+fi
 exec nice -n 19 python3 -m TaskWorker.TaskManagerBootstrap "$@"
 } 2>&1 | tee dag_bootstrap.out
@@ -97,6 +97,12 @@ if [ "X$MAX_POST_TMP" != "X" ]; then
     MAX_POST=$MAX_POST_TMP
 fi
 
+# tell dag_bootstrap.sh to run PRE/POST scripts via the per-task TaskManagerServer
+TASKMANAGER_SERVER=`grep '^CRAB_TaskManagerServer =' $_CONDOR_JOB_AD | tr -d '"' | awk '{print $NF;}'`
+if [ "X$TASKMANAGER_SERVER" = "X1" ]; then
+    export CRAB_TASKMANAGER_SERVER=1
+fi
+
 # Bootstrap the runtime - we want to do this before DAG is submitted
 # so all the children don't try this at once.
 if [ "X$TASKWORKER_ENV" = "X" -a ! -e CRAB3.zip ]; then
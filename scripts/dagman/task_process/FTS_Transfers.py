@@ -46,6 +46,7 @@ import json
 import logging
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from http.client import HTTPException
 
@@ -59,6 +60,23 @@ from ServerUtilities import encodeRequest
 
 FTS_ENDPOINT = "https://fts3-cms.cern.ch:8446/"
 FTS_MONITORING = "https://fts3-cms.cern.ch:8449/"
+# FTS jobs whose status is retrieved with a single request
+FTS_STATUS_BATCH_SIZE = 20
+# max number of concurrent status requests to FTS
+FTS_STATUS_WORKERS = 5
+# max number of file ids reported to CRAB REST in one call
+MARK_CHUNK_SIZE = 1000
+# job states for which FTS file states need to be looked at
+FTS_JOB_STATES_WITH_FILES = ['ACTIVE', 'FINISHED', 'FINISHEDDIRTY', "FAILED", "CANCELED"]
+# FTS jobs are filled up to MAX_FILES_PER_FTS_JOB files or MAX_BYTES_PER_FTS_JOB bytes, whichever comes first
+MAX_FILES_PER_FTS_JOB = 50
+MAX_BYTES_PER_FTS_JOB = 50 * 2**30
+# max number of not completed FTS jobs per (source, destination) link. Files which do not fit
+# wait in PENDING_TRANSFERS_FILE and are submitted in a later iteration, in bigger jobs
+MAX_FTS_JOBS_PER_LINK = 10
+PENDING_TRANSFERS_FILE = 'task_process/transfers/pending_transfers.json'
+# {fts job id: [source, destination]} for the jobs in fts_jobids.txt
+FTS_JOB_LINKS_FILE = 'task_process/transfers/fts_job_links.json'
 
 if not os.path.exists('task_process/transfers'):
     os.makedirs('task_process/transfers')
@@ -95,6 +113,54 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def read_json_file(fileName, default):
+    """
+    :return: the content of a JSON file, or default if the file does not exist
+    """
+    if not os.path.exists(fileName):
+        return default
+    with open(fileName, 'r', encoding='utf-8') as fh:
+        return json.load(fh)
+
+
+def write_json_file(fileName, content):
+    """
+    replace the JSON file atomically
+    """
+    tmpFileName = fileName + '.tmp'
+    with open(tmpFileName, 'w', encoding='utf-8') as fh:
+        json.dump(content, fh)
+    os.rename(tmpFileName, fileName)
+
+
+def plan_FTSJobs(files, maxJobs):
+    """
+    split the transfers of one link in FTS jobs of at most MAX_FILES_PER_FTS_JOB files
+    and MAX_BYTES_PER_FTS_JOB bytes (a single bigger file gets its own job)
+    :param files: list of transfers as built in submit(), file size at index 7
+    :param maxJobs: max number of jobs to create
+    :return: list of jobs, each a list of transfers. Together they are the first files
+        in the input list, the other ones have to wait
+    """
+    jobs = []
+    job = []
+    jobBytes = 0
+    if maxJobs <= 0:
+        return jobs
+    for f in files:
+        if job and (len(job) >= MAX_FILES_PER_FTS_JOB or jobBytes + f[7] > MAX_BYTES_PER_FTS_JOB):
+            jobs.append(job)
+            if len(jobs) >= maxJobs:
+                return jobs
+            job = []
+            jobBytes = 0
+        job.append(f)
+        jobBytes += f[7]
+    if job:
+        jobs.append(job)
+    return jobs
+
+
 def mark_transferred(ids, crabserver):
     """
     Mark the list of files as tranferred
@@ -145,6 +211,36 @@ def mark_failed(ids, failures_reasons, crabserver):
     return True
 
 
+def mark_jobs(jobIDs, done_id, failed_id, failed_reasons, crabserver):
+    """
+    Mark the files of many FTS jobs as transferred or failed, merging the files of
+    several jobs in the same REST call, up to about MARK_CHUNK_SIZE files per call
+    :param jobIDs: list of FTS job ids with files to mark
+    :param done_id, failed_id, failed_reasons: dictionaries {jobId: list} filled by check_FTSJob
+    :param crabserver: a CRABRest object for doing POST to CRAB server REST
+    :return: set of job ids whose files were all marked successfully
+    """
+    markedJobs = set()
+    group = []
+    numIds = 0
+    for i, jobID in enumerate(jobIDs):
+        logging.info('Marking job %s files done and %s files failed for job %s', len(done_id[jobID]), len(failed_id[jobID]), jobID)
+        group.append(jobID)
+        numIds += len(done_id[jobID]) + len(failed_id[jobID])
+        if numIds < MARK_CHUNK_SIZE and i < len(jobIDs) - 1:
+            continue
+        doneIds = [_id for j in group for _id in done_id[j]]
+        failedIds = [_id for j in group for _id in failed_id[j]]
+        reasons = [r for j in group for r in failed_reasons[j]]
+        markDone = mark_transferred(doneIds, crabserver) if doneIds else True
+        markFailed = mark_failed(failedIds, reasons, crabserver) if failedIds else True
+        if markDone and markFailed:
+            markedJobs.update(group)
+        group = []
+        numIds = 0
+    return markedJobs
+
+
 def remove_files_in_bkg(pfns, logFile, timeout=None):
     """
     fork a process to remove the indicated PFN's without
@@ -167,44 +263,93 @@ def remove_files_in_bkg(pfns, logFile, timeout=None):
     return
 
 
-def check_FTSJob(logger, ftsContext, jobid, jobsEnded, jobs_ongoing, done_id, failed_id, failed_reasons):
+def get_FTSJob_status(logger, ftsContext, jobid):
+    """
+    get status of one FTS job, with the file states if needed
+    :param logger: a logging object
+    :param ftsContext: FTS context
+    :param jobid: FTS job id
+    :return: job status dictionary as returned by FTS, None if FTS does not know the job
+    :raise: any exception raised by the FTS client, other than HTTP 404
+    """
+    try:
+        status = fts3.get_job_status(ftsContext, jobid, list_files=False)
+        if status["job_state"] in FTS_JOB_STATES_WITH_FILES:
+            status['files'] = fts3.get_job_status(ftsContext, jobid, list_files=True)['files']
+    except HTTPException as hte:
+        logger.exception(f"failed to retrieve status for {jobid}")
+        logger.exception(f"httpExeption headers {hte.headers}")
+        if hte.status == 404:
+            logger.exception(f"{jobid} not found in FTS3 DB")
+            return None
+        raise
+    return status
+
+
+def get_FTSJobs_statuses(logger, ftsContext, jobids):
+    """
+    get status of many FTS jobs. Jobs are queried FTS_STATUS_BATCH_SIZE at a time
+    in one request, with up to FTS_STATUS_WORKERS requests in parallel. If a bulk
+    request fails, the jobs in it are queried one by one.
+    :param logger: a logging object
+    :param ftsContext: FTS context
+    :param jobids: list of FTS job ids
+    :return: dictionary {jobid: job status with the file states, or None if FTS does not know the job}
+        jobs whose status could not be retrieved are not in the dictionary
+    """
+    def getBatch(batch):
+        statuses = {}
+        try:
+            jobs = fts3.get_jobs_statuses(ftsContext, batch, list_files=True)
+            # FTS returns a single object when only one job is asked for
+            if isinstance(jobs, dict):
+                jobs = [jobs]
+            for job in jobs:
+                if str(job.get('http_status', '')).startswith('404'):
+                    logger.error(f"{job['job_id']} not found in FTS3 DB")
+                    statuses[job['job_id']] = None
+                elif 'job_state' in job:
+                    statuses[job['job_id']] = job
+            return statuses
+        except Exception:
+            logger.exception(f"failed to retrieve status for jobs {batch}, will query them one by one")
+        for jobid in batch:
+            try:
+                statuses[jobid] = get_FTSJob_status(logger, ftsContext, jobid)
+            except Exception:
+                logger.exception(f"failed to retrieve status for {jobid}")
+        return statuses
+
+    statuses = {}
+    batches = list(chunks(jobids, FTS_STATUS_BATCH_SIZE))
+    if not batches:
+        return statuses
+    with ThreadPoolExecutor(max_workers=min(FTS_STATUS_WORKERS, len(batches))) as executor:
+        for batchStatuses in executor.map(getBatch, batches):
+            statuses.update(batchStatuses)
+    return statuses
+
+
+def check_FTSJob(logger, jobid, status, jobsEnded, done_id, failed_id, failed_reasons):
     """
     get transfers state per jobid
 
     INPUT PARAMS
     :param logger: a logging object
-    :param ftsContext:
     :param jobid:
+    :param status: job status as returned by get_FTSJobs_statuses
     OUTPUT PARAMS
     :prarm jobsEnded:
-    :param jobs_ongoing:
     :param done_id:
     :param failed_id:
     :param failed_reasons:
     - check if the fts job is in final state (FINISHED, FINISHEDDIRTY, CANCELED, FAILED)
     - get file transfers states and get corresponding oracle ID from FTS file metadata
-    - update states on oracle
     """
 
-    logger.info(f"Getting state of job {jobid}")
-
-    jobs_ongoing.append(jobid)
     file_statuses = {}
-
-    try:
-        status = fts3.get_job_status(ftsContext, jobid, list_files=False)
-        if status["job_state"] in ['ACTIVE', 'FINISHED', 'FINISHEDDIRTY', "FAILED", "CANCELED"]:
-            file_statuses = fts3.get_job_status(ftsContext, jobid, list_files=True)['files']
-    except HTTPException as hte:
-        logger.exception(f"failed to retrieve status for {jobid}")
-        logger.exception(f"httpExeption headers {hte.headers}")
-        if hte.status == 404:
-            logger.exception(f"{jobid} not found in FTS3 DB")
-            jobs_ongoing.remove(jobid)
-        return
-    except Exception:
-        logger.exception(f"failed to retrieve status for {jobid}")
-        return
+    if status["job_state"] in FTS_JOB_STATES_WITH_FILES:
+        file_statuses = status.get('files', {})
 
     logger.info("State of job %s: %s", jobid, status["job_state"])
 
@@ -376,12 +521,13 @@ def submitToFTS(logger, ftsContext, files, jobids, toUpdate):
     return jobid
 
 
-def submit(rucioClient, ftsContext, toTrans, crabserver):
+def submit(rucioClient, ftsContext, toTrans, crabserver, jobLinks):
     """
     submit tranfer jobs
 
     - group files to be transferred by source site
-    - prepare jobs chunks of max 200 transfers
+    - prepare jobs of max MAX_FILES_PER_FTS_JOB transfers and MAX_BYTES_PER_FTS_JOB bytes,
+      without exceeding MAX_FTS_JOBS_PER_LINK not completed jobs per link
     - submit fts job
 
     :param ftsContext: fts client ftsContext
@@ -394,10 +540,16 @@ def submit(rucioClient, ftsContext, toTrans, crabserver):
                       taskname,
                       filesize, checksum],....]
     :param crabserver: an CRABRest object for doing POST to CRAB server REST
-    :return: list of jobids submitted
+    :param jobLinks: {fts job id: [source, destination]} of the jobs not completed yet,
+        new jobs are added to it
+    :return: tuple (list of jobids submitted, list of transfers from toTrans which have to wait)
     """
     jobids = []
     to_update = []
+    deferred = []
+    jobsPerLink = {}
+    for link in jobLinks.values():
+        jobsPerLink[tuple(link)] = jobsPerLink.get(tuple(link), 0) + 1
 
     # some things are the same for all files, pick them from the first one
     username = toTrans[0][5]
@@ -475,9 +627,18 @@ def submit(rucioClient, ftsContext, toTrans, crabserver):
             xfer = [src_pfn, dst_pfn, jobid, source, dst_rse, username, taskname, size, checksums['adler32'].rjust(8, '0')]
             tx_from_source.append(xfer)
 
-        xfersPerFTSJob = 50
-        for files in chunks(tx_from_source, xfersPerFTSJob):
+        link = (source, dst_rse)
+        ftsJobs = plan_FTSJobs(tx_from_source, MAX_FTS_JOBS_PER_LINK - jobsPerLink.get(link, 0))
+        numPlanned = sum(len(files) for files in ftsJobs)
+        if numPlanned < len(tx_from_source):
+            logging.info("Link %s -> %s has %d jobs in flight, %d transfers will wait",
+                         source, dst_rse, jobsPerLink.get(link, 0), len(tx_from_source) - numPlanned)
+            # tx_from_source is built in the same order as toTransFromThisSource
+            deferred += toTransFromThisSource[numPlanned:]
+        for files in ftsJobs:
             ftsJobId = submitToFTS(logging, ftsContext, files, jobids, to_update)
+            jobLinks[ftsJobId] = list(link)
+            jobsPerLink[link] = jobsPerLink.get(link, 0) + 1
             # save oracleIds of files in this job in a local file
             jobContentFileName = 'task_process/transfers/' + ftsJobId + '.json'
             with open(jobContentFileName, 'w', encoding='utf-8') as fh:
@@ -487,10 +648,10 @@ def submit(rucioClient, ftsContext, toTrans, crabserver):
         _ = crabserver.post('filetransfers', data=encodeRequest(fileDoc))
         logging.info("Marked submitted %s files", fileDoc['list_of_ids'])
 
-    return jobids
+    return jobids, deferred
 
 
-def perform_transfers(inputFile, lastLine, _lastFile, ftsContext, rucioClient, crabserver):
+def perform_transfers(inputFile, lastLine, _lastFile, ftsContext, rucioClient, crabserver, jobLinks):
     """
     get transfers and update last read line number
 
@@ -499,10 +660,12 @@ def perform_transfers(inputFile, lastLine, _lastFile, ftsContext, rucioClient, c
     :param _last: path to the file keeping track of the last read line
     :param ftsContext: FTS context
     :param rucioClient: a Rucio Client object
+    :param jobLinks: {fts job id: [source, destination]} of the jobs not completed yet
     :return:
     """
 
-    transfers = []
+    # transfers which did not fit in the previous iterations go first
+    transfers = read_json_file(PENDING_TRANSFERS_FILE, [])
     logging.info("starting from line: %s", lastLine)
 
     # read one doc from each line in input file
@@ -546,14 +709,16 @@ def perform_transfers(inputFile, lastLine, _lastFile, ftsContext, rucioClient, c
                               doc["checksums"]])
 
         jobids = []
+        deferred = []
         if transfers:
-            jobids = submit(rucioClient, ftsContext, transfers, crabserver)
+            jobids, deferred = submit(rucioClient, ftsContext, transfers, crabserver, jobLinks)
 
             for jobid in jobids:
                 logging.info("Monitor link: " + FTS_MONITORING + "fts3/ftsmon/#/job/%s", jobid)  # pylint: disable=logging-not-lazy
 
             # TODO: send to dashboard
 
+        write_json_file(PENDING_TRANSFERS_FILE, deferred)
         _lastFile.write(str(lastLine))
 
     return transfers, jobids
@@ -574,13 +739,25 @@ def state_manager(ftsContext, crabserver):
 
     if os.path.exists('task_process/transfers/fts_jobids.txt'):
         with open("task_process/transfers/fts_jobids.txt", "r", encoding='utf-8') as _jobids:
-            lines = _jobids.readlines()
-            for line in list(set(lines)):
-                if line:
-                    jobid = line.split('\n')[0]
-                if jobid:
-                    check_FTSJob(logging, ftsContext, jobid, jobsEnded, jobs_ongoing, done_id, failed_id, failed_reasons)
-            _jobids.close()
+            jobids = []
+            for line in _jobids.readlines():
+                jobid = line.split('\n')[0]
+                if jobid and jobid not in jobids:
+                    jobids.append(jobid)
+
+        # one (bulk) FTS request per FTS_STATUS_BATCH_SIZE jobs instead of one or two per job
+        logging.info("Getting state of %d jobs", len(jobids))
+        statuses = get_FTSJobs_statuses(logging, ftsContext, jobids)
+        for jobid in jobids:
+            jobs_ongoing.append(jobid)
+            if jobid not in statuses:
+                # failed to get the status, try again next time
+                continue
+            if statuses[jobid] is None:
+                # not in FTS DB anymore, stop monitoring it
+                jobs_ongoing.remove(jobid)
+                continue
+            check_FTSJob(logging, jobid, statuses[jobid], jobsEnded, done_id, failed_id, failed_reasons)
 
         # the loop above has filled:
         # job_ongoing: list of FTS jobs processed
@@ -589,21 +766,12 @@ def state_manager(ftsContext, crabserver):
         # but at this point a given FTS job may be compelted, or still ACTIVE and only part of its transfers are
         # reported as done/failed.
         try:
-            # process all jobs for which some xfers have been reported as dobe
+            # process all jobs for which some xfers have been reported as done or failed
+            markedJobs = mark_jobs(list(done_id), done_id, failed_id, failed_reasons, crabserver)
             for jobID in done_id:
-                logging.info('Marking job %s files done and %s files failed for job %s', len(done_id[jobID]), len(failed_id[jobID]), jobID)
-
-                if done_id[jobID]:
-                    markDone = mark_transferred(done_id[jobID], crabserver)
-                else:
-                    markDone = True
-                if failed_id[jobID]:
-                    markFailed = mark_failed(failed_id[jobID], failed_reasons[jobID], crabserver)
-                else:
-                    markFailed = True
                 if jobID in jobsEnded:
                     # only remove a Terminated FTS job from the list of xfer marking was successful, otherwise will try again
-                    if markDone and markFailed:
+                    if jobID in markedJobs:
                         jobs_done.append(jobID)
                         jobs_ongoing.remove(jobID)
         except Exception:
@@ -621,10 +789,14 @@ def state_manager(ftsContext, crabserver):
     return jobs_ongoing
 
 
-def submission_manager(rucioClient, ftsContext, crabserver):
+def submission_manager(rucioClient, ftsContext, crabserver, jobs_ongoing):
     """
 
     """
+    # links of the jobs which are not completed, to limit the number of jobs per link
+    jobLinks = read_json_file(FTS_JOB_LINKS_FILE, {})
+    jobLinks = {jobid: link for jobid, link in jobLinks.items() if jobid in jobs_ongoing}
+
     last_line = 0
     if os.path.exists('task_process/transfers/last_transfer.txt'):
         with open("task_process/transfers/last_transfer.txt", "r", encoding='utf-8') as _last:
@@ -635,9 +807,10 @@ def submission_manager(rucioClient, ftsContext, crabserver):
 
     # TODO: if the following fails check not to leave a corrupted file
     with open("task_process/transfers/last_transfer_new.txt", "w+", encoding='utf-8') as _last:
-        _, jobids = perform_transfers("task_process/transfers.txt", last_line, _last, ftsContext, rucioClient, crabserver)
+        _, jobids = perform_transfers("task_process/transfers.txt", last_line, _last, ftsContext, rucioClient, crabserver, jobLinks)
         _last.close()
         os.rename("task_process/transfers/last_transfer_new.txt", "task_process/transfers/last_transfer.txt")
+    write_json_file(FTS_JOB_LINKS_FILE, jobLinks)
 
     with open("task_process/transfers/fts_jobids.txt", "a", encoding='utf-8') as _jobids:
         for job in jobids:
@@ -703,7 +876,7 @@ def algorithm():
         raise exc
 
     jobs_ongoing = state_manager(ftsContext, crabserver)
-    new_jobs = submission_manager(rucioClient, ftsContext, crabserver)
+    new_jobs = submission_manager(rucioClient, ftsContext, crabserver, jobs_ongoing)
 
     logging.info("Transfer jobs ongoing: %s, new: %s ", jobs_ongoing, new_jobs)
 
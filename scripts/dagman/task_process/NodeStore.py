@@ -0,0 +1,302 @@
+"""
+Compact storage of the per DAG node information collected by cache_status.py
+
+Instead of one dictionary per node holding a dozen python lists, the information
+is kept in fixed width array columns:
+ - one row per node for the scalar values (State, Retries, Restarts, RecordedSite)
+ - one row per job attempt (submission or restart) in a "retry index" table for the
+   values which are appended together at each attempt (SubmitTimes, cpu times, RSS, JobIds)
+ - one row per entry in separate tables for StartTimes, EndTimes, WallDurations and
+   SiteHistory, which can have a different length than the number of attempts
+Each table row points to the previous row of the same node, and each node points to
+its last row, so appending is O(1) and the per node lists are rebuilt only when
+the legacy dictionary is needed, i.e. when writing status_cache.pkl/json/txt.
+Arrays pickle as plain bytes, which makes saving and loading the store cheap.
+Times from the job log are whole seconds and are kept in integer columns. CPU times and
+wall durations can be fractional, their whole values are written back as int in the
+status_cache files, as they were when the nodes were kept in dictionaries.
+"""
+import hashlib
+import pickle
+from array import array
+
+STATES = [None, 'unsubmitted', 'idle', 'running', 'held', 'transferring', 'cooloff', 'finished', 'failed', 'killed']
+STATE_CODES = {name: code for code, name in enumerate(STATES)}
+
+STORE_FORMAT_VERSION = 2
+
+
+def wholeToInt(values):
+    """
+    :return: the list of values of a float column, with whole numbers as int
+    """
+    return [int(value) if value.is_integer() else value for value in values]
+
+
+class Chain():
+    """
+    Variable length per node lists stored as rows of fixed width columns.
+    All columns of a Chain are appended together.
+    """
+    def __init__(self, columns):
+        """
+        :param columns: list of (name, array typecode) tuples
+        """
+        self.names = [name for name, _ in columns]
+        self.columns = {name: array(typecode) for name, typecode in columns}
+        self.prev = array('q')
+        self.head = array('q')
+        self.length = array('i')
+
+    def addNode(self):
+        self.head.append(-1)
+        self.length.append(0)
+
+    def append(self, node, *values):
+        row = len(self.prev)
+        for name, value in zip(self.names, values):
+            self.columns[name].append(value)
+        self.prev.append(self.head[node])
+        self.head[node] = row
+        self.length[node] += 1
+
+    def count(self, node):
+        return self.length[node]
+
+    def _lastRow(self, node):
+        row = self.head[node]
+        if row < 0:
+            # same as accessing [-1] of an empty list in the node dictionary
+            raise IndexError("no entries for this node")
+        return row
+
+    def last(self, node, name):
+        return self.columns[name][self._lastRow(node)]
+
+    def setLast(self, node, name, value):
+        self.columns[name][self._lastRow(node)] = value
+
+    def values(self, node, name):
+        column = self.columns[name]
+        result = []
+        row = self.head[node]
+        while row >= 0:
+            result.append(column[row])
+            row = self.prev[row]
+        result.reverse()
+        return result
+
+    def dump(self):
+        return {'columns': self.columns, 'prev': self.prev, 'head': self.head, 'length': self.length}
+
+    def load(self, data):
+        self.columns = data['columns']
+        self.prev = data['prev']
+        self.head = data['head']
+        self.length = data['length']
+
+
+class NodeStore():
+    """
+    Array backed replacement for the {nodeId: nodeInfoDict} structure of cache_status.py
+    """
+    def __init__(self):
+        self.nodeIds = []
+        self.rows = {}
+        self.state = array('b')
+        self.recordedSite = array('b')  # -1 means not set
+        self.retries = array('i')
+        self.restarts = array('i')
+        self.attempts = Chain([('SubmitTimes', 'q'), ('TotalUserCpuTimeHistory', 'd'),
+                               ('TotalSysCpuTimeHistory', 'd'), ('ResidentSetSize', 'q'),
+                               ('JobCluster', 'q'), ('JobProc', 'i')])
+        self.startTimes = Chain([('StartTimes', 'q')])
+        self.endTimes = Chain([('EndTimes', 'q')])
+        self.wallDurations = Chain([('WallDurations', 'd')])
+        self.siteHistory = Chain([('SiteHistory', 'i')])
+        self.siteNames = []
+        self.siteCodes = {}
+        self.errors = {}
+        self.dagStatus = None
+        # (cluster, proc) -> node row
+        self.nodeMap = {}
+        self.jobLogCheckpoint = None
+        self.fjrParseResCheckpoint = 0
+        self.viewsDigest = None
+
+    def _chains(self):
+        return [self.attempts, self.startTimes, self.endTimes, self.wallDurations, self.siteHistory]
+
+    def row(self, nodeId):
+        """
+        Return the row of nodeId, adding a node with default values if not there yet
+        """
+        node = self.rows.get(nodeId)
+        if node is None:
+            node = len(self.nodeIds)
+            self.nodeIds.append(nodeId)
+            self.rows[nodeId] = node
+            self.state.append(0)
+            self.recordedSite.append(-1)
+            self.retries.append(0)
+            self.restarts.append(0)
+            for chain in self._chains():
+                chain.addNode()
+        return node
+
+    def getState(self, node):
+        return STATES[self.state[node]]
+
+    def setState(self, node, name):
+        self.state[node] = STATE_CODES[name]
+
+    def addSite(self, node, site):
+        code = self.siteCodes.get(site)
+        if code is None:
+            code = len(self.siteNames)
+            self.siteNames.append(site)
+            self.siteCodes[site] = code
+        self.siteHistory.append(node, code)
+
+    def addAttempt(self, node, submitTime, cluster, proc):
+        """
+        Record a new attempt for this node. Since WallDurations are initialized
+        at the same time as the other per attempt values, add one entry there as well
+        """
+        self.attempts.append(node, submitTime, 0, 0, 0, cluster, proc)
+        self.wallDurations.append(node, 0)
+
+    # - - - - - conversion from/to the legacy dictionaries - - - - -
+
+    def toNodeDict(self, node):
+        """
+        Build the dictionary which describes one node in status_cache files
+        """
+        info = {
+            'Retries': self.retries[node],
+            'Restarts': self.restarts[node],
+            'SiteHistory': [self.siteNames[code] for code in self.siteHistory.values(node, 'SiteHistory')],
+            'ResidentSetSize': self.attempts.values(node, 'ResidentSetSize'),
+            'SubmitTimes': self.attempts.values(node, 'SubmitTimes'),
+            'StartTimes': self.startTimes.values(node, 'StartTimes'),
+            'EndTimes': self.endTimes.values(node, 'EndTimes'),
+            'TotalUserCpuTimeHistory': wholeToInt(self.attempts.values(node, 'TotalUserCpuTimeHistory')),
+            'TotalSysCpuTimeHistory': wholeToInt(self.attempts.values(node, 'TotalSysCpuTimeHistory')),
+            'WallDurations': wholeToInt(self.wallDurations.values(node, 'WallDurations')),
+            'JobIds': ["%d.%d" % jobId for jobId in zip(self.attempts.values(node, 'JobCluster'),
+                                                         self.attempts.values(node, 'JobProc'))],
+        }
+        if self.state[node]:
+            info['State'] = STATES[self.state[node]]
+        if self.recordedSite[node] >= 0:
+            info['RecordedSite'] = bool(self.recordedSite[node])
+        if node in self.errors:
+            info['Error'] = self.errors[node]
+        return info
+
+    def toNodesDict(self):
+        """
+        Build the legacy {nodeId: nodeInfo, 'DagStatus': dagStatus} dictionary
+        """
+        nodes = {nodeId: self.toNodeDict(node) for node, nodeId in enumerate(self.nodeIds)}
+        if self.dagStatus is not None:
+            nodes['DagStatus'] = self.dagStatus
+        return nodes
+
+    def toNodeMapDict(self):
+        return {proc: self.nodeIds[node] for proc, node in self.nodeMap.items()}
+
+    @classmethod
+    def fromNodesDict(cls, nodes, nodeMap):
+        """
+        Build a store from the dictionaries found in a legacy status_cache.pkl
+        """
+        store = cls()
+        for nodeId, info in nodes.items():
+            if nodeId == 'DagStatus':
+                store.dagStatus = info
+                continue
+            node = store.row(nodeId)
+            if 'State' in info:
+                store.setState(node, info['State'])
+            if 'RecordedSite' in info:
+                store.recordedSite[node] = int(info['RecordedSite'])
+            store.retries[node] = info['Retries']
+            store.restarts[node] = info['Restarts']
+            for i, jobId in enumerate(info['JobIds']):
+                cluster, proc = jobId.split('.')
+                store.attempts.append(node, int(info['SubmitTimes'][i]), info['TotalUserCpuTimeHistory'][i],
+                                      info['TotalSysCpuTimeHistory'][i], info['ResidentSetSize'][i],
+                                      int(cluster), int(proc))
+            for value in info['StartTimes']:
+                store.startTimes.append(node, int(value))
+            for value in info['EndTimes']:
+                store.endTimes.append(node, int(value))
+            for value in info['WallDurations']:
+                store.wallDurations.append(node, value)
+            for site in info['SiteHistory']:
+                store.addSite(node, site)
+            if 'Error' in info:
+                store.errors[node] = info['Error']
+        for proc, nodeId in nodeMap.items():
+            store.nodeMap[proc] = store.row(nodeId)
+        return store
+
+    # - - - - - persistency - - - - -
+
+    def _content(self):
+        return {
+            'nodeIds': self.nodeIds,
+            'state': self.state,
+            'recordedSite': self.recordedSite,
+            'retries': self.retries,
+            'restarts': self.restarts,
+            'chains': {name: chain.dump() for name, chain in zip(
+                ['attempts', 'startTimes', 'endTimes', 'wallDurations', 'siteHistory'], self._chains())},
+            'siteNames': self.siteNames,
+            'errors': self.errors,
+            'dagStatus': self.dagStatus,
+            'nodeMap': self.nodeMap,
+        }
+
+    def dump(self, fp):
+        content = self._content()
+        content['version'] = STORE_FORMAT_VERSION
+        content['jobLogCheckpoint'] = self.jobLogCheckpoint
+        content['fjrParseResCheckpoint'] = self.fjrParseResCheckpoint
+        content['viewsDigest'] = self.viewsDigest
+        pickle.dump(content, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, fp):
+        content = pickle.load(fp)
+        if content.get('version') != STORE_FORMAT_VERSION:
+            raise ValueError("unsupported node store format version %s" % content.get('version'))
+        store = cls()
+        store.nodeIds = content['nodeIds']
+        store.rows = {nodeId: node for node, nodeId in enumerate(store.nodeIds)}
+        store.state = content['state']
+        store.recordedSite = content['recordedSite']
+        store.retries = content['retries']
+        store.restarts = content['restarts']
+        for name, chain in zip(['attempts', 'startTimes', 'endTimes', 'wallDurations', 'siteHistory'], store._chains()):
+            chain.load(content['chains'][name])
+        store.siteNames = content['siteNames']
+        store.siteCodes = {site: code for code, site in enumerate(store.siteNames)}
+        store.errors = content['errors']
+        store.dagStatus = content['dagStatus']
+        store.nodeMap = content['nodeMap']
+        store.jobLogCheckpoint = content['jobLogCheckpoint']
+        store.fjrParseResCheckpoint = content['fjrParseResCheckpoint']
+        store.viewsDigest = content['viewsDigest']
+        return store
+
+    def digest(self):
+        """
+        A fingerprint of everything which ends in the status_cache files, but the
+        job log checkpoint which changes at every run. Used to only rewrite those
+        files when something changed.
+        """
+        content = self._content()
+        content['fjrParseResCheckpoint'] = self.fjrParseResCheckpoint
+        return hashlib.sha1(pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
@@ -8,7 +8,6 @@ import time
 import logging
 import os
 import glob
-import copy
 from shutil import move
 import pickle
 import json
@@ -16,22 +15,11 @@ import json
 import htcondor2 as htcondor
 import classad2 as classad
 
-logging.basicConfig(filename='task_process/cache_status.log', level=logging.DEBUG)
+from NodeStore import NodeStore
 
-NODE_DEFAULTS = {
-    'Retries': 0,
-    'Restarts': 0,
-    'SiteHistory': [],
-    'ResidentSetSize': [],
-    'SubmitTimes': [],
-    'StartTimes': [],
-    'EndTimes': [],
-    'TotalUserCpuTimeHistory': [],
-    'TotalSysCpuTimeHistory': [],
-    'WallDurations': [],
-    'JobIds': []
-}
+logging.basicConfig(filename='task_process/cache_status.log', level=logging.DEBUG)
 
+NODE_STORE_FILE = "task_process/node_store.pkl"
 STATUS_CACHE_FILE = "task_process/status_cache.txt"
 PKL_STATUS_CACHE_FILE = "task_process/status_cache.pkl"
 JSON_STATUS_CACHE_FILE = "task_process/status_cache.json"
@@ -42,11 +30,12 @@ FJR_PARSE_RES_FILE = "task_process/fjr_parse_results.txt"
 cpuRe = re.compile(r"Usr \d+ (\d+):(\d+):(\d+), Sys \d+ (\d+):(\d+):(\d+)")
 
 
-def insertCpu(event, info):
+def insertCpu(event, store, node):
     """
     add CPU usage information to the job info record
     :param event: an event from HTCondor log
-    :param info: the structure where information for a job is collected
+    :param store: the NodeStore where information for all jobs is collected
+    :param node: the row of the job in the store
     :return: nothing
     """
     if 'TotalRemoteUsage' in event:
@@ -55,13 +44,29 @@ def insertCpu(event, info):
             g = [int(i) for i in m.groups()]
             user = g[0] * 3600 + g[1] * 60 + g[2]
             system = g[3] * 3600 + g[4] * 60 + g[5]
-            info['TotalUserCpuTimeHistory'][-1] = user
-            info['TotalSysCpuTimeHistory'][-1] = system
+            store.attempts.setLast(node, 'TotalUserCpuTimeHistory', user)
+            store.attempts.setLast(node, 'TotalSysCpuTimeHistory', system)
     else:
         if 'RemoteSysCpu' in event:
-            info['TotalSysCpuTimeHistory'][-1] = float(event['RemoteSysCpu'])
+            store.attempts.setLast(node, 'TotalSysCpuTimeHistory', float(event['RemoteSysCpu']))
         if 'RemoteUserCpu' in event:
-            info['TotalUserCpuTimeHistory'][-1] = float(event['RemoteUserCpu'])
+            store.attempts.setLast(node, 'TotalUserCpuTimeHistory', float(event['RemoteUserCpu']))
+
+
+def setLastWallDuration(store, node):
+    """
+    set the last wall duration of a job to the difference between its last end and start times
+    """
+    store.wallDurations.setLast(node, 'WallDurations',
+                                store.endTimes.last(node, 'EndTimes') - store.startTimes.last(node, 'StartTimes'))
+
+
+def recordRestart(store, node):
+    """
+    a job went back to idle after running, start collecting information for a new attempt
+    """
+    store.addAttempt(node, -1, store.attempts.last(node, 'JobCluster'), store.attempts.last(node, 'JobProc'))
+    store.restarts[node] += 1
 
 
 nodeNameRe = re.compile(r"DAG Node: Job(\d+(?:-\d+)?)")
@@ -71,123 +76,108 @@ nodeName2Re = re.compile(r"Job(\d+(?:-\d+)?)")
 # this now takes as input an htcondor.JobEventLog object
 # which as of HTCondor 8.9 can be saved/restored with memory of
 # where it had reached in processing the job log file
-def parseJobLog(jel, nodes, nodeMap):
+def parseJobLog(jel, store):
     """
-    parses new events in condor job log file and updates nodeMap
+    parses new events in condor job log file and updates the node store
     :param jel: a condor JobEventLog object which provides an iterator over events
-    :param nodes: the structure where we collect one job info for cache_status file
-    :param nodeMap: a structure to map DAG node id (i.e. CRAB_Id) to condor jobid Cluster.Proc
+    :param store: the NodeStore where we collect jobs info for cache_status file. Its nodeMap
+                    maps condor jobid (Cluster, Proc) to the row of the DAG node (i.e. CRAB_Id)
                     first (Submit) event in job_log has a LogNotes attribute with the DAG id,
                     but subsequent ones are only identified via Cluster and Proc
     :return: nothing
     """
     count = 0
+    nodeMap = store.nodeMap
     for event in jel.events(0):
         count += 1
-        eventtime = time.mktime(time.strptime(event['EventTime'], "%Y-%m-%dT%H:%M:%S"))
+        eventtime = int(time.mktime(time.strptime(event['EventTime'], "%Y-%m-%dT%H:%M:%S")))
         if event['MyType'] == 'SubmitEvent':
             m = nodeNameRe.match(event['LogNotes'])  # True if LogNotes is like 'DAG Node: Job13'
             if m:
-                node = m.groups()[0]  # the number after 'DAG Node: Job' e.g. '13' (as a string), i.e. CRAB_Id
-                proc = event['Cluster'], event['Proc']  # SB: why a tuple instead of a string  like '10210368.0' ?
-                info = nodes.setdefault(node, copy.deepcopy(NODE_DEFAULTS))  # adds key "node" and makes info=NODE_DEFAULTS
-                info['State'] = 'idle'
-                info['JobIds'].append("%d.%d" % proc)
-                info['RecordedSite'] = False
-                info['SubmitTimes'].append(eventtime)
-                info['TotalUserCpuTimeHistory'].append(0)
-                info['TotalSysCpuTimeHistory'].append(0)
-                info['WallDurations'].append(0)
-                info['ResidentSetSize'].append(0)
-                info['Retries'] = len(info['SubmitTimes']) - 1
-                nodeMap[proc] = node  # nodeMap maps CRAB_Id '13' to (cluster, proc) i.e. condor jobId
+                nodeId = m.groups()[0]  # the number after 'DAG Node: Job' e.g. '13' (as a string), i.e. CRAB_Id
+                proc = event['Cluster'], event['Proc']
+                node = store.row(nodeId)  # adds the node with default values if needed
+                store.setState(node, 'idle')
+                store.recordedSite[node] = False
+                store.addAttempt(node, eventtime, proc[0], proc[1])
+                # all attempts but restarts have a SubmitTime
+                store.retries[node] = store.attempts.count(node) - 1
+                nodeMap[proc] = node  # nodeMap maps condor jobId to the node row
         elif event['MyType'] == 'ExecuteEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            nodes[node]['StartTimes'].append(eventtime)
-            nodes[node]['State'] = 'running'
-            nodes[node]['RecordedSite'] = False
+            store.startTimes.append(node, eventtime)
+            store.setState(node, 'running')
+            store.recordedSite[node] = False
         elif event['MyType'] == 'JobTerminatedEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            nodes[node]['EndTimes'].append(eventtime)
+            store.endTimes.append(node, eventtime)
             # at times HTCondor does not log the ExecuteEvent and there's no StartTime
-            if nodes[node]['StartTimes'] and nodes[node]['StartTimes'][-1] > 0:
-                nodes[node]['WallDurations'][-1] = nodes[node]['EndTimes'][-1] - nodes[node]['StartTimes'][-1]
+            if store.startTimes.count(node) and store.startTimes.last(node, 'StartTimes') > 0:
+                setLastWallDuration(store, node)
             else:
-                nodes[node]['WallDurations'][-1] = 0
-            insertCpu(event, nodes[node])
+                store.wallDurations.setLast(node, 'WallDurations', 0)
+            insertCpu(event, store, node)
             if event['TerminatedNormally']:
                 if event['ReturnValue'] == 0:
-                    nodes[node]['State'] = 'transferring'
+                    store.setState(node, 'transferring')
                 else:
-                    nodes[node]['State'] = 'cooloff'
+                    store.setState(node, 'cooloff')
             else:
-                nodes[node]['State'] = 'cooloff'
+                store.setState(node, 'cooloff')
         elif event['MyType'] == 'PostScriptTerminatedEvent':
             m = nodeName2Re.match(event['DAGNodeName'])
             if m:
-                node = m.groups()[0]
+                node = store.rows[m.groups()[0]]
                 if event['TerminatedNormally']:
                     if event['ReturnValue'] == 0:
-                        nodes[node]['State'] = 'finished'
+                        store.setState(node, 'finished')
                     elif event['ReturnValue'] == 2:
-                        nodes[node]['State'] = 'failed'
+                        store.setState(node, 'failed')
                     else:
-                        nodes[node]['State'] = 'cooloff'
+                        store.setState(node, 'cooloff')
                 else:
-                    nodes[node]['State'] = 'cooloff'
+                    store.setState(node, 'cooloff')
         elif event['MyType'] == 'ShadowExceptionEvent' or event["MyType"] == "JobReconnectFailedEvent" or event['MyType'] == 'JobEvictedEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            if nodes[node]['State'] != 'idle':
-                nodes[node]['EndTimes'].append(eventtime)
-                if nodes[node]['WallDurations'] and nodes[node]['EndTimes'] and nodes[node]['StartTimes']:
-                    nodes[node]['WallDurations'][-1] = nodes[node]['EndTimes'][-1] - nodes[node]['StartTimes'][-1]
-                nodes[node]['State'] = 'idle'
-                insertCpu(event, nodes[node])
-                nodes[node]['TotalUserCpuTimeHistory'].append(0)
-                nodes[node]['TotalSysCpuTimeHistory'].append(0)
-                nodes[node]['WallDurations'].append(0)
-                nodes[node]['ResidentSetSize'].append(0)
-                nodes[node]['SubmitTimes'].append(-1)
-                nodes[node]['JobIds'].append(nodes[node]['JobIds'][-1])
-                nodes[node]['Restarts'] += 1
+            if store.getState(node) != 'idle':
+                store.endTimes.append(node, eventtime)
+                if store.wallDurations.count(node) and store.startTimes.count(node):
+                    setLastWallDuration(store, node)
+                store.setState(node, 'idle')
+                insertCpu(event, store, node)
+                recordRestart(store, node)
         elif event['MyType'] == 'JobAbortedEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            if nodes[node]['State'] == "idle" or nodes[node]['State'] == "held":
-                nodes[node]['StartTimes'].append(-1)
-                if not nodes[node]['RecordedSite']:
-                    nodes[node]['SiteHistory'].append("Unknown")
-            nodes[node]['State'] = 'killed'
-            insertCpu(event, nodes[node])
+            if store.getState(node) == "idle" or store.getState(node) == "held":
+                store.startTimes.append(node, -1)
+                if not store.recordedSite[node] > 0:
+                    store.addSite(node, "Unknown")
+            store.setState(node, 'killed')
+            insertCpu(event, store, node)
         elif event['MyType'] == 'JobHeldEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            if nodes[node]['State'] == 'running':
-                nodes[node]['EndTimes'].append(eventtime)
-                if nodes[node]['WallDurations'] and nodes[node]['EndTimes'] and nodes[node]['StartTimes']:
-                    nodes[node]['WallDurations'][-1] = nodes[node]['EndTimes'][-1] - nodes[node]['StartTimes'][-1]
-                insertCpu(event, nodes[node])
-                nodes[node]['TotalUserCpuTimeHistory'].append(0)
-                nodes[node]['TotalSysCpuTimeHistory'].append(0)
-                nodes[node]['WallDurations'].append(0)
-                nodes[node]['ResidentSetSize'].append(0)
-                nodes[node]['SubmitTimes'].append(-1)
-                nodes[node]['JobIds'].append(nodes[node]['JobIds'][-1])
-                nodes[node]['Restarts'] += 1
-            nodes[node]['State'] = 'held'
+            if store.getState(node) == 'running':
+                store.endTimes.append(node, eventtime)
+                if store.wallDurations.count(node) and store.startTimes.count(node):
+                    setLastWallDuration(store, node)
+                insertCpu(event, store, node)
+                recordRestart(store, node)
+            store.setState(node, 'held')
         elif event['MyType'] == 'JobReleaseEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            nodes[node]['State'] = 'idle'
+            store.setState(node, 'idle')
         elif event['MyType'] == 'JobAdInformationEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            if (not nodes[node]['RecordedSite']) and ('JOBGLIDEIN_CMSSite' in event) and not event['JOBGLIDEIN_CMSSite'].startswith("$$"):
-                nodes[node]['SiteHistory'].append(event['JOBGLIDEIN_CMSSite'])
-                nodes[node]['RecordedSite'] = True
-            insertCpu(event, nodes[node])
+            if (not store.recordedSite[node] > 0) and ('JOBGLIDEIN_CMSSite' in event) and not event['JOBGLIDEIN_CMSSite'].startswith("$$"):
+                store.addSite(node, event['JOBGLIDEIN_CMSSite'])
+                store.recordedSite[node] = True
+            insertCpu(event, store, node)
         elif event['MyType'] == 'JobImageSizeEvent':
             node = nodeMap[event['Cluster'], event['Proc']]
-            nodes[node]['ResidentSetSize'][-1] = int(event['ResidentSetSize'])
-            if nodes[node]['StartTimes']:
-                nodes[node]['WallDurations'][-1] = eventtime - nodes[node]['StartTimes'][-1]
-            insertCpu(event, nodes[node])
+            store.attempts.setLast(node, 'ResidentSetSize', int(event['ResidentSetSize']))
+            if store.startTimes.count(node):
+                store.wallDurations.setLast(node, 'WallDurations', eventtime - store.startTimes.last(node, 'StartTimes'))
+            insertCpu(event, store, node)
         elif event["MyType"] == "JobDisconnectedEvent" \
                 or event["MyType"] == "JobReconnectedEvent" \
                 or event["MyType"] == "FileTransferEvent":
@@ -198,57 +188,56 @@ def parseJobLog(jel, nodes, nodeMap):
 
     logging.debug("There were %d events in the job log.", count)
     now = time.time()
-    for node, info in nodes.items():
-        if node == 'DagStatus':
-            # StartTimes and WallDurations are not present, though crab status2 uses this record to get the DagStatus.
-            continue
+    for node in range(len(store.nodeIds)):
         lastStart = now
-        if info['StartTimes']:
-            lastStart = info['StartTimes'][-1]
-        while len(info['WallDurations']) < len(info['SiteHistory']):
+        if store.startTimes.count(node):
+            lastStart = store.startTimes.last(node, 'StartTimes')
+        while store.wallDurations.count(node) < store.siteHistory.count(node):
             if lastStart > 0:
-                info['WallDurations'].append(now - lastStart)
+                store.wallDurations.append(node, now - lastStart)
             else:  # this means job did not start
-                info['WallDurations'].append(0)
-        while len(info['WallDurations']) > len(info['SiteHistory']):
-            info['SiteHistory'].append("Unknown")
+                store.wallDurations.append(node, 0)
+        while store.wallDurations.count(node) > store.siteHistory.count(node):
+            store.addSite(node, "Unknown")
 
 
-def parseErrorReport(fjrReports, nodes):
+def parseErrorReport(fjrReports, store):
     """
     iterate over the jobs and set the error dict for those which are failed
     :param fjrReports: a dictionary as returned by summarizeFjrParseResults() : {jobid:errdict}
                  errdict is {crab_retry:error_summary} from PostJob/prepareErrorSummary
                  which writes one line for PostJoun run: {job_id : {crab_retry : error_summary}}
                  in which crab_retry is a string and error_summary is a list [exitcode, errorMsg, {}]
-    :param nodes: a dictionary with format {jobid:dictionary}
+    :param store: the NodeStore with jobs info
     :return: nothing
-    : SIDE ACTION: modifies nodes in place by adding the Error key to the dictionary of matching jobs
-                   with content = error_summary
+    : SIDE ACTION: modifies store in place by setting the Error of matching jobs
+                   to error_summary
     explicitely:
      fjrReports = {jobid (string): errdict(dict)}
      errdict = {retry(string): error_Summary(list)}
     example:
        fjrReports['2'] = {'0': [5, 'Error while running CMSSW:\n', {}]}
-    in node[jobid]['Error'] we want the list  [5, 'Error while running CMSSW:\n', {}]
+    in the Error of node jobid we want the list  [5, 'Error while running CMSSW:\n', {}]
     which is what CRAB CLient status command expects.
     """
     for jobid in fjrReports:
-        if jobid in nodes:
+        if jobid in store.rows:
             # there should be only one retry, but anyhow ... find the last retry attempt
             # by taking the maximum key (retry number).
             last_retry = max(fjrReports[jobid], key=int)  # Get the latest retry (largest key).
             # Set the error summary from the last retry attempt.
-            nodes[jobid]['Error'] = fjrReports[jobid][last_retry]
+            store.errors[store.rows[jobid]] = fjrReports[jobid][last_retry]
 
-def parseNodeStateV2(fp, nodes, level):
+def parseNodeStateV2(fp, store, level):
     """
     HTCondor 8.1.6 updated the node state file to be classad-based.
     This is a more flexible format that allows future extensions but, unfortunately,
     also requires a separate parser.
     """
-    # note that when nodes was read from cache, setdefault returns the current value
-    dagStatus = nodes.setdefault("DagStatus", {})
+    # note that when store was read from cache, dagStatus is the current value
+    if store.dagStatus is None:
+        store.dagStatus = {}
+    dagStatus = store.dagStatus
     dagStatus.setdefault("SubDagStatus", {})
     subDagStatus = dagStatus.setdefault("SubDags", {})
     for ad in classad.parseAds(fp):
@@ -289,34 +278,34 @@ def parseNodeStateV2(fp, nodes, level):
         status = ad.get('NodeStatus', -1)
         retry = ad.get('RetryCount', -1)
         msg = ad.get("StatusDetails", "")
-        info = nodes.setdefault(nodeid, copy.deepcopy(NODE_DEFAULTS))
+        node = store.row(nodeid)
         if status == 1: # STATUS_READY
             if retry == 0:
-                info['State'] = 'unsubmitted'
+                store.setState(node, 'unsubmitted')
             else:
-                info['State'] = 'cooloff'
+                store.setState(node, 'cooloff')
         elif status == 2: # STATUS_PRERUN
             if retry == 0:
-                info['State'] = 'unsubmitted'
+                store.setState(node, 'unsubmitted')
             else:
-                info['State'] = 'cooloff'
+                store.setState(node, 'cooloff')
         elif status == 3: # STATUS_SUBMITTED
             if msg == 'not_idle':
-                info['State'] = 'running'
+                store.setState(node, 'running')
             else:
-                info['State'] = 'idle'
+                store.setState(node, 'idle')
         elif status == 4: # STATUS_POSTRUN
-            if info.get("State") != "cooloff":
-                info['State'] = 'transferring'
+            if store.getState(node) != "cooloff":
+                store.setState(node, 'transferring')
         elif status == 5: # STATUS_DONE
-            info['State'] = 'finished'
+            store.setState(node, 'finished')
         elif status == 6: # STATUS_ERROR
             # Older versions of HTCondor would put jobs into STATUS_ERROR
             # for a short time if the job was to be retried.  Hence, we had
             # some status parsing logic to try and guess whether the job would
             # be tried again in the near future.  This behavior is no longer
             # observed; STATUS_ERROR is terminal.
-            info['State'] = 'failed'
+            store.setState(node, 'failed')
 
 def readOldStatusCacheFile():
     """
@@ -353,58 +342,100 @@ def readOldStatusCacheFile():
     cacheDoc['nodeMap'] = nodeMap
     return cacheDoc
 
-def parseCondorLog(cacheDoc):
+def readNodeStore():
     """
-    do all real work and update checkpoints, nodes and nodemap dictionaries
-    takes as input a cacheDoc dictionary with keys
-      jobLogCheckpoint, fjrParseResCheckpoint, nodes, nodeMap
-    and returns the same dictionary with updated information
+    load the NodeStore saved by the previous run. When there is none, e.g. the task
+    was started with a previous version of this script, build it from status_cache.pkl
+    returns: a NodeStore object
     """
+    if not os.path.exists(NODE_STORE_FILE):
+        cacheDoc = readOldStatusCacheFile()
+        store = NodeStore.fromNodesDict(cacheDoc['nodes'], cacheDoc['nodeMap'])
+        store.jobLogCheckpoint = cacheDoc['jobLogCheckpoint']
+        store.fjrParseResCheckpoint = cacheDoc['fjrParseResCheckpoint']
+        return store
+    try:
+        with open(NODE_STORE_FILE, 'rb') as fp:
+            return NodeStore.load(fp)
+    except Exception:  # pylint: disable=broad-except
+        # status_cache.pkl may be older than the store, so it is not safe to resume from it
+        logging.exception("error loading node store, will parse the job log from the beginning")
+        return NodeStore()
 
-    jobLogCheckpoint = cacheDoc['jobLogCheckpoint']
-    fjrParseResCheckpoint = cacheDoc['fjrParseResCheckpoint']
-    nodes = cacheDoc['nodes']
-    nodeMap = cacheDoc['nodeMap']
-    if jobLogCheckpoint:
+
+def parseCondorLog(store):
+    """
+    do all real work and update checkpoints and nodes information in the NodeStore
+    takes as input a NodeStore object and returns the collapsed DAG status
+    """
+
+    if store.jobLogCheckpoint:
         # resume log parsing where we left
-        with open((LOG_PARSING_POINTERS_DIR+jobLogCheckpoint), 'rb') as f:
+        with open((LOG_PARSING_POINTERS_DIR+store.jobLogCheckpoint), 'rb') as f:
             jel = pickle.load(f)
     else:
         # parse log from beginning
         jel = htcondor.JobEventLog('job_log')
 
-    parseJobLog(jel, nodes, nodeMap)
+    parseJobLog(jel, store)
     # save jel object in a pickle file made unique by a timestamp
     newJelPickleName = f"jel-{int(time.time())}.pkl"
     if not os.path.exists(LOG_PARSING_POINTERS_DIR):
         os.mkdir(LOG_PARSING_POINTERS_DIR)
     with open((LOG_PARSING_POINTERS_DIR+newJelPickleName), 'wb') as f:
         pickle.dump(jel, f)
-    newJobLogCheckpoint = newJelPickleName
+    store.jobLogCheckpoint = newJelPickleName
 
     for fn in glob.glob("node_state*"):
         level = re.match(r'(\w+)(?:.(\w+))?', fn).group(2)
         with open(fn, 'r', encoding='utf-8') as nodeState:
-            parseNodeStateV2(nodeState, nodes, level)
+            parseNodeStateV2(nodeState, store, level)
 
     try:
-        errorSummary, newFjrParseResCheckpoint = summarizeFjrParseResults(fjrParseResCheckpoint)
+        errorSummary, newFjrParseResCheckpoint = summarizeFjrParseResults(store.fjrParseResCheckpoint)
         if errorSummary and newFjrParseResCheckpoint:
-            parseErrorReport(errorSummary, nodes)
+            parseErrorReport(errorSummary, store)
+        store.fjrParseResCheckpoint = newFjrParseResCheckpoint
     except IOError:
         logging.exception("error during error_summary file handling")
 
-    # collect all cache info in a single dictionary and return it to caller
-    newCacheDoc = {}
-    newCacheDoc['jobLogCheckpoint'] = newJobLogCheckpoint
-    newCacheDoc['fjrParseResCheckpoint'] = newFjrParseResCheckpoint
-    newCacheDoc['nodes'] = nodes
-    newCacheDoc['nodeMap'] = nodeMap
-    logging.info(f"Full dagStatus is {nodes['DagStatus']}")
-    collapsedDagStatus = collapseDAGStatus(nodes['DagStatus'])
+    logging.info(f"Full dagStatus is {store.dagStatus}")
+    collapsedDagStatus = collapseDAGStatus(store.dagStatus)
     logging.info(f"Collapsed DAG status for reportig is {collapsedDagStatus}")
-    newCacheDoc['overallDagStatus'] = collapsedDagStatus
-    return newCacheDoc
+    return collapsedDagStatus
+
+
+def storeNodeStore(store):
+    """
+    save the NodeStore for next run, replacing the previous one atomically
+    """
+    tempFilename = (NODE_STORE_FILE + ".%s") % os.getpid()
+    with open(tempFilename, "wb") as fp:
+        store.dump(fp)
+    move(tempFilename, NODE_STORE_FILE)
+
+
+def storeStatusCacheFiles(store, overallDagStatus):
+    """
+    write the status_cache files in pkl, txt and JSON format used by other tools,
+    but only if something changed since they were last written
+    """
+    digest = store.digest()
+    viewFiles = [PKL_STATUS_CACHE_FILE, STATUS_CACHE_FILE, JSON_STATUS_CACHE_FILE]
+    if digest == store.viewsDigest and all(os.path.exists(f) for f in viewFiles):
+        logging.info("No change in nodes information, status_cache files are up to date")
+        return
+    cacheDoc = {}
+    cacheDoc['jobLogCheckpoint'] = store.jobLogCheckpoint
+    cacheDoc['fjrParseResCheckpoint'] = store.fjrParseResCheckpoint
+    cacheDoc['nodes'] = store.toNodesDict()
+    cacheDoc['nodeMap'] = store.toNodeMapDict()
+    cacheDoc['overallDagStatus'] = overallDagStatus
+    storeNodesInfoInPklFile(cacheDoc)
+    # to keep the txt file locally, useful for debugging, when we remove the old code:
+    storeNodesInfoInTxtFile(cacheDoc)
+    storeNodesInfoInJSONFile(cacheDoc)
+    store.viewsDigest = digest
 
 
 def storeNodesInfoInPklFile(cacheDoc):
@@ -454,14 +485,14 @@ def storeNodesInfoInJSONFile(cacheDoc):
     # First write a new cache file with a temporary name. Then replace old one with new.
     tempFilename = (JSON_STATUS_CACHE_FILE + ".%s") % os.getpid()
     # nodeMap keys are tuple, JSON does not like them. Anyhot this dict. appears unused by other code
-    newDict = copy.deepcopy(cacheDoc)
-    del newDict['nodeMap']
+    # remove checkpoints to enable comparison with *new*
+    newDict = {k: v for k, v in cacheDoc.items() if k not in ('nodeMap', 'jobLogCheckpoint')}
     # Avoid time information to enable comparison with *new*
-    for node, nodeInfo in newDict['nodes'].items():
+    newDict['nodes'] = {}
+    for node, nodeInfo in cacheDoc['nodes'].items():
         if node != 'DagStatus':
-            del nodeInfo['WallDurations']
-    # remove checkpoints to enable comparison with *new*
-    del newDict['jobLogCheckpoint']
+            nodeInfo = {k: v for k, v in nodeInfo.items() if k != 'WallDurations'}
+        newDict['nodes'][node] = nodeInfo
     with open(tempFilename, "w", encoding='utf-8') as fp:
         json.dump(newDict, fp)
     move(tempFilename, JSON_STATUS_CACHE_FILE)
@@ -648,18 +679,16 @@ def main():
     try:
         logging.info(f"Start at {time.strftime('%d/%m/%y %X',time.localtime())}")
 
-        oldInfo = readOldStatusCacheFile()
-        updatedInfo = parseCondorLog(oldInfo)
-        storeNodesInfoInPklFile(updatedInfo)
-        # to keep the txt file locally, useful for debugging, when we remove the old code:
-        storeNodesInfoInTxtFile(updatedInfo)
-        storeNodesInfoInJSONFile(updatedInfo)
+        store = readNodeStore()
+        overallDagStatus = parseCondorLog(store)
+        storeStatusCacheFiles(store, overallDagStatus)
+        storeNodeStore(store)
 
         # make sure that we only do this when status has changed, not every 5 minutes
         # even if...all in all.. one call per task every 5min is a drop in the ocean
         # isTimeToReport
-        #reportDagStatusToDB(updatedInfo['nodes']['DagStatus'])
-        reportDagStatusToDB(updatedInfo['overallDagStatus'])
+        #reportDagStatusToDB(store.dagStatus)
+        reportDagStatusToDB(overallDagStatus)
 
     except Exception:  # pylint: disable=broad-except
         logging.exception("error during main loop")
@@ -33,6 +33,21 @@ function manage_transfers {
     fi
 }
 
+function start_status_broker {
+    # One long lived process per task refreshes aso_status.json for all PostJobs,
+    # see TaskWorker/Actions/TransferStatusBroker.py. It exits by itself when
+    # task_process/task_process_running is removed.
+    if [[ ! -f task_process/RestInfoForFileTransfers.json ]]; then
+        return
+    fi
+    if [[ -f task_process/transfer_status_broker.pid ]] && kill -0 $(cat task_process/transfer_status_broker.pid) 2>/dev/null; then
+        return
+    fi
+    log "Starting transfer_status_broker.py"
+    python3 task_process/transfer_status_broker.py $REQUEST_NAME >> task_process/transfer_status_broker.out 2>&1 &
+    echo $! > task_process/transfer_status_broker.pid
+}
+
 function exit_now {
     # Checks if the TP can exit without losing any possible future updates to the status of the task
     # Returns a string "True" or "False"
@@ -133,6 +148,7 @@ do
     # Run the parsing script
     cache_status
     manage_transfers
+    start_status_broker
     sleep 300s
 
     # Calculate how much time has passed since the last condor_q and perform it again if it has been long enough.
@@ -0,0 +1,10 @@
+#! /usr/bin/python3
+
+"""
+Entrypoint of the per-task transfer status broker
+"""
+
+from TaskWorker.Actions.TransferStatusBroker import main
+
+if __name__ == "__main__":
+    main()
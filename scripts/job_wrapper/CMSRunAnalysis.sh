@@ -51,6 +51,24 @@ if [[ "X$CRAB3_RUNTIME_DEBUG" == "X" ]]; then
         # Allow user to override the choice
         curl $CRAB_RUNTIME_TARBALL | tar xm || exit 10042
     fi
+    # jobs created by automatic splitting stages get their arguments, lumis and input files
+    # from the bundle of their stage, which replaces those from CMSRunAnalysis.tar.gz.
+    # Grid jobs only receive their own bundle, while local reruns (crab preparelocal) get
+    # all of them plus the index, and must expand only the bundle of the job being run
+    jobId=$CRAB_Id
+    for arg in "$@"; do
+        case $arg in
+            --jobId=*) jobId=${arg#--jobId=} ;;
+        esac
+    done
+    if [ -e job_wrapper_inputs.json ]; then
+        bundles=$($pythonCommand -c 'import json, sys; print(json.load(open("job_wrapper_inputs.json")).get(sys.argv[1], ""))' "$jobId") || exit 10042
+    else
+        bundles=$(ls JobWrapperInputs.*.tar.gz 2>/dev/null)
+    fi
+    for bundle in $bundles; do
+        tar xmf "$bundle" || exit 10042
+    done
 else
     echo "I am in runtime debug mode. I will not extract the sandbox"
 fi
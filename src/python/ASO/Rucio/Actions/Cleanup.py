@@ -2,9 +2,10 @@
 Clean it up.
 """
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import ASO.Rucio.config as config # pylint: disable=consider-using-from-import
-from ASO.Rucio.utils import callGfalRm
+from ASO.Rucio.utils import callGfalRm, chunks, gfalBulkRm, hasGfal2, storageEndpoint
 
 
 class Cleanup:
@@ -32,13 +33,19 @@ class Cleanup:
             if not name in self.transfer.cleanedFiles:
                 toBeDeleted.append(name)
         self.deleteFileInTempArea(toBeDeleted)
-        self.transfer.cleanedFiles += toBeDeleted
-        self.transfer.updateCleanedFiles()
 
     def deleteFileInTempArea(self, fileList):
         """
-        This method call `callGfalRm`, fire-and-forget function to delete
-        file from temp area from provided PFN.`
+        Delete files from temp area and bookkeep them in
+        `self.transfer.cleanedFiles`.
+
+        With gfal2 python bindings, PFNs are grouped by storage endpoint and
+        deleted with bulk unlinks, at most `config.args.cleanup_workers` at
+        the same time. Files are bookkept as soon as their chunk is done, so an
+        interrupted cleanup resumes from the files not deleted yet. Files
+        which fail are retried in the next run.
+        Without gfal2, call `callGfalRm`, fire-and-forget function, and
+        bookkeep all files.
 
         `fileList` is the list of the "key" of fileDocs to lookup original
         transfer dict to get `source_lfn`.
@@ -52,12 +59,44 @@ class Cleanup:
         if len(fileList) == 0:
             self.logger.info('No file to clean up.')
             return
-        pfns = []
+        pfn2Key = {}
         for key in fileList:
             transferItem = self.transfer.LFN2transferItemMap[key]
             rse = f'{transferItem["source"]}_Temp'
             lfn = transferItem['source_lfn']
             pfn = self.transfer.LFN2PFNMap[rse][lfn]
-            pfns.append(pfn)
+            pfn2Key[pfn] = key
             self.logger.debug(f'PFN to delete: {pfn}.')
-        callGfalRm(pfns, self.transfer.restProxyFile, config.args.gfal_log_path)
+        if not hasGfal2():
+            callGfalRm(list(pfn2Key), self.transfer.restProxyFile, config.args.gfal_log_path)
+            self.transfer.updateCleanedFiles(fileList)
+            return
+
+        pfnsByEndpoint = {}
+        for pfn in pfn2Key:
+            pfnsByEndpoint.setdefault(storageEndpoint(pfn), []).append(pfn)
+        tasks = []
+        for endpoint, pfns in pfnsByEndpoint.items():
+            for chunk in chunks(pfns, config.args.cleanup_chunk_size):
+                tasks.append((endpoint, chunk))
+        numFailed = 0
+        workers = max(1, min(config.args.cleanup_workers, len(tasks)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(gfalBulkRm, chunk, self.transfer.restProxyFile): (endpoint, chunk)
+                       for endpoint, chunk in tasks}
+            # bookkeeping stays in this thread, the state store connection
+            # can not be shared with the workers.
+            for future in as_completed(futures):
+                endpoint, chunk = futures[future]
+                try:
+                    deleted, failed = future.result()
+                except Exception as ex: # pylint: disable=broad-except
+                    self.logger.warning(f'Bulk deletion of {len(chunk)} files at {endpoint} failed: {ex}')
+                    numFailed += len(chunk)
+                    continue
+                for pfn, reason in failed.items():
+                    self.logger.warning(f'Failed to delete {pfn}: {reason}')
+                numFailed += len(failed)
+                self.transfer.updateCleanedFiles([pfn2Key[pfn] for pfn in deleted])
+        if numFailed:
+            self.logger.info(f'{numFailed} files will be deleted in the next run.')
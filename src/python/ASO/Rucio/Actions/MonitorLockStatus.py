@@ -6,6 +6,7 @@ import logging
 import copy
 import datetime
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import ASO.Rucio.config as config # pylint: disable=consider-using-from-import
 from ASO.Rucio.utils import updateToREST, parseFileNameFromLFN
@@ -24,6 +25,8 @@ class MonitorLockStatus:
         self.rucioClient = rucioClient
         self.transfer = transfer
         self.crabRESTClient = crabRESTClient
+        # datasets found with all locks OK by `checkLockStatus`
+        self.newLockOKDatasets = []
 
     def execute(self):
         """
@@ -38,6 +41,8 @@ class MonitorLockStatus:
         self.updateRESTFileDocsStateToDone(newDoneFileDocs)
         # bookkeeping, also to be used in `Cleanup` action.
         self.transfer.updateOKLocks([x['name'] for x in newDoneFileDocs])
+        # only after their files are bookkept as OK, so that they are never skipped
+        self.transfer.updateLockOKDatasets(self.newLockOKDatasets)
 
         # NOTE: See https://github.com/dmwm/CRABServer/issues/7940
         ## Filter only files need to publish
@@ -63,37 +68,97 @@ class MonitorLockStatus:
 
     def checkLockStatus(self):
         """
-        Check all lock status of replicas in the rule from
+        Check lock status of replicas in the rule from
         `Transfer.containerRuleID`.
 
+        Locks are only fetched for the datasets of the transfer container
+        which are not in `Transfer.lockOKDatasets` yet, i.e. which may still
+        have replicas not `OK`. Replicas in `Transfer.bookkeepingOKLocks` are
+        returned as `OK` without asking Rucio again. Datasets which are closed
+        and have all locks `OK` are put in `self.newLockOKDatasets`, so that
+        their locks are not fetched in next runs.
+
         :return: list of `okFileDocs` where locks is `OK` and `notOKFileDocs`
             where locks is `REPLICATING` or `STUCK`. Return as fileDoc format
         :rtype: tuple of list of dict
         """
         okFileDocs = []
         notOKFileDocs = []
+        self.newLockOKDatasets = []
+        seenLFNs = set()
+        datasets = self.rucioClient.list_content(self.transfer.rucioScope, self.transfer.transferContainer)
+        for dataset in [ds['name'] for ds in datasets]:
+            if dataset in self.transfer.lockOKDatasets:
+                continue
+            locks = self.listDatasetLocks(dataset)
+            allOK = True
+            for lock in locks:
+                seenLFNs.add(lock['name'])
+                fileDoc = self.lockFileDoc(lock['name'])
+                if lock['state'] == 'OK':
+                    okFileDocs.append(fileDoc)
+                else:
+                    allOK = False
+                    notOKFileDocs.append(fileDoc)
+            if locks and allOK and self.isDatasetLocked(dataset, len(locks)):
+                self.newLockOKDatasets.append(dataset)
+        # replicas found OK in previous runs
+        for lfn in self.transfer.bookkeepingOKLocks:
+            if lfn not in seenLFNs:
+                okFileDocs.append(self.lockFileDoc(lfn))
+        return (okFileDocs, notOKFileDocs)
+
+    def listDatasetLocks(self, dataset):
+        """
+        Get the replica locks of the container rule for the files in one
+        dataset of the transfer container.
+
+        :param dataset: dataset name
+        :type dataset: str
+
+        :return: list of lock dicts, with at least `name` and `state`
+        :rtype: list of dict
+        """
         try:
-            listReplicasLocks = self.rucioClient.list_replica_locks(self.transfer.containerRuleID)
+            locks = self.rucioClient.get_locks_for_dids([{'scope': self.transfer.rucioScope, 'name': dataset}])
         except TypeError:
             # Current rucio-clients==1.29.10 will raise exception when it get
             # None from server. It happen when we run list_replica_locks
             # immediately after register replicas in transfer container which
             # replicas lock info is not available yet.
-            self.logger.info('Error was raised. Assume there is still no lock info available yet.')
-            listReplicasLocks = []
-        for lock in listReplicasLocks:
-            fileDoc = {
-                'id': self.transfer.LFN2transferItemMap[lock['name']]['id'],
-                'name': lock['name'],
-                'dataset': None,
-                'blockcomplete': 'NO',
-                'ruleid': self.transfer.containerRuleID,
-            }
-            if lock['state'] == 'OK':
-                okFileDocs.append(fileDoc)
-            else:
-                notOKFileDocs.append(fileDoc)
-        return (okFileDocs, notOKFileDocs)
+            self.logger.info(f'Error was raised. Assume there is still no lock info available yet for {dataset}.')
+            return []
+        # files are also locked by the rules of the publish containers
+        return [lock for lock in locks if lock['rule_id'] == self.transfer.containerRuleID]
+
+    def isDatasetLocked(self, dataset, numOKLocks):
+        """
+        A dataset will not get new replicas (and locks) anymore once it is
+        closed.
+
+        :param dataset: dataset name
+        :type dataset: str
+        :param numOKLocks: number of `OK` locks found in the dataset
+        :type numOKLocks: int
+
+        :return: True if the dataset is closed and all its files have an `OK` lock
+        :rtype: bool
+        """
+        metadata = self.rucioClient.get_metadata(self.transfer.rucioScope, dataset)
+        return not metadata['is_open'] and metadata['length'] == numOKLocks
+
+    def lockFileDoc(self, lfn):
+        """
+        :return: fileDoc of a replica in the container rule
+        :rtype: dict
+        """
+        return {
+            'id': self.transfer.LFN2transferItemMap[lfn]['id'],
+            'name': lfn,
+            'dataset': None,
+            'blockcomplete': 'NO',
+            'ruleid': self.transfer.containerRuleID,
+        }
 
     def registerToPublishContainer(self, fileDocs):
         """
@@ -170,6 +235,10 @@ class MonitorLockStatus:
         Checking (DBS) block completion status from `is_open` dataset metadata.
         Only return list of fileDocs where `is_open` of the dataset is `False`.
 
+        Metadata of all datasets is fetched concurrently (see
+        `getDatasetsMetadata()`) and the task status is read once, then all
+        datasets are evaluated in one pass.
+
         :param fileDocs: replicas's fileDocs
             method.
         :type fileDocs: list of dict
@@ -185,16 +254,21 @@ class MonitorLockStatus:
                 datasetsMap[datasetName] = [i]
             else:
                 datasetsMap[datasetName].append(i)
+        if not datasetsMap:
+            return tmpFileDocs
+        # also close if task has completed (DAG is in final status)
+        with open('task_process/status_cache.json', 'r', encoding='utf-8') as fd:
+            statusCache = json.load(fd)
+        taskCompleted = statusCache['overallDagStatus'] in ['COMPLETED', 'FAILED']
+        metadataMap = self.getDatasetsMetadata(list(datasetsMap))
+        now = datetime.datetime.now()
         for dataset, v in datasetsMap.items():
-            metadata = self.rucioClient.get_metadata(self.transfer.rucioScope, dataset)
+            metadata = metadataMap[dataset]
             # close if no new replica/is_open for too long
             shouldClose = (metadata['updated_at'] + \
                            datetime.timedelta(seconds=config.args.open_dataset_timeout)) \
-                           < datetime.datetime.now()
-            # also close if task has completed (DAG is in final status)
-            with open('task_process/status_cache.json', 'r', encoding='utf-8') as fd:
-                statusCache = json.load(fd)
-            shouldClose |= (statusCache['overallDagStatus'] in ['COMPLETED', 'FAILED'])
+                           < now
+            shouldClose |= taskCompleted
             if not metadata['is_open']:
                 for f in v:
                     newF = copy.deepcopy(f)
@@ -211,6 +285,22 @@ class MonitorLockStatus:
                 self.logger.info(f'Dataset {dataset} is still open.')
         return tmpFileDocs
 
+    def getDatasetsMetadata(self, datasets):
+        """
+        Get metadata of many datasets with concurrent `get_metadata` calls, at
+        most `config.args.dataset_metadata_workers` at a time.
+
+        :param datasets: dataset names
+        :type datasets: list of str
+
+        :return: map of dataset name to its metadata
+        :rtype: dict
+        """
+        workers = max(1, min(config.args.dataset_metadata_workers, len(datasets)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            metadata = executor.map(lambda ds: self.rucioClient.get_metadata(self.transfer.rucioScope, ds), datasets)
+            return dict(zip(datasets, metadata))
+
     def filterFilesNeedToPublish(self, fileDocs):
         """
         Return only fileDoc that need to publish by publisher.
@@ -251,7 +341,7 @@ class MonitorLockStatus:
             'list_of_retry_value': None, # omit
             'list_of_fts_id': [x['ruleid'] for x in fileDocs],
         }
-        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc)
+        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc, self.transfer.store)
 
     def updateRESTFileDocsBlockCompletionInfo(self, fileDocs):
         """
@@ -275,7 +365,7 @@ class MonitorLockStatus:
             'list_of_retry_value': None, # omit
             'list_of_fts_id': None,
         }
-        updateToREST(self.crabRESTClient, 'filetransfers', 'updateRucioInfo', restFileDoc)
+        updateToREST(self.crabRESTClient, 'filetransfers', 'updateRucioInfo', restFileDoc, self.transfer.store)
         # update also publish flag in filetransfer table, use a separate API call
         # because we have to restrict this to files which are fit for DBS
         filesToPublish = [x for x in fileDocs if not x['dataset'].startswith('/FakeDataset/')]
@@ -285,4 +375,4 @@ class MonitorLockStatus:
             'publish_flag': 1,
             'list_of_publication_state': ['NEW'] * num,
         }
-        updateToREST(self.crabRESTClient, 'filetransfers', 'updatePublication', restFileDoc)
+        updateToREST(self.crabRESTClient, 'filetransfers', 'updatePublication', restFileDoc, self.transfer.store)
@@ -3,15 +3,16 @@ Registering files to Rucio.
 """
 
 import logging
-import itertools
 import copy
+from concurrent.futures import ThreadPoolExecutor
 from rucio.rse.rsemanager import find_matching_scheme
 from rucio.common.exception import RucioException
 
 import ASO.Rucio.config as config # pylint: disable=consider-using-from-import
 from ASO.Rucio.Actions.BuildDBSDataset import BuildDBSDataset
 from ASO.Rucio.exception import RucioTransferException
-from ASO.Rucio.utils import chunks, updateToREST, tfcLFN2PFN, LFNToPFNFromPFN
+from ASO.Rucio.LFN2PFNCache import LFN2PFNCache
+from ASO.Rucio.utils import chunks, updateToREST, tfcLFN2PFN
 
 
 class RegisterReplicas:
@@ -30,14 +31,15 @@ class RegisterReplicas:
         """
         Main execution steps to register replicas to datasets.
         """
-        # Generate generator for range of transferItems we want to register.
+        # Get range of transferItems we want to register.
         # This make it easier for do testing.
         start = self.transfer.lastTransferLine
         if config.args.force_total_files:
             end = start + config.args.force_total_files
         else:
             end = len(self.transfer.transferItems)
-        transferGenerator = itertools.islice(self.transfer.transferItems, start, end)
+        # slicing only reads these items from the state store
+        transferGenerator = self.transfer.transferItems[start:end]
 
         # Prepare
         transferItemsWithoutLogfile = self.skipLogTransfers(transferGenerator)
@@ -92,7 +94,7 @@ class RegisterReplicas:
             'list_of_retry_value': None, # omit
             'list_of_fts_id': ['NA']*num,
         }
-        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc)
+        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc, self.transfer.store)
         return newTransfers
 
     def prepare(self, transfers):
@@ -104,7 +106,8 @@ class RegisterReplicas:
 
         We still need to resolve PFN manually because Temp RSE is
         non-deterministic. We rely on `rucioClient.lfn2pfns()` to determine the
-        PFN of Temp RSE from normal RSE (The RSE without `Temp` suffix).
+        PFN of Temp RSE from normal RSE (The RSE without `Temp` suffix),
+        through `LFN2PFNCache` which only asks Rucio for a few files.
 
         :param transfers: the iterable object which produce item of transfer.
         :type transfers: iterator
@@ -122,16 +125,15 @@ class RegisterReplicas:
                 bucket[rse] = []
             bucket[rse].append(xdict)
         for rse, xdictList in bucket.items():
-            xdict = xdictList[0]
             # We determine PFN of Temp RSE from normal RSE.
-            # Simply remove temp suffix before passing to getSourcePFN function.
-            pfn = self.getSourcePFN(xdict["source_lfn"], rse.split('_Temp')[0], xdict["destination"])
+            # Simply remove temp suffix before passing to getSourcePFNs function.
+            pfns = self.getSourcePFNs([x["source_lfn"] for x in xdictList], rse.split('_Temp')[0], xdictList[0]["destination"])
             replicasByRSE[rse] = {}
             for xdict in xdictList:
                 replica = {
                     xdict['id'] : {
                         'scope': self.transfer.rucioScope,
-                        'pfn': LFNToPFNFromPFN(xdict["source_lfn"], pfn),
+                        'pfn': pfns[xdict["source_lfn"]],
                         'name': xdict['destination_lfn'],
                         'bytes': xdict['filesize'],
                         'adler32': xdict['checksums']['adler32'].rjust(8, '0'),
@@ -145,6 +147,11 @@ class RegisterReplicas:
         Register files in Temp RSE in chunks per RSE (chunk size is defined in
         `config.args.replicas_chunk_size`).
 
+        Chunks are independent of each other, so they are registered
+        concurrently by at most `config.args.register_replicas_workers`
+        threads. Results are collected in the same order as the chunks, so the
+        output does not depend on which request finishes first.
+
         :param prepareReplicas: dict return from `prepare()` method.
         :type prepareReplicas: dict
 
@@ -155,47 +162,75 @@ class RegisterReplicas:
         retSuccess = []
         retFail = []
         self.logger.debug(f'Prepare replicas: {prepareReplicas}')
+        tasks = []
         for rse, replicas in prepareReplicas.items():
             self.logger.debug(f'Registering replicas from {rse}')
             self.logger.debug(f'Replicas: {replicas}')
             for chunk in chunks(replicas, config.args.replicas_chunk_size):
-                # Wa: I should make code more clear instead write comment like this.
-                # chunk is slice of list of dict.items() return by chunks's utils function, only when we passing dict in first args.
-                rs = [v for _, v in chunk]
-                try:
-                    # add_replicas with same dids will always return True, even
-                    # with changing metadata (e.g pfn), rucio will not update to
-                    # the new value.
-                    # See https://github.com/dmwm/CMSRucio/issues/343#issuecomment-1543663323
-                    self.rucioClient.add_replicas(rse, rs)
-                    for idx, r in chunk:
-                        fileDoc = {
-                            'id': idx,
-                            'name': r['name'],
-                            'dataset': None,
-                            'blockcomplete': None,
-                            'ruleid': None,
-                        }
-                        retSuccess.append(fileDoc)
-                except RucioException as ex:
-                    # Usually when exception occur it affect the whole chunk,
-                    # no need to retry individually.
-                    #
-                    # Note that at this point, it still possible for job to
-                    # retry because file is not register in replica yet.
-                    self.logger.exception(ex)
-                    self.logger.warning('Exception is raised at add_replicas(rse, rs)')
-                    self.logger.debug(f'rse={rse}, rs={rs}')
-                    for idx, r in chunk:
-                        fileDoc = {
-                            'id': idx,
-                            'name': r['name'],
-                            'dataset': None,
-                            'blockcomplete': None,
-                            'ruleid': None,
-                            'failReason': f'RUCIO_Transfers.py raised an exception: {ex.__class__.__name__}'
-                        }
-                        retFail.append(fileDoc)
+                tasks.append((rse, chunk))
+        if not tasks:
+            return retSuccess, retFail
+        workers = max(1, min(config.args.register_replicas_workers, len(tasks)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.addChunkToRucio, rse, chunk) for rse, chunk in tasks]
+            for future in futures:
+                success, fail = future.result()
+                retSuccess += success
+                retFail += fail
+        return retSuccess, retFail
+
+    def addChunkToRucio(self, rse, chunk):
+        """
+        Register one chunk of replicas in Temp RSE. Executed in the thread pool
+        of `addFilesToRucio()`.
+
+        :param rse: Temp RSE name
+        :type rse: str
+        :param chunk: list of (REST xfer id, replica dict) tuples
+        :type chunk: list
+
+        :returns: tuple of lists of fileDoc which succeeded and failed
+        :rtype: tuple
+        """
+        retSuccess = []
+        retFail = []
+        # Wa: I should make code more clear instead write comment like this.
+        # chunk is slice of list of dict.items() return by chunks's utils function, only when we passing dict in first args.
+        rs = [v for _, v in chunk]
+        try:
+            # add_replicas with same dids will always return True, even
+            # with changing metadata (e.g pfn), rucio will not update to
+            # the new value.
+            # See https://github.com/dmwm/CMSRucio/issues/343#issuecomment-1543663323
+            self.rucioClient.add_replicas(rse, rs)
+            for idx, r in chunk:
+                fileDoc = {
+                    'id': idx,
+                    'name': r['name'],
+                    'dataset': None,
+                    'blockcomplete': None,
+                    'ruleid': None,
+                }
+                retSuccess.append(fileDoc)
+        except RucioException as ex:
+            # Usually when exception occur it affect the whole chunk,
+            # no need to retry individually.
+            #
+            # Note that at this point, it still possible for job to
+            # retry because file is not register in replica yet.
+            self.logger.exception(ex)
+            self.logger.warning('Exception is raised at add_replicas(rse, rs)')
+            self.logger.debug(f'rse={rse}, rs={rs}')
+            for idx, r in chunk:
+                fileDoc = {
+                    'id': idx,
+                    'name': r['name'],
+                    'dataset': None,
+                    'blockcomplete': None,
+                    'ruleid': None,
+                    'failReason': f'RUCIO_Transfers.py raised an exception: {ex.__class__.__name__}'
+                }
+                retFail.append(fileDoc)
         return retSuccess, retFail
 
     def addReplicasToContainer(self, fileDocs, container):
@@ -304,6 +339,40 @@ class RegisterReplicas:
         except Exception as ex:
             raise RucioTransferException("Failed to get source PFN") from ex
 
+    def getSourcePFNs(self, sourceLFNs, sourceRSE, destinationRSE):
+        """
+        Same as `getSourcePFN()` for many LFNs at the same RSE. PFNs are
+        translated by `LFN2PFNCache` with the rules in
+        `self.transfer.LFN2PFNRules`, new rules are bookkept.
+
+        :param sourceLFNs: source LFNs
+        :type sourceLFNs: list of string
+        :param sourceRSE: source RSE, without `_Temp` suffix
+        :type sourceRSE: string
+        :param destinationRSE: need for select proper protocol for transfer
+            with `find_matching_scheme()`.
+        :type destinationRSE: string
+
+        :returns: map of LFN to PFN
+        :rtype: dict
+        """
+        self.logger.debug(f'Getting pfn for {len(sourceLFNs)} files at {sourceRSE}')
+        cache = LFN2PFNCache(self.rucioClient, self.transfer.rucioScope, self.transfer.LFN2PFNRules)
+        try:
+            _, srcScheme, _, _ = find_matching_scheme(
+                {"protocols": self.rucioClient.get_protocols(destinationRSE)},
+                {"protocols": self.rucioClient.get_protocols(sourceRSE)},
+                "third_party_copy_read",
+                "third_party_copy_write",
+            )
+            pfns = cache.translate(sourceRSE, sourceLFNs, "third_party_copy_read", srcScheme)
+        except Exception as ex:
+            raise RucioTransferException("Failed to get source PFN") from ex
+        self.logger.debug(f'Asked Rucio PFN of {cache.numRemote} out of {len(sourceLFNs)} files')
+        if cache.changed:
+            self.transfer.updateLFN2PFNRules(cache.rules)
+        return pfns
+
     def getSourcePFN2(self, sourceLFN, sourceRSE):
         """
         Just for crosschecking with FTS algo we use in `getSourcePFN()`
@@ -347,7 +416,7 @@ class RegisterReplicas:
             'list_of_retry_value': None, # omit
             'list_of_fts_id': [x['ruleid'] for x in fileDocs]
         }
-        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc)
+        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc, self.transfer.store)
 
     def updateRESTFileDocStateToFailed(self, fileDocs):
         """
@@ -372,17 +441,18 @@ class RegisterReplicas:
             'list_of_retry_value': [0]*num,
             #'list_of_fts_id': None,
         }
-        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc)
+        updateToREST(self.crabRESTClient, 'filetransfers', 'updateTransfers', restFileDoc, self.transfer.store)
 
     def bookkeepingPFN(self, prepareReplicas):
         """
-        Store lfn to pfn map to `self.transfer.LFN2PFNMap` and bookkeeping it to
-        disk. `prepareReplicas` is the same dict that passing to
+        Store lfn to pfn map to `self.transfer.LFN2PFNMap` and bookkeeping the
+        new entries. `prepareReplicas` is the same dict that passing to
         `addFilesToRucio()`.
 
         :param prepareReplicas: dict return from `prepare()` method.
         :type prepareReplicas: dict
         """
+        newLFN2PFNMap = {}
         for rse, replicas in prepareReplicas.items():
             tmpdict = {}
             for r in replicas.values():
@@ -392,4 +462,5 @@ class RegisterReplicas:
                 self.transfer.LFN2PFNMap[rse].update(tmpdict)
             else:
                 self.transfer.LFN2PFNMap[rse] = tmpdict
-        self.transfer.updateLFN2PFNMap()
+            newLFN2PFNMap[rse] = tmpdict
+        self.transfer.updateLFN2PFNMap(newLFN2PFNMap)
@@ -0,0 +1,166 @@
+"""
+LFN to PFN translation which learns the rule of each RSE.
+
+For most RSEs, PFN is a fixed prefix followed by the LFN (or by the end of
+it), so asking Rucio `lfns2pfns` for every file is not needed. A rule is
+learned from the answer of Rucio for one file and used for the next files
+once it predicted the answer for another file. From time to time a locally
+translated PFN is compared with the one from Rucio and the rule is thrown
+away if they differ. Files which the rule does not apply to are always
+asked to Rucio.
+"""
+import logging
+
+# number of files asked to Rucio to learn and confirm a rule
+NUM_SAMPLES = 2
+# compare with Rucio after this many local translations
+VERIFY_INTERVAL = 1000
+
+
+def learnRule(lfn, pfn):
+    """
+    Build the rule which translates `lfn` to `pfn`: the longest common
+    trailing path of both is kept, the leading part of the LFN is replaced.
+
+    >>> learnRule('/store/temp/user/a/output_1.root', 'davs://eoscms.cern.ch:443/eos/cms/store/temp/user/a/output_1.root')
+    {'lfnPrefix': '', 'pfnPrefix': 'davs://eoscms.cern.ch:443/eos/cms', 'confirmed': False}
+
+    :param lfn: LFN
+    :type lfn: str
+    :param pfn: PFN of the LFN
+    :type pfn: str
+    :return: rule, or None if LFN and PFN do not share the file name
+    :rtype: dict
+    """
+    lfnParts = lfn.split('/')
+    pfnParts = pfn.split('/')
+    n = 0
+    # keep the leading '' of the LFN, so the prefix is always a full directory
+    while n < len(lfnParts) - 1 and n < len(pfnParts) and lfnParts[-1 - n] == pfnParts[-1 - n]:
+        n += 1
+    if n == 0:
+        return None
+    return {
+        'lfnPrefix': '/'.join(lfnParts[:-n]),
+        'pfnPrefix': '/'.join(pfnParts[:-n]),
+        'confirmed': False,
+    }
+
+
+def applyRule(rule, lfn):
+    """
+    :return: PFN of `lfn`, or None if the rule does not apply to it
+    :rtype: str
+    """
+    if not lfn.startswith(rule['lfnPrefix'] + '/'):
+        return None
+    return rule['pfnPrefix'] + lfn[len(rule['lfnPrefix']):]
+
+
+class LFN2PFNCache:
+    """
+    Translate LFNs to PFNs with the rule learned for each (RSE, operation,
+    scheme), asking Rucio only when needed.
+
+    :param rucioClient: Rucio Client object
+    :type rucioClient: rucio.client.client.Client
+    :param scope: Rucio scope of the files
+    :type scope: str
+    :param rules: rules learned in previous runs, see `rules` attribute
+    :type rules: dict
+    """
+    def __init__(self, rucioClient, scope, rules=None, verifyInterval=VERIFY_INTERVAL):
+        self.logger = logging.getLogger("RucioTransfer.LFN2PFNCache")
+        self.rucioClient = rucioClient
+        self.scope = scope
+        # map of '<rse>:<operation>:<scheme>' to rule, JSON serializable
+        self.rules = dict(rules) if rules else {}
+        self.verifyInterval = verifyInterval
+        self.changed = False
+        self.numRemote = 0
+
+    def lookup(self, rse, lfns, operation, scheme):
+        """
+        Ask Rucio the PFNs, with a single `lfns2pfns` call.
+
+        :return: map of LFN to PFN
+        :rtype: dict
+        """
+        if not lfns:
+            return {}
+        self.numRemote += len(lfns)
+        dids = [f'{self.scope}:{lfn}' for lfn in lfns]
+        pfnMap = self.rucioClient.lfns2pfns(rse, dids, operation=operation, scheme=scheme)
+        return {lfn: pfnMap[did] for lfn, did in zip(lfns, dids)}
+
+    def setRule(self, key, rule):
+        """
+        Replace (or remove, if `rule` is None) the rule of `key`.
+        """
+        if rule is None:
+            self.rules.pop(key, None)
+        else:
+            self.rules[key] = rule
+        self.changed = True
+
+    def translate(self, rse, lfns, operation, scheme=None):
+        """
+        Translate LFNs to PFNs.
+
+        :param rse: RSE name
+        :type rse: str
+        :param lfns: list of LFN
+        :type lfns: list
+        :param operation: operation passed to `lfns2pfns`
+        :type operation: str
+        :param scheme: scheme passed to `lfns2pfns`
+        :type scheme: str
+        :return: map of LFN to PFN
+        :rtype: dict
+        """
+        key = f'{rse}:{operation}:{scheme}'
+        rule = self.rules.get(key)
+        pfns = {}
+        if rule and rule['confirmed'] and rule['sinceVerify'] >= self.verifyInterval:
+            sample = next((lfn for lfn in lfns if applyRule(rule, lfn)), None)
+            if sample:
+                pfns.update(self.lookup(rse, [sample], operation, scheme))
+                if applyRule(rule, sample) == pfns[sample]:
+                    rule = dict(rule, sinceVerify=0)
+                else:
+                    self.logger.warning(f'LFN2PFN rule for {key} does not match Rucio anymore: {rule}')
+                    rule = learnRule(sample, pfns[sample])
+                    if rule:
+                        rule['sample'] = sample
+                self.setRule(key, rule)
+        if not rule or not rule['confirmed']:
+            samples = [lfn for lfn in lfns if lfn not in pfns][:NUM_SAMPLES]
+            pfns.update(self.lookup(rse, samples, operation, scheme))
+            for lfn in samples:
+                if rule and applyRule(rule, lfn) == pfns[lfn]:
+                    if lfn != rule.get('sample'):
+                        rule = dict(rule, confirmed=True, sinceVerify=0)
+                        rule.pop('sample', None)
+                        self.logger.info(f'LFN2PFN rule for {key} confirmed: {rule}')
+                        self.setRule(key, rule)
+                        break
+                else:
+                    rule = learnRule(lfn, pfns[lfn])
+                    if rule:
+                        rule['sample'] = lfn
+                    self.setRule(key, rule)
+        remote = []
+        numLocal = 0
+        for lfn in lfns:
+            if lfn in pfns:
+                continue
+            pfn = applyRule(rule, lfn) if rule and rule['confirmed'] else None
+            if pfn is None:
+                remote.append(lfn)
+            else:
+                pfns[lfn] = pfn
+                numLocal += 1
+        if numLocal:
+            self.setRule(key, dict(rule, sinceVerify=rule['sinceVerify'] + numLocal))
+        pfns.update(self.lookup(rse, remote, operation, scheme))
+        return pfns
@@ -21,11 +21,16 @@ def initLogger():
     logger.addHandler(hldr)
 
 
-def main():
+def parseArgs(argv=None):
     """
-    This main function is mean to called by RUCIO_Transfers.py script.
-    Arguments are process here and only for run integration test or
-    run process directly from this file.
+    Parse the command line arguments. Also used by tools which run
+    RunTransfer in-process, to get the same defaults.
+
+    :param argv: arguments to parse, `sys.argv[1:]` if None
+    :type argv: list of str
+
+    :return: parsed arguments
+    :rtype: argparse.Namespace
     """
     opt = ArgumentParser(usage=__doc__)
     opt.add_argument("--force-publishname", dest="force_publishname", default=None, type=str,
@@ -37,6 +42,8 @@ def main():
     # default here must change because theses current value is too low (chunk=2/max=5)
     opt.add_argument("--replicas-chunk-size", dest="replicas_chunk_size", default=5, type=int,
                      help="")
+    opt.add_argument("--register-replicas-workers", dest="register_replicas_workers", default=4, type=int,
+                     help="max number of replicas chunks registered to Rucio concurrently")
     opt.add_argument("--max-file-per-dataset", dest="max_file_per_dataset", default=100, type=int,
                      help="")
     opt.add_argument("--last-line-path", dest="last_line_path",
@@ -63,6 +70,8 @@ def main():
     opt.add_argument("--ignore-bookkeeping-block-complete", dest="ignore_bookkeeping_block_complete",
                      action='store_true',
                      help="")
+    opt.add_argument("--dataset-metadata-workers", dest="dataset_metadata_workers", default=8, type=int,
+                     help="max number of concurrent get_metadata calls when checking block completion")
     opt.add_argument("--open-dataset-timeout", dest="open_dataset_timeout", default=4*60*60, type=int, # 4 hours
                      help="Open dataset timeout in seconds")
     opt.add_argument("--lfn2pfn-map-path", dest="lfn2pfn_map_path",
@@ -77,13 +86,29 @@ def main():
     opt.add_argument("--ignore-cleaned-files", dest="ignore_cleaned_files",
                      action='store_true',
                      help="")
+    opt.add_argument("--state-db-path", dest="state_db_path",
+                     default='task_process/transfers/transfer_state.db',
+                     help="Bookkeeping database, other bookkeeping paths are only read once to import them")
     opt.add_argument("--gfal-log-path", dest="gfal_log_path",
                      default='task_process/transfers/gfal.log',
                      help="gfal log path")
+    opt.add_argument("--cleanup-workers", dest="cleanup_workers", default=4, type=int,
+                     help="max number of concurrent gfal2 bulk deletions in the temp area")
+    opt.add_argument("--cleanup-chunk-size", dest="cleanup_chunk_size", default=200, type=int,
+                     help="max number of files per gfal2 bulk deletion")
     opt.add_argument("--purge-transfers-dir", dest="purge_transfers_dir",
                      action='store_true',
                      help="purge task_process/transfers directory")
-    opts = opt.parse_args()
+    return opt.parse_args(argv)
+
+
+def main():
+    """
+    This main function is mean to called by RUCIO_Transfers.py script.
+    Arguments are process here and only for run integration test or
+    run process directly from this file.
+    """
+    opts = parseArgs()
 
     # Put args to config module to share variable across process.
     # NOTE: For unittest, manually instantiate new one with argparse.Namespace
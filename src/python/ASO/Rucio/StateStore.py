@@ -0,0 +1,269 @@
+"""
+Durable state of the Rucio ASO process for one task.
+
+All the bookkeeping which used to be in separate JSON/text files in
+task_process/transfers (last_transfer.txt, transfer_ok.txt, block_complete.txt,
+lfn2pfn_map.json, cleaned_files.json, container_ruleid.json) is kept in one SQLite
+database, together with the transfer dicts already read from transfers.txt, the
+byte offset where reading should continue and the values last uploaded to REST
+for each file. Every update method only writes the
+rows which changed, in a single transaction.
+"""
+import json
+import sqlite3
+from collections.abc import Mapping, Sequence
+
+from ASO.Rucio.exception import RucioTransferException
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS transfer_items (line INTEGER PRIMARY KEY, lfn TEXT NOT NULL, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS transfer_items_lfn ON transfer_items (lfn, line);
+CREATE TABLE IF NOT EXISTS files (lfn TEXT PRIMARY KEY, transfer_ok INTEGER NOT NULL DEFAULT 0,
+                                  cleaned INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS lfn2pfn (rse TEXT NOT NULL, lfn TEXT NOT NULL, pfn TEXT NOT NULL,
+                                    PRIMARY KEY (rse, lfn));
+CREATE TABLE IF NOT EXISTS block_complete (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS rest_state (subresource TEXT NOT NULL, id TEXT NOT NULL, state TEXT NOT NULL,
+                                       PRIMARY KEY (subresource, id));
+"""
+
+# per-file flags in the `files` table
+FILE_STATES = ('transfer_ok', 'cleaned')
+
+
+class StateStore:
+    """
+    SQLite backed store of the Transfer object state.
+
+    :param path: path of the database file, created if it does not exist.
+    :type path: str
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self.numTransferItems = self.conn.execute('SELECT COUNT(*) FROM transfer_items').fetchone()[0]
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.conn.close()
+
+    def getMeta(self, key, default=None):
+        """
+        :param key: name of the value
+        :type key: str
+        :return: JSON decoded value stored with `setMeta`, or `default`
+        """
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def setMeta(self, key, value):
+        """
+        :param key: name of the value
+        :type key: str
+        :param value: any JSON serializable value
+        """
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def appendTransferItems(self, items, offset):
+        """
+        Store transfer dicts read from transfers.txt together with the byte
+        offset where the next read has to start, in the same transaction.
+        Values uploaded to REST for the same file ids are forgotten, the file
+        has a new transfer (e.g. job retry) and has to be uploaded again.
+
+        :param items: new transfer dicts, in the order of transfers.txt
+        :type items: list of dict
+        :param offset: position in transfers.txt after the last item
+        :type offset: int
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO transfer_items (line, lfn, doc) VALUES (?, ?, ?)',
+                ((self.numTransferItems + i, x['destination_lfn'], json.dumps(x)) for i, x in enumerate(items)))
+            self.conn.executemany('DELETE FROM rest_state WHERE id = ?', ((x['id'],) for x in items))
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                              ('transfersTxtOffset', json.dumps(offset)))
+        self.numTransferItems += len(items)
+
+    def resetTransferItems(self):
+        """
+        Forget all transfer dicts, to read transfers.txt again from the beginning.
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM transfer_items')
+            self.conn.execute('DELETE FROM meta WHERE key = ?', ('transfersTxtOffset',))
+        self.numTransferItems = 0
+
+    def getTransferItems(self, start, end):
+        """
+        :return: transfer dicts from line `start` (included) to `end` (excluded)
+        :rtype: list of dict
+        """
+        rows = self.conn.execute('SELECT doc FROM transfer_items WHERE line >= ? AND line < ? ORDER BY line',
+                                 (start, end))
+        return [json.loads(doc) for (doc,) in rows]
+
+    def iterTransferItems(self):
+        """
+        :return: generator of all transfer dicts, in the order of transfers.txt
+        """
+        for (doc,) in self.conn.execute('SELECT doc FROM transfer_items ORDER BY line'):
+            yield json.loads(doc)
+
+    def getTransferItemByLFN(self, lfn):
+        """
+        :return: latest transfer dict (i.e. of the last job retry) with this
+            `destination_lfn`, or None
+        :rtype: dict
+        """
+        row = self.conn.execute('SELECT doc FROM transfer_items WHERE lfn = ? ORDER BY line DESC LIMIT 1',
+                                (lfn,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iterTransferItemLFNs(self):
+        """
+        :return: generator of distinct `destination_lfn` of all transfer dicts
+        """
+        for (lfn,) in self.conn.execute('SELECT DISTINCT lfn FROM transfer_items'):
+            yield lfn
+
+    def countTransferItemLFNs(self):
+        """
+        :return: number of distinct `destination_lfn`
+        :rtype: int
+        """
+        return self.conn.execute('SELECT COUNT(DISTINCT lfn) FROM transfer_items').fetchone()[0]
+
+    def getFiles(self, state):
+        """
+        :param state: one of FILE_STATES
+        :type state: str
+        :return: LFNs of files flagged with `state`
+        :rtype: set
+        """
+        if state not in FILE_STATES:
+            raise RucioTransferException(f'Unknown file state: {state}')
+        return {lfn for (lfn,) in self.conn.execute(f'SELECT lfn FROM files WHERE {state} = 1')}
+
+    def setFiles(self, state, lfns):
+        """
+        Flag files with `state`.
+
+        :param state: one of FILE_STATES
+        :type state: str
+        :param lfns: LFNs of the files
+        :type lfns: iterable of str
+        """
+        if state not in FILE_STATES:
+            raise RucioTransferException(f'Unknown file state: {state}')
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO files (lfn) VALUES (?)', ((x,) for x in lfns))
+            self.conn.executemany(f'UPDATE files SET {state} = 1 WHERE lfn = ?', ((x,) for x in lfns))
+
+    def getBlockComplete(self):
+        """
+        :return: names of the datasets (blocks) already complete
+        :rtype: set
+        """
+        return {name for (name,) in self.conn.execute('SELECT name FROM block_complete')}
+
+    def addBlockComplete(self, names):
+        """
+        :param names: names of newly completed datasets (blocks)
+        :type names: iterable of str
+        """
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO block_complete (name) VALUES (?)', ((x,) for x in names))
+
+    def getLFN2PFNMap(self):
+        """
+        :return: map of RSE to map of LFN to PFN
+        :rtype: dict
+        """
+        lfn2pfnMap = {}
+        for rse, lfn, pfn in self.conn.execute('SELECT rse, lfn, pfn FROM lfn2pfn'):
+            lfn2pfnMap.setdefault(rse, {})[lfn] = pfn
+        return lfn2pfnMap
+
+    def addLFN2PFNMap(self, lfn2pfnMap):
+        """
+        :param lfn2pfnMap: new entries, map of RSE to map of LFN to PFN
+        :type lfn2pfnMap: dict
+        """
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO lfn2pfn (rse, lfn, pfn) VALUES (?, ?, ?)',
+                                  ((rse, lfn, pfn) for rse, m in lfn2pfnMap.items() for lfn, pfn in m.items()))
+
+    def getRESTStates(self, subresource):
+        """
+        :param subresource: `<api>/<subresource>` of the REST call
+        :type subresource: str
+        :return: map of file id to the values last uploaded
+        :rtype: dict
+        """
+        return dict(self.conn.execute('SELECT id, state FROM rest_state WHERE subresource = ?', (subresource,)))
+
+    def setRESTStates(self, subresource, states):
+        """
+        :param subresource: `<api>/<subresource>` of the REST call
+        :type subresource: str
+        :param states: map of file id to the values just uploaded
+        :type states: dict
+        """
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO rest_state (subresource, id, state) VALUES (?, ?, ?)',
+                                  ((subresource, k, v) for k, v in states.items()))
+
+
+class TransferItems(Sequence):
+    """
+    Read-only list of transfer dicts, backed by the StateStore. Slicing is done
+    with a single query, so only the needed dicts are decoded.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.numTransferItems
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            items = self.store.getTransferItems(start, stop)
+            return items[::step] if step != 1 else items
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('transfer item index out of range')
+        return self.store.getTransferItems(index, index + 1)[0]
+
+    def __iter__(self):
+        return self.store.iterTransferItems()
+
+
+class TransferItemsByLFN(Mapping):
+    """
+    Read-only map of `destination_lfn` to the latest transfer dict with that
+    LFN, backed by the StateStore.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, lfn):
+        item = self.store.getTransferItemByLFN(lfn)
+        if item is None:
+            raise KeyError(lfn)
+        return item
+
+    def __iter__(self):
+        return self.store.iterTransferItemLFNs()
+
+    def __len__(self):
+        return self.store.countTransferItemLFNs()
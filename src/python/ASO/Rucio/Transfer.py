@@ -9,7 +9,8 @@ import shutil
 
 import ASO.Rucio.config as config # pylint: disable=consider-using-from-import
 from ASO.Rucio.exception import RucioTransferException
-from ASO.Rucio.utils import writePath, parseFileNameFromLFN, addSuffixToProcessedDataset
+from ASO.Rucio.utils import parseFileNameFromLFN, addSuffixToProcessedDataset
+from ASO.Rucio.StateStore import StateStore, TransferItems, TransferItemsByLFN
 
 
 class Transfer:
@@ -27,10 +28,14 @@ class Transfer:
         self.restProxyFile = ''
 
         # Content of transfers.txt (list of dict)
-        # Note that we load whole file into memory but continue process from
-        # `lastTransferLine`.
+        # Note that only new lines are read from transfers.txt at each run,
+        # items are kept in the state store and decoded only when accessed.
+        # Process continues from `lastTransferLine`.
         self.transferItems = []
 
+        # durable bookkeeping, see ASO.Rucio.StateStore
+        self.store = None
+
         # from transfer info
         self.rucioUsername = ''
         self.rucioScope = ''
@@ -55,8 +60,10 @@ class Transfer:
         self.publishRuleID = None
         self.multiPubRuleIDs = {}
         self.bookkeepingOKLocks = None
+        self.lockOKDatasets = None
         self.bookkeepingBlockComplete = None
         self.LFN2PFNMap = None
+        self.LFN2PFNRules = None
         self.cleanedFiles = None
 
     def readInfo(self):
@@ -70,6 +77,8 @@ class Transfer:
         # ensure task_process/transfers directory
         if not os.path.exists('task_process/transfers'):
             os.makedirs('task_process/transfers')
+        self.store = StateStore(config.args.state_db_path)
+        self.importLegacyBookkeeping()
         # read into memory
         self.readLastTransferLine()
         self.readTransferItems()
@@ -79,8 +88,10 @@ class Transfer:
         self.buildMultiPubContainerNames()
         self.readContainerRuleID()
         self.readOKLocks()
+        self.readLockOKDatasets()
         self.readBlockComplete()
         self.readLFN2PFNMap()
+        self.readLFN2PFNRules()
         self.readCleanedFiles()
 
     def readInfoFromRucio(self, rucioClient):
@@ -92,48 +103,94 @@ class Transfer:
         """
         # Currently, we do not use this method.
 
+    def importLegacyBookkeeping(self):
+        """
+        Copy the bookkeeping files written before the state store was
+        introduced (e.g. task_process/transfers/transfer_ok.txt) into the
+        store. Done only once per task, files are left untouched.
+        """
+        if self.store.getMeta('legacyImported'):
+            return
+        def readLegacy(path, parse):
+            try:
+                with open(path, 'r', encoding='utf-8') as r:
+                    return parse(r)
+            except FileNotFoundError:
+                return None
+        lastTransferLine = readLegacy(config.args.last_line_path, lambda r: int(r.read()))
+        if lastTransferLine is not None:
+            self.store.setMeta('lastTransferLine', lastTransferLine)
+        ruleIDs = readLegacy(config.args.container_ruleid_path, json.load)
+        if ruleIDs is not None:
+            self.store.setMeta('containerRuleID', ruleIDs)
+        okLocks = readLegacy(config.args.transfer_ok_path, lambda r: r.read().splitlines())
+        if okLocks:
+            self.store.setFiles('transfer_ok', okLocks)
+        blockComplete = readLegacy(config.args.bookkeeping_block_complete_path, lambda r: r.read().splitlines())
+        if blockComplete:
+            self.store.addBlockComplete(blockComplete)
+        LFN2PFNMap = readLegacy(config.args.lfn2pfn_map_path, json.load)
+        if LFN2PFNMap:
+            self.store.addLFN2PFNMap(LFN2PFNMap)
+        cleanedFiles = readLegacy(config.args.cleaned_files_path, json.load)
+        if cleanedFiles:
+            self.store.setFiles('cleaned', cleanedFiles)
+        self.store.setMeta('legacyImported', True)
+
     def readLastTransferLine(self):
         """
-        Reading lastTransferLine from task_process/transfers/last_transfer.txt
+        Reading lastTransferLine from the state store.
         """
         if not config.args.force_last_line is None: # Need explicitly compare to None
             self.lastTransferLine = config.args.force_last_line
             return
-        path = config.args.last_line_path
-        try:
-            with open(path, 'r', encoding='utf-8') as r:
-                self.lastTransferLine = int(r.read())
-        except FileNotFoundError:
-            self.logger.info(f'{path} not found. Assume it is first time it run.')
+        self.lastTransferLine = self.store.getMeta('lastTransferLine')
+        if self.lastTransferLine is None:
+            self.logger.info('lastTransferLine not found. Assume it is first time it run.')
             self.lastTransferLine = 0
 
     def updateLastTransferLine(self, line):
         """
-        Update lastTransferLine to task_process/transfers/last_transfer.txt
+        Update lastTransferLine in the state store.
 
         :param line: line number
         :type line: int
         """
         self.lastTransferLine = line
-        path = config.args.last_line_path
-        with writePath(path) as w:
-            w.write(str(self.lastTransferLine))
+        self.store.setMeta('lastTransferLine', self.lastTransferLine)
 
     def readTransferItems(self):
         """
-        Reading transferItems (whole files) from task_process/transfers.txt
+        Reading new transferItems from task_process/transfers.txt, starting
+        from the byte offset where the previous run stopped, and add them to
+        the ones in the state store.
+        A line which does not end with a newline is still being written by
+        a PostJob, it will be read in the next run.
         """
         path = config.args.transfers_txt_path
+        offset = self.store.getMeta('transfersTxtOffset', 0)
+        newItems = []
         try:
-            with open(path, 'r', encoding='utf-8') as r:
+            with open(path, 'rb') as r:
+                if os.fstat(r.fileno()).st_size < offset:
+                    self.logger.warning(f'{path} is shorter than what was already read. Reading it again from the beginning.')
+                    self.store.resetTransferItems()
+                    offset = 0
+                r.seek(offset)
                 for line in r:
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
                     doc = json.loads(line)
                     # Manipulate transfers dicts when running integration test
                     if config.args.force_publishname:
                         doc = manipulateOutputDataset(doc, config.args.force_publishname)
-                    self.transferItems.append(doc)
+                    newItems.append(doc)
         except FileNotFoundError as ex:
             raise RucioTransferException(f'{path} does not exist. Probably no completed jobs in the task yet.') from ex
+        self.store.appendTransferItems(newItems, offset)
+        self.logger.info(f'Read {len(newItems)} new transfer items from {path}')
+        self.transferItems = TransferItems(self.store)
         if len(self.transferItems) == 0:
             raise RucioTransferException(f'{path} does not contain new entry.')
 
@@ -143,9 +200,7 @@ class Transfer:
         Note that LFN2transferItemMap only point to latest `destination_lfn` in
         case job has been retry.
         """
-        self.LFN2transferItemMap = {}
-        for x in self.transferItems:
-            self.LFN2transferItemMap[x['destination_lfn']] = x
+        self.LFN2transferItemMap = TransferItemsByLFN(self.store)
 
     def readRESTInfo(self):
         """
@@ -223,105 +278,110 @@ class Transfer:
 
     def readContainerRuleID(self):
         """
-        Read containerRuleID from task_process/transfers/container_ruleid.txt
+        Read containerRuleID from the state store.
         """
         # Skip reading rule from bookkeeping in case to intend to create
         # different container name when test.
         if config.args.force_publishname:
             return
-        path = config.args.container_ruleid_path
-        try:
-            with open(path, 'r', encoding='utf-8') as r:
-                tmp = json.load(r)
-                self.containerRuleID = tmp['containerRuleID']
-                self.publishRuleID = tmp['publishRuleID']
-                self.multiPubRuleIDs = tmp['multiPubRuleIDs']
-                self.logger.info('Got container rule ID from bookkeeping:')
-                self.logger.info(f'  Transfer Container rule ID: {self.containerRuleID}')
-                self.logger.info(f'  Publish Container rule ID: {self.publishRuleID}')
-                self.logger.info(f'  Multiple Publish Container rule IDs: {self.multiPubRuleIDs}')
-        except FileNotFoundError:
+        tmp = self.store.getMeta('containerRuleID')
+        if tmp is None:
             self.containerRuleID = ''
-            self.logger.info(f'Bookkeeping rules "{path}" does not exist. Assume it is first time it run.')
+            self.logger.info('Bookkeeping rules does not exist. Assume it is first time it run.')
+            return
+        self.containerRuleID = tmp['containerRuleID']
+        self.publishRuleID = tmp['publishRuleID']
+        self.multiPubRuleIDs = tmp['multiPubRuleIDs']
+        self.logger.info('Got container rule ID from bookkeeping:')
+        self.logger.info(f'  Transfer Container rule ID: {self.containerRuleID}')
+        self.logger.info(f'  Publish Container rule ID: {self.publishRuleID}')
+        self.logger.info(f'  Multiple Publish Container rule IDs: {self.multiPubRuleIDs}')
 
     def updateContainerRuleID(self):
         """
-        update containerRuleID to task_process/transfers/container_ruleid.txt
+        update containerRuleID in the state store.
         """
-        path = config.args.container_ruleid_path
-        self.logger.info(f'Bookkeeping Transfer Container rule ID [{self.containerRuleID}] and Pransfer Container and [{self.publishRuleID}] to file: {path}')
-        with writePath(path) as w:
-            json.dump({
-                'containerRuleID': self.containerRuleID,
-                'publishRuleID': self.publishRuleID,
-                'multiPubRuleIDs': self.multiPubRuleIDs,
-            }, w)
+        self.logger.info(f'Bookkeeping Transfer Container rule ID [{self.containerRuleID}] and Publish Container rule ID [{self.publishRuleID}]')
+        self.store.setMeta('containerRuleID', {
+            'containerRuleID': self.containerRuleID,
+            'publishRuleID': self.publishRuleID,
+            'multiPubRuleIDs': self.multiPubRuleIDs,
+        })
 
     def readOKLocks(self):
         """
-        Read bookkeepingOKLocks from task_process/transfers/transfers_ok.txt.
-        Initialize empty list in case of path not found or
-        `--ignore-transfer-ok` is `True`.
+        Read bookkeepingOKLocks, the set of LFNs whose transfer is done, from
+        the state store.
+        Initialize empty set in case of `--ignore-transfer-ok` is `True`.
         """
         if config.args.ignore_transfer_ok:
-            self.bookkeepingOKLocks = []
+            self.bookkeepingOKLocks = set()
             return
-        path = config.args.transfer_ok_path
-        try:
-            with open(path, 'r', encoding='utf-8') as r:
-                self.bookkeepingOKLocks = r.read().splitlines()
-                self.logger.info(f'Got list of "OK" locks from bookkeeping: {self.bookkeepingOKLocks}')
-        except FileNotFoundError:
-            self.bookkeepingOKLocks = []
-            self.logger.info(f'Bookkeeping path "{path}" does not exist. Assume this is first time it run.')
+        self.bookkeepingOKLocks = self.store.getFiles('transfer_ok')
+        self.logger.info(f'Got {len(self.bookkeepingOKLocks)} "OK" locks from bookkeeping.')
 
     def updateOKLocks(self, newLocks):
         """
-        update bookkeepingOKLocks to task_process/transfers/transfers_ok.txt
+        Add newLocks to bookkeepingOKLocks and to the state store.
 
         :param newLocks: list of LFN
         :type newLocks: list of string
         """
-        self.bookkeepingOKLocks += newLocks
-        path = config.args.transfer_ok_path
-        self.logger.info(f'Bookkeeping transfer status OK: {self.bookkeepingOKLocks}')
-        self.logger.info(f'to file: {path}')
-        with writePath(path) as w:
-            for l in self.bookkeepingOKLocks:
-                w.write(f'{l}\n')
+        self.bookkeepingOKLocks.update(newLocks)
+        self.logger.info(f'Bookkeeping transfer status OK: {newLocks}')
+        self.store.setFiles('transfer_ok', newLocks)
+
+    def readLockOKDatasets(self):
+        """
+        Read lockOKDatasets, the set of datasets in the transfer container
+        which are closed and where all replica locks of the container rule are
+        `OK`, from the state store. Locks of these datasets do not need to be
+        checked anymore.
+        Initialize empty set in case of `--ignore-transfer-ok` is `True`,
+        because files in these datasets are not in bookkeepingOKLocks either.
+        """
+        if config.args.ignore_transfer_ok:
+            self.lockOKDatasets = set()
+            return
+        self.lockOKDatasets = set(self.store.getMeta('lockOKDatasets', []))
+        self.logger.info(f'Got {len(self.lockOKDatasets)} datasets with all locks "OK" from bookkeeping.')
+
+    def updateLockOKDatasets(self, newDatasets):
+        """
+        Add newDatasets to lockOKDatasets and to the state store.
+
+        :param newDatasets: list of dataset names
+        :type newDatasets: list of string
+        """
+        if not newDatasets:
+            return
+        self.lockOKDatasets.update(newDatasets)
+        self.logger.info(f'Bookkeeping datasets with all locks OK: {newDatasets}')
+        self.store.setMeta('lockOKDatasets', sorted(self.lockOKDatasets))
 
     def readBlockComplete(self):
         """
-        Read bookkeepingBlockComplete from task_process/transfers/transfers_ok.txt.
-        Initialize empty list in case of path not found or
-        `--ignore-transfer-ok` is `True`.
+        Read bookkeepingBlockComplete, the set of completed datasets, from the
+        state store.
+        Initialize empty set in case of `--ignore-bookkeeping-block-complete`
+        is `True`.
         """
         if config.args.ignore_bookkeeping_block_complete:
-            self.bookkeepingBlockComplete = []
+            self.bookkeepingBlockComplete = set()
             return
-        path = config.args.bookkeeping_block_complete_path
-        try:
-            with open(path, 'r', encoding='utf-8') as r:
-                self.bookkeepingBlockComplete = r.read().splitlines()
-                self.logger.info(f'Got list of block complete from bookkeeping: {self.bookkeepingBlockComplete}')
-        except FileNotFoundError:
-            self.bookkeepingBlockComplete = []
-            self.logger.info(f'Bookkeeping block complete path "{path}" does not exist. Assume this is first time it run.')
+        self.bookkeepingBlockComplete = self.store.getBlockComplete()
+        self.logger.info(f'Got list of block complete from bookkeeping: {self.bookkeepingBlockComplete}')
 
     def updateBlockComplete(self, newBlocks):
         """
-        update bookkeepingBlockComplete to task_process/transfers/transfers_ok.txt
+        Add newBlocks to bookkeepingBlockComplete and to the state store.
 
-        :param newBlocks: list of LFN
+        :param newBlocks: list of dataset names
         :type newBlocks: list of string
         """
-        self.bookkeepingBlockComplete += newBlocks
-        path = config.args.bookkeeping_block_complete_path
-        self.logger.info (f'Bookkeeping block complete to file: {path}')
-        self.logger.debug(f'{self.bookkeepingBlockComplete}')
-        with writePath(path) as w:
-            for l in self.bookkeepingBlockComplete:
-                w.write(f'{l}\n')
+        self.bookkeepingBlockComplete.update(newBlocks)
+        self.logger.info(f'Bookkeeping block complete: {newBlocks}')
+        self.store.addBlockComplete(newBlocks)
 
 
     def populateLFN2DatasetMap(self, container, rucioClient):
@@ -347,63 +407,77 @@ class Transfer:
 
     def readLFN2PFNMap(self):
         """
-        Read LFN2PFNMap from task_process/transfers/lfn2pfn_map.json
-        Initialize empty dict in case of path not found or
-        `--ignore-lfn2pfn-map` is `True`.
+        Read LFN2PFNMap from the state store.
+        Initialize empty dict in case of `--ignore-lfn2pfn-map` is `True`.
         """
         if config.args.ignore_lfn2pfn_map:
             self.LFN2PFNMap = {}
             return
-        path = config.args.lfn2pfn_map_path
-        try:
-            with open(path, 'r', encoding='utf-8') as r:
-                self.LFN2PFNMap = json.load(r)
-                self.logger.info(f'Got LFN2PFN Map from bookkeeping: {self.LFN2PFNMap}')
-        except FileNotFoundError:
-            self.LFN2PFNMap = {}
-            self.logger.info(f'Bookkeeping LFN2PFNMap file "{path}" does not exist. Assume this is first time it run.')
+        self.LFN2PFNMap = self.store.getLFN2PFNMap()
+        self.logger.info(f'Got LFN2PFN Map from bookkeeping for {sum(len(x) for x in self.LFN2PFNMap.values())} files.')
 
-    def updateLFN2PFNMap(self):
+    def updateLFN2PFNMap(self, newLFN2PFNMap):
         """
-        update LFN2PFNMap to task_process/transfers/lfn2pfn_map.json
+        Save new entries of LFN2PFNMap, which the caller already added to
+        `self.LFN2PFNMap`, to the state store.
         Note that we did not check if dict in self.LFN2PFNMap are conform with
         format we expected.
+
+        :param newLFN2PFNMap: map of RSE to map of LFN to PFN
+        :type newLFN2PFNMap: dict
         """
-        path = config.args.lfn2pfn_map_path
-        self.logger.info (f'Bookkeeping LFN2PFNMap to file: {path}')
-        self.logger.debug(f'LFN2PFNMap: {self.LFN2PFNMap}')
-        with writePath(path) as w:
-            json.dump(self.LFN2PFNMap, w)
+        self.logger.info('Bookkeeping LFN2PFNMap')
+        self.logger.debug(f'new LFN2PFNMap entries: {newLFN2PFNMap}')
+        self.store.addLFN2PFNMap(newLFN2PFNMap)
+
+    def readLFN2PFNRules(self):
+        """
+        Read the LFN to PFN rules learned by `ASO.Rucio.LFN2PFNCache` from the
+        state store.
+        Initialize empty dict in case of `--ignore-lfn2pfn-map` is `True`.
+        """
+        if config.args.ignore_lfn2pfn_map:
+            self.LFN2PFNRules = {}
+            return
+        self.LFN2PFNRules = self.store.getMeta('LFN2PFNRules', {})
+        self.logger.info(f'Got {len(self.LFN2PFNRules)} LFN2PFN rules from bookkeeping.')
+
+    def updateLFN2PFNRules(self, rules):
+        """
+        Replace the LFN to PFN rules in `self.LFN2PFNRules` and in the state
+        store.
+
+        :param rules: `rules` attribute of `ASO.Rucio.LFN2PFNCache`
+        :type rules: dict
+        """
+        self.LFN2PFNRules = rules
+        self.logger.info('Bookkeeping LFN2PFN rules')
+        self.logger.debug(f'LFN2PFN rules: {rules}')
+        self.store.setMeta('LFN2PFNRules', rules)
 
     def readCleanedFiles(self):
         """
-        Read `self.cleanedFiles` from task_process/transfers/cleaned_files.json
-        Initialize empty dict in case of path not found or
-        `--ignore-cleanup-files` is `True`.
+        Read `self.cleanedFiles`, the set of LFNs already deleted from the temp
+        area, from the state store.
+        Initialize empty set in case of `--ignore-cleaned-files` is `True`.
         """
         if config.args.ignore_cleaned_files:
-            self.cleanedFiles = []
+            self.cleanedFiles = set()
             return
-        path = config.args.cleaned_files_path
-        try:
-            with open(path, 'r', encoding='utf-8') as r:
-                self.cleanedFiles = json.load(r)
-                self.logger.info(f'Got `cleanedFiles` from bookkeeping: {self.cleanedFiles}')
-        except FileNotFoundError:
-            self.cleanedFiles = []
-            self.logger.info(f'`cleanedFiles` "{path}" does not exist. Assume this is first time it run.')
+        self.cleanedFiles = self.store.getFiles('cleaned')
+        self.logger.info(f'Got {len(self.cleanedFiles)} `cleanedFiles` from bookkeeping.')
 
-    def updateCleanedFiles(self):
+    def updateCleanedFiles(self, newCleanedFiles):
         """
-        update LFN2PFNMap to task_process/transfers/lfn2pfn_map.json
-        Note that we did not check if dict in self.LFN2PFNMap are conform with
-        format we expected.
+        Add newCleanedFiles to `self.cleanedFiles` and to the state store.
+
+        :param newCleanedFiles: list of LFN
+        :type newCleanedFiles: list of string
         """
-        path = config.args.cleaned_files_path
-        self.logger.info (f'Bookkeeping `self.cleanedFiles` to file: {path}')
-        self.logger.debug(f'self.cleanedFiles: {self.cleanedFiles}')
-        with writePath(path) as w:
-            json.dump(self.cleanedFiles, w)
+        self.cleanedFiles.update(newCleanedFiles)
+        self.logger.info(f'Bookkeeping {len(newCleanedFiles)} new `cleanedFiles`')
+        self.logger.debug(f'new cleanedFiles: {newCleanedFiles}')
+        self.store.setFiles('cleaned', newCleanedFiles)
 
 
 def manipulateOutputDataset(transfer, forcePubName):
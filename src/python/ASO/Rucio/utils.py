@@ -4,9 +4,18 @@ The utility function of Rucio ASO.
 import shutil
 import re
 import os
+import json
+import errno
 import itertools
 import subprocess
 from contextlib import contextmanager
+from urllib.parse import urlparse
+
+try:
+    import gfal2
+except ImportError:
+    # only `callGfalRm` can be used
+    gfal2 = None
 
 from ServerUtilities import encodeRequest
 from ASO.Rucio.exception import RucioTransferException
@@ -55,10 +64,15 @@ def chunks(l, n=1):
             else:
                 break
 
-def updateToREST(client, api, subresource, fileDoc):
+def updateToREST(client, api, subresource, fileDoc, store=None):
     """
     Upload fileDoc to REST
 
+    If `store` is provided, files (entries of the `list_of_*` values) which
+    were already uploaded with the same values are removed from fileDoc
+    first, nothing is uploaded if no file changed. Values are recorded in
+    `store` after the upload succeeded.
+
     :param client: CRAB REST client.
     :type client: RESTInteractions.CRABRest
     :param api: API name
@@ -67,12 +81,50 @@ def updateToREST(client, api, subresource, fileDoc):
     :type subresource: string
     :param fileDoc: fileDoc to upload to REST
     :type fileDoc: dict
+    :param store: state store of the Transfer object
+    :type store: ASO.Rucio.StateStore.StateStore
     """
+    newStates = None
+    if store is not None and 'list_of_ids' in fileDoc:
+        fileDoc, newStates = filterPushedFiles(store.getRESTStates(f'{api}/{subresource}'), fileDoc)
+        if not fileDoc['list_of_ids']:
+            return
     fileDoc['subresource'] = subresource
     client.post(
         api=api,
         data=encodeRequest(fileDoc)
     )
+    if newStates:
+        store.setRESTStates(f'{api}/{subresource}', newStates)
+
+def filterPushedFiles(pushedStates, fileDoc):
+    """
+    Remove from fileDoc the files whose values are the same as the last
+    uploaded ones.
+
+    :param pushedStates: map of file id to the values last uploaded, as
+        returned in the second item of the tuple
+    :type pushedStates: dict
+    :param fileDoc: fileDoc with `list_of_ids` and other `list_of_*` values
+        for the same files
+    :type fileDoc: dict
+    :return: tuple of new fileDoc with only the changed files, and map of id
+        to values of those files
+    :rtype: tuple
+    """
+    listKeys = [k for k, v in fileDoc.items() if k.startswith('list_of_') and isinstance(v, list)]
+    common = {k: v for k, v in fileDoc.items() if k not in listKeys}
+    keep = []
+    newStates = {}
+    for i, fileId in enumerate(fileDoc['list_of_ids']):
+        state = json.dumps([common, {k: fileDoc[k][i] for k in listKeys}], sort_keys=True)
+        if pushedStates.get(fileId) != state:
+            keep.append(i)
+            newStates[fileId] = state
+    newFileDoc = dict(common)
+    for k in listKeys:
+        newFileDoc[k] = [fileDoc[k][i] for i in keep]
+    return newFileDoc, newStates
 
 def tfcLFN2PFN(lfn, tfc, proto, depth=0):
     """
@@ -196,3 +248,58 @@ def callGfalRm(pfns, proxy, logPath):
     pfnsArg = ' '.join(pfns)
     command = f'set -x; X509_USER_PROXY={proxy} timeout {timeout} gfal-rm -v -t 180 {pfnsArg} >> {logPath} 2>&1 &'
     subprocess.call(command, shell=True)
+
+
+def hasGfal2():
+    """
+    :return: True if gfal2 python bindings are available for `gfalBulkRm`
+    :rtype: bool
+    """
+    return gfal2 is not None
+
+
+def storageEndpoint(pfn):
+    """
+    Return the storage endpoint part of a PFN.
+
+    >>> storageEndpoint('davs://eoscms.cern.ch:443/eos/cms/store/temp/user/output_3.root')
+    'davs://eoscms.cern.ch:443'
+
+    :param pfn: PFN
+    :type pfn: str
+    :return: `scheme://host:port` of the PFN
+    :rtype: str
+    """
+    parsed = urlparse(pfn)
+    return f'{parsed.scheme}://{parsed.netloc}'
+
+
+def gfalBulkRm(pfns, proxy, timeout=180):
+    """
+    Delete files with a single gfal2 bulk unlink. PFNs are expected to be on
+    the same storage endpoint, so the protocol plugin can do it in one
+    session. Files which do not exist anymore count as deleted.
+
+    :param pfns: list of pfn to delete
+    :type pfns: list
+    :param proxy: X509 proxy path
+    :type proxy: str
+    :param timeout: gfal2 namespace operation timeout in seconds
+    :type timeout: int
+    :return: tuple of list of deleted PFNs and dict of PFN to error message
+        of the ones which could not be deleted
+    :rtype: tuple
+    """
+    ctx = gfal2.creat_context()
+    ctx.set_opt_string('X509', 'CERT', proxy)
+    ctx.set_opt_string('X509', 'KEY', proxy)
+    ctx.set_opt_integer('CORE', 'NAMESPACE_TIMEOUT', timeout)
+    errors = ctx.unlink(pfns)
+    deleted = []
+    failed = {}
+    for pfn, error in zip(pfns, errors):
+        if error is None or error.code == errno.ENOENT:
+            deleted.append(pfn)
+        else:
+            failed[pfn] = error.message
+    return deleted, failed
@@ -70,15 +70,13 @@ class DataFileMetadata(object):
             }
             yield json.dumps(filedict)
 
-    def inject(self, **kwargs):
-        """ Insert or update a record in the database
+    def makeBinds(self, **kwargs):
+        """ Build the bind values to insert one file record, from the PUT parameters
         """
-        self.logger.debug("Calling jobmetadata inject with parameters %s" % kwargs)
-
         bindnames = set(kwargs.keys()) - set(['outfileruns', 'outfilelumis'])
         binds = {}
         for name in bindnames:
-            binds[name] = [kwargs[name]]
+            binds[name] = kwargs[name]
 
         # Modify all incoming metadata to have the structure 'lumi1:events1,lumi2:events2..'
         # instead of 'lumi1,lumi2,lumi3...' if necessary.
@@ -100,10 +98,19 @@ class DataFileMetadata(object):
             lumiEventList.append(lumiDict)
         runList = kwargs['outfileruns']
         # fmd_runlumi column in FILEMETADATA table is CLOB, so need to cast into a string here
-        binds['runlumi'] = [str(dict(zip(runList, lumiEventList)))]
+        binds['runlumi'] = str(dict(zip(runList, lumiEventList)))
 
-        #Changed to Select if exist, update, else insert
         binds['outtmplfn'] = binds['outlfn']
+        return binds
+
+    def inject(self, **kwargs):
+        """ Insert or update a record in the database
+        """
+        self.logger.debug("Calling jobmetadata inject with parameters %s" % kwargs)
+
+        binds = dict((k, [v]) for k, v in self.makeBinds(**kwargs).items())
+
+        #Changed to Select if exist, update, else insert
         row = self.api.query(None, None, self.FileMetaData.GetCurrent_sql,
                               outlfn=binds['outlfn'][0], taskname=binds['taskname'][0])
         try:
@@ -124,6 +131,44 @@ class DataFileMetadata(object):
         self.api.modify(self.FileMetaData.Update_sql, **update_bind)
         return []
 
+    def injectBulk(self, records):
+        """ Insert or update many records in the database, with one executemany for
+            the new records and one for the ones which already exist.
+            :arg list records: list of dictionaries with the same keys as the inject kwargs
+        """
+        self.logger.debug("Calling jobmetadata injectBulk for %d files" % len(records))
+
+        allBinds = [self.makeBinds(**record) for record in records]
+
+        # find which files are already there, with one query per job instead of one per file
+        existing = set()
+        for taskname, jobid in set((b['taskname'], b['jobid']) for b in allBinds):
+            if jobid is None:
+                lfns = [b['outlfn'] for b in allBinds if b['taskname'] == taskname and b['jobid'] is None]
+                for lfn in lfns:
+                    rows = self.api.query(None, None, self.FileMetaData.GetCurrent_sql, outlfn=lfn, taskname=taskname)
+                    existing.update((taskname, row[0]) for row in rows)
+            else:
+                rows = self.api.query(None, None, self.FileMetaData.GetCurrentForJob_sql, taskname=taskname, jobid=jobid)
+                existing.update((taskname, row[0]) for row in rows)
+
+        newBinds = dict((name, []) for name in allBinds[0])
+        updateBinds = dict((name, []) for name in ['outtmplocation', 'outsize', 'taskname', 'outlfn', 'outtmplfn'])
+        for binds in allBinds:
+            if (binds['taskname'], binds['outlfn']) in existing:
+                for name in updateBinds:
+                    updateBinds[name].append(binds[name])
+            else:
+                for name in newBinds:
+                    newBinds[name].append(binds[name])
+        if newBinds['outlfn']:
+            self.logger.debug('Inserting %d new rows into filemetadata' % len(newBinds['outlfn']))
+            self.api.modify(self.FileMetaData.New_sql, **newBinds)
+        if updateBinds['outlfn']:
+            self.logger.debug('Changing filemetadata information for %d files' % len(updateBinds['outlfn']))
+            self.api.modify(self.FileMetaData.Update_sql, **updateBinds)
+        return []
+
     def changeState(self, **kwargs): #kwargs are (taskname, outlfn, filestate)
         """ UNUSED method that change the fmd_filestate column of a filemetadata record
         """
@@ -1,6 +1,8 @@
+import json
+
 # WMCore dependecies here
 from WMCore.REST.Error import InvalidParameter
-from WMCore.REST.Server import RESTEntity, restcall
+from WMCore.REST.Server import RESTEntity, RESTArgs, restcall
 from WMCore.REST.Validation import validate_str, validate_strlist, validate_num
 
 # CRABServer dependecies here
@@ -23,34 +25,12 @@ class RESTFileMetadata(RESTEntity):
         authz_login_valid()
 
         if method in ['PUT']:
-            validate_str("taskname", param, safe, RX_TASKNAME, optional=False)
-            validate_strlist("outfilelumis", param, safe, RX_LUMILIST)
-            validate_strlist("outfileruns", param, safe, RX_RUNS)
-            if len(safe.kwargs["outfileruns"]) != len(safe.kwargs["outfilelumis"]):
-                raise InvalidParameter("The number of runs and the number of lumis lists are different")
-            validate_strlist("inparentlfns", param, safe, RX_PARENTLFN)
-            # inparentlfns will be inserted in Oracle as CLOB, so it must be a string
-            safe.kwargs['inparentlfns'] = str(safe.kwargs['inparentlfns'])
-            validate_str("globalTag", param, safe, RX_GLOBALTAG, optional=True)
-            validate_str("jobid", param, safe, RX_JOBID, optional=True)
-            validate_num("outsize", param, safe, optional=False)
-            validate_str("publishdataname", param, safe, RX_PUBLISH, optional=False)
-            validate_str("appver", param, safe, RX_CMSSW, optional=False)
-            validate_str("outtype", param, safe, RX_OUTTYPES, optional=False)
-            validate_str("checksummd5", param, safe, RX_CHECKSUM, optional=False)
-            validate_num("checksumcksum", param, safe, optional=False)
-            validate_str("checksumadler32", param, safe, RX_CHECKSUM, optional=False)
-            validate_str("outlocation", param, safe, RX_CMSSITE, optional=False)
-            validate_str("outtmplocation", param, safe, RX_CMSSITE, optional=False)
-            validate_str("acquisitionera", param, safe, RX_TASKNAME, optional=False)
-            validate_str("outdatasetname", param, safe, RX_OUTDSLFN, optional=False)
-            # need to use RX_PARENTLFN becasue same API is also used for input metadata
-            validate_str("outlfn", param, safe, RX_PARENTLFN, optional=False)
-            validate_str("outtmplfn", param, safe, RX_LFN, optional=True)
-            validate_num("events", param, safe, optional=False)
-            validate_str("filestate", param, safe, RX_FILESTATE, optional=True)
-            validate_num("directstageout", param, safe, optional=True)
-            safe.kwargs["directstageout"] = 'T' if safe.kwargs["directstageout"] else 'F' #'F' if not provided
+            if 'filesmetadata' in param.kwargs:
+                # bulk upload: a JSON list of records, each with the same parameters as a single file PUT
+                validate_str("filesmetadata", param, safe, RX_ANYTHING, optional=False)
+                safe.kwargs['filesmetadata'] = self.validateFilesMetadata(safe.kwargs['filesmetadata'])
+            else:
+                self.validateFileMetadata(param, safe)
         elif method in ['POST']:
             validate_str("taskname", param, safe, RX_TASKNAME, optional=False)
             validate_str("outlfn", param, safe, RX_LFN, optional=False)
@@ -68,6 +48,65 @@ class RESTFileMetadata(RESTEntity):
                 raise InvalidParameter("You have to specify a taskname or a number of hours. Files of this task or created before the number of hours"+\
                                         " will be deleted. Only one of the two parameters can be specified.")
 
+    @staticmethod
+    def validateFileMetadata(param, safe):
+        """Validate the parameters describing one file in a PUT"""
+        validate_str("taskname", param, safe, RX_TASKNAME, optional=False)
+        validate_strlist("outfilelumis", param, safe, RX_LUMILIST)
+        validate_strlist("outfileruns", param, safe, RX_RUNS)
+        if len(safe.kwargs["outfileruns"]) != len(safe.kwargs["outfilelumis"]):
+            raise InvalidParameter("The number of runs and the number of lumis lists are different")
+        validate_strlist("inparentlfns", param, safe, RX_PARENTLFN)
+        # inparentlfns will be inserted in Oracle as CLOB, so it must be a string
+        safe.kwargs['inparentlfns'] = str(safe.kwargs['inparentlfns'])
+        validate_str("globalTag", param, safe, RX_GLOBALTAG, optional=True)
+        validate_str("jobid", param, safe, RX_JOBID, optional=True)
+        validate_num("outsize", param, safe, optional=False)
+        validate_str("publishdataname", param, safe, RX_PUBLISH, optional=False)
+        validate_str("appver", param, safe, RX_CMSSW, optional=False)
+        validate_str("outtype", param, safe, RX_OUTTYPES, optional=False)
+        validate_str("checksummd5", param, safe, RX_CHECKSUM, optional=False)
+        validate_num("checksumcksum", param, safe, optional=False)
+        validate_str("checksumadler32", param, safe, RX_CHECKSUM, optional=False)
+        validate_str("outlocation", param, safe, RX_CMSSITE, optional=False)
+        validate_str("outtmplocation", param, safe, RX_CMSSITE, optional=False)
+        validate_str("acquisitionera", param, safe, RX_TASKNAME, optional=False)
+        validate_str("outdatasetname", param, safe, RX_OUTDSLFN, optional=False)
+        # need to use RX_PARENTLFN becasue same API is also used for input metadata
+        validate_str("outlfn", param, safe, RX_PARENTLFN, optional=False)
+        validate_str("outtmplfn", param, safe, RX_LFN, optional=True)
+        validate_num("events", param, safe, optional=False)
+        validate_str("filestate", param, safe, RX_FILESTATE, optional=True)
+        validate_num("directstageout", param, safe, optional=True)
+        safe.kwargs["directstageout"] = 'T' if safe.kwargs["directstageout"] else 'F' #'F' if not provided
+
+    @staticmethod
+    def validateFilesMetadata(filesmetadata):
+        """Validate each record of a bulk PUT as if it was sent in its own PUT.
+           Values are converted to strings first, as they would be in a form encoded request.
+           :arg str filesmetadata: JSON encoded list of dictionaries;
+           :return: list of dictionaries with the validated parameters."""
+        try:
+            records = json.loads(filesmetadata)
+        except ValueError as ex:
+            raise InvalidParameter("filesmetadata is not a valid JSON string") from ex
+        if not isinstance(records, list) or not records:
+            raise InvalidParameter("filesmetadata must be a non empty list of file records")
+        validRecords = []
+        for record in records:
+            if not isinstance(record, dict):
+                raise InvalidParameter("filesmetadata must be a list of dictionaries")
+            kwargs = {}
+            for key, value in record.items():
+                kwargs[key] = [str(v) for v in value] if isinstance(value, list) else str(value)
+            recordParam = RESTArgs([], kwargs)
+            recordSafe = RESTArgs([], {})
+            RESTFileMetadata.validateFileMetadata(recordParam, recordSafe)
+            if recordParam.kwargs:
+                raise InvalidParameter("Unexpected parameters in filesmetadata record: %s" % list(recordParam.kwargs))
+            validRecords.append(recordSafe.kwargs)
+        return validRecords
+
     ## A few notes about how the following methods (put, post, get, delete) work when decorated with restcall.
     ## * The order of the arguments is irrelevant. For example, these two definitions are equivalent:
     ##   def get(self, a, b) or def get(self, b, a)
@@ -78,14 +117,13 @@ class RESTFileMetadata(RESTEntity):
     ## * The name of the arguments has to be the same as used in the http request, and the same as used in validate().
 
     @restcall
-    def put(self, taskname, outfilelumis, inparentlfns, globalTag, outfileruns, jobid, outsize, publishdataname, appver, outtype, checksummd5,\
-            checksumcksum, checksumadler32, outlocation, outtmplocation, outdatasetname, acquisitionera, outlfn, events, filestate, directstageout, outtmplfn):
-        """Insert a new job metadata information"""
-        return self.jobmetadata.inject(taskname=taskname, outfilelumis=outfilelumis, inparentlfns=inparentlfns, globalTag=globalTag, outfileruns=outfileruns,\
-                           jobid=jobid, outsize=outsize, publishdataname=publishdataname, appver=appver, outtype=outtype, checksummd5=checksummd5,\
-                           checksumcksum=checksumcksum, checksumadler32=checksumadler32, outlocation=outlocation, outtmplocation=outtmplocation,\
-                           outdatasetname=outdatasetname, acquisitionera=acquisitionera, outlfn=outlfn, outtmplfn=outtmplfn, events=events, filestate=filestate, \
-                           directstageout=directstageout)
+    def put(self, **kwargs):
+        """Insert a new job metadata information.
+           Either the parameters of a single file, or filesmetadata: a list of dictionaries
+           with the same parameters for many files, which are inserted/updated in one go."""
+        if 'filesmetadata' in kwargs:
+            return self.jobmetadata.injectBulk(kwargs['filesmetadata'])
+        return self.jobmetadata.inject(**kwargs)
 
     @restcall
     def post(self, taskname, outlfn, filestate):
@@ -15,6 +15,13 @@ from ServerUtilities import TRANSFERDB_STATUSES, PUBLICATIONDB_STATUSES
 import time, logging
 
 
+def repeatBinds(binds, num):
+    """ Repeat the single value binds (like asoworker, last_update) for num rows, so that
+        the per file binds can be added and all files updated with one executemany
+    """
+    return dict((key, value * num) for key, value in binds.items())
+
+
 class RESTFileTransfers(RESTEntity):
     """REST entity to handle interactions between CAFTaskWorker and TaskManager database"""
 
@@ -64,6 +71,7 @@ class RESTFileTransfers(RESTEntity):
             validate_str("asoworker", param, safe, RX_ASO_WORKERNAME, optional=True)
             validate_num("grouping", param, safe, optional=False)
             validate_num("limit", param, safe, optional=True)
+            validate_str("after_id", param, safe, RX_ANYTHING, optional=True)
         elif method in ['DELETE']:
             # This one I don`t really like to have implemented
             # There is some security concerns
@@ -148,39 +156,30 @@ class RESTFileTransfers(RESTEntity):
             ###############################################
             binds['last_update'] = [timeNow]
             # TODO: fix case: if 'fts_instance' in kwargs
+            ids = makeList(kwargs['list_of_ids'])
+            states = makeList(kwargs['list_of_transfer_state'])
+            retry = [0 for x in states]
+            reasons = ["" for x in states]
             if kwargs['list_of_fts_instance']:
                 #del errorMsg
-                ids = makeList(kwargs['list_of_ids'])
-                states = makeList(kwargs['list_of_transfer_state'])
-                retry = [0 for x in states]
-                reasons = ["" for x in states]
-                instances = makeList(kwargs['list_of_fts_instance'])
-                fts_id = makeList(kwargs['list_of_fts_id'])
-
-                for num in range(len(ids)):
-                    binds['id'] = [ids[num]]
-                    binds['transfer_state'] = [TRANSFERDB_STATUSES[states[num]]]
-                    binds['fts_instance'] = [str(instances[num])]
-                    binds['fts_id'] = [str(fts_id[num])]
-                    binds['fail_reason'] = [reasons[num]]
-                    binds['retry_value'] = [int(retry[num])]
-                    self.api.modifynocheck(self.transferDB.UpdateTransfers_sql, **binds)
+                instances = [str(x) for x in makeList(kwargs['list_of_fts_instance'])]
+                fts_id = [str(x) for x in makeList(kwargs['list_of_fts_id'])]
             else:
-                ids = makeList(kwargs['list_of_ids'])
-                states = makeList(kwargs['list_of_transfer_state'])
-                retry = [0 for x in states]
-                reasons = ["" for x in states]
+                instances = [None for x in states]
+                fts_id = [None for x in states]
                 if kwargs['list_of_retry_value'] is not None:
                     reasons = makeList(kwargs['list_of_failure_reason'])
                     retry = makeList(kwargs['list_of_retry_value'])
-                for num in range(len(ids)):
-                    binds['id'] = [ids[num]]
-                    binds['transfer_state'] = [TRANSFERDB_STATUSES[states[num]]]
-                    binds['fts_instance'] = [None]
-                    binds['fts_id'] = [None]
-                    binds['fail_reason'] = [reasons[num]]
-                    binds['retry_value'] = [int(retry[num])]
-                    self.api.modifynocheck(self.transferDB.UpdateTransfers_sql, **binds)
+            num = len(ids)
+            binds = repeatBinds(binds, num)
+            binds['id'] = ids
+            binds['transfer_state'] = [TRANSFERDB_STATUSES[x] for x in states[:num]]
+            binds['fts_instance'] = instances[:num]
+            binds['fts_id'] = fts_id[:num]
+            binds['fail_reason'] = reasons[:num]
+            binds['retry_value'] = [int(x) for x in retry[:num]]
+            if ids:
+                self.api.modifynocheck(self.transferDB.UpdateTransfers_sql, **binds)
 
         elif subresource == 'updateRucioInfo':
             binds['last_update'] = [timeNow]
@@ -191,10 +190,12 @@ class RESTFileTransfers(RESTEntity):
                 blocknames = makeList(kwargs['list_of_dbs_blockname'])
             if kwargs['list_of_block_complete'] is not None:
                 blockcompletes = makeList(kwargs['list_of_block_complete'])
-            for num in range(len(ids)):
-                binds['id'] = [ids[num]]
-                binds['dbs_blockname'] = [blocknames[num]]
-                binds['block_complete'] = [blockcompletes[num]]
+            num = len(ids)
+            binds = repeatBinds(binds, num)
+            binds['id'] = ids
+            binds['dbs_blockname'] = blocknames[:num]
+            binds['block_complete'] = blockcompletes[:num]
+            if ids:
                 self.api.modifynocheck(self.transferDB.UpdateRucioInfo_sql, **binds)
 
         elif subresource == 'updatePublication':
@@ -223,12 +224,14 @@ class RESTFileTransfers(RESTEntity):
             if kwargs['list_of_retry_value'] is not None:
                 reasons = makeList(kwargs['list_of_failure_reason'])
                 retry = makeList(kwargs['list_of_retry_value'])
-            for num in range(len(ids)):
-                binds['publication_state'] = [PUBLICATIONDB_STATUSES[states[num]]]
-                binds['id'] = [ids[num]]
-                binds['fail_reason'] = [reasons[num]]
-                binds['retry_value'] = [int(retry[num])]
-                binds['publish'] = [kwargs["publish_flag"] or -1]
+            num = len(ids)
+            binds = repeatBinds(binds, num)
+            binds['publication_state'] = [PUBLICATIONDB_STATUSES[x] for x in states[:num]]
+            binds['id'] = ids
+            binds['fail_reason'] = reasons[:num]
+            binds['retry_value'] = [int(x) for x in retry[:num]]
+            binds['publish'] = [kwargs["publish_flag"] or -1] * num
+            if ids:
                 self.api.modify(self.transferDB.UpdatePublication_sql, **binds)
 
         elif subresource == 'retryPublication':
@@ -291,7 +294,7 @@ class RESTFileTransfers(RESTEntity):
                 self.api.modify(self.transferDB.KillTransfers_sql, **binds)
 
     @restcall
-    def get(self, subresource, username, vogroup, vorole, taskname, destination, source, asoworker, grouping, limit):
+    def get(self, subresource, username, vogroup, vorole, taskname, destination, source, asoworker, grouping, limit, after_id):
         """ Retrieve all docs from DB for specific parameters.
             """
         binds = {}
@@ -373,7 +376,7 @@ class RESTFileTransfers(RESTEntity):
                 rows = self.api.query(None, None, sqlQuery, **binds)
                 return rows
             elif subresource == 'acquiredPublication':
-                if grouping > 1:
+                if grouping > 2:
                     raise InvalidParameter('This grouping level is not implemented')
                 binds['state'] = PUBLICATIONDB_STATUSES['ACQUIRED']
                 binds['transfer_state'] = TRANSFERDB_STATUSES['DONE']
@@ -391,6 +394,14 @@ class RESTFileTransfers(RESTEntity):
                         raise InvalidParameter('Username is not defined')
                     binds['username'] = username
                     sqlQuery = self.transferDB.GetDocsPublication1_sql
+                elif grouping == 2:
+                    # ---------------------------------------------
+                    # (str) after_id: optional, id of the last doc of the previous page
+                    # Return: Docs, which match these conditions: asoworker, state = ACQUIRED, sorted by id,
+                    #         with id larger than after_id. Allows to retrieve all of them in pages of limit docs
+                    # ---------------------------------------------
+                    binds['after_id'] = after_id
+                    sqlQuery = self.transferDB.GetDocsPublication2_sql
                 rows = self.api.query_load_all_rows(None, None, sqlQuery, **binds)
                 return rows
 
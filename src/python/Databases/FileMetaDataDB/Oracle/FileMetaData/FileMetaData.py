@@ -108,6 +108,7 @@ class FileMetaData(object):
 
     #the field selected here is not used, the query is only executed to check if a filemetadata for the file was already uploaded or not
     GetCurrent_sql = "SELECT fmd_lfn from filemetadata WHERE tm_taskname = :taskname AND fmd_lfn = :outlfn"
+    GetCurrentForJob_sql = "SELECT fmd_lfn from filemetadata WHERE tm_taskname = :taskname AND job_id = :jobid"
 
     DeleteTaskFiles_sql = "DELETE FROM filemetadata WHERE tm_taskname = :taskname"
     DeleteFilesByTime_sql = "DELETE FROM filemetadata WHERE fmd_creation_time < sysdate - (:hours/24)"
@@ -133,6 +133,23 @@ class FileTransfers():
                                       f.tm_aso_worker = :asoworker AND rownum < :limit \
                                        ORDER BY rownum"
 
+    # same as GetDocsPublication0_sql, but sorted by id and starting after :after_id (if not NULL)
+    # to retrieve all docs in pages of :limit rows
+    GetDocsPublication2_sql = "SELECT * FROM (SELECT f.tm_id, f.tm_publication_state, f.tm_transfer_state, f.tm_aso_worker, \
+                                      f.tm_taskname, f.tm_username, \
+                                      f.tm_destination, f.tm_source_lfn, f.tm_destination_lfn, \
+                                      f.tm_last_update, f.tm_dbs_blockname, f.tm_block_complete,\
+                                      t.tm_user_role, t.tm_user_group, \
+                                      t.tm_input_dataset, t.tm_cache_url, t.tm_dbs_url \
+                                      FROM filetransfersdb f \
+                                      LEFT OUTER JOIN tasks t ON t.tm_taskname = f.tm_taskname \
+                                      WHERE f.tm_publication_state = :state AND \
+                                      f.tm_transfer_state = :transfer_state AND \
+                                      f.tm_aso_worker = :asoworker AND \
+                                      (:after_id IS NULL OR f.tm_id > :after_id) \
+                                      ORDER BY f.tm_id) \
+                                      WHERE rownum <= :limit"
+
     GetGroupedTransferStatistics0_sql = "SELECT count(*) as count, tm_aso_worker, tm_transfer_state \
                                          FROM filetransfersdb \
                                          GROUP BY tm_aso_worker, tm_transfer_state"
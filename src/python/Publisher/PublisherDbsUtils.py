@@ -10,16 +10,34 @@ import json
 import time
 from random import uniform
 from datetime import datetime
+from collections import OrderedDict
 
 from dbs.apis.dbsClient import DbsApi as DbsApiBase
 from dbs.exceptions.dbsClientException import dbsClientException
 from RestClient.ErrorHandling.RestClientExceptions import HTTPError
 
+from ServerUtilities import getLock
 from TaskWorker.WorkerExceptions import CannotMigrateException
 
 MAX_RETRY_ATTEMPTS = 3
 MIN_RETRY_DELAY = 10
 MAX_RETRY_DELAY = 3 * 60 # 3 minutes
+# number of parent LFN's looked up in DBS with one listFileArray call
+PARENT_LOOKUP_BATCH_SIZE = 100
+# number of LFN -> block entries kept in memory by ParentBlockResolver
+PARENT_CACHE_SIZE = 100000
+# at most this many LFN's of published files are kept in memory by PublishedFilesCache
+PUBLISHED_FILES_CACHE_SIZE = 500000
+# when more new blocks than this are in a dataset, list all files at once rather than block by block
+MAX_BLOCKS_LISTED_ONE_BY_ONE = 10
+# block migrations status is checked after MIGRATION_POLL_MIN seconds, then less
+# and less often, up to every MIGRATION_POLL_MAX seconds
+MIGRATION_POLL_MIN = 10
+MIGRATION_POLL_MAX = 120
+# how long a task waits for the migrations it needs before giving up until next iteration
+MIGRATION_MAX_WAIT = 300
+# how long the outcome of a migration is remembered for other tasks which need the same block
+MIGRATION_RESULT_KEEP = 3600
 
 class DbsApi(DbsApiBase):  # pylint: disable=too-few-public-methods
     """
@@ -141,80 +159,154 @@ def setupDbsAPIs(sourceURL=None, publishURL=None, DBSHost=None, logger=None):
     return DBSApis
 
 
+class ParentBlockResolver():
+    """
+    finds the DBS blocks of parent files with bulk queries, remembering in a LRU
+    cache the LFN -> block name of files found. One resolver is shared by all
+    tasks published in the same process (see parentBlockResolver below), which
+    often have the same parents. Files not found are not cached, since they may
+    appear in the destination DBS once their block is migrated
+    """
+    def __init__(self, maxSize=PARENT_CACHE_SIZE, batchSize=PARENT_LOOKUP_BATCH_SIZE):
+        self.maxSize = maxSize
+        self.batchSize = batchSize
+        self.cache = OrderedDict()  # (DBS url, lfn) : block name
+
+    def remember(self, url, lfn, blockName):
+        """
+        add one entry to the cache, dropping the least recently used if full
+        """
+        self.cache[(url, lfn)] = blockName
+        self.cache.move_to_end((url, lfn))
+        if len(self.cache) > self.maxSize:
+            self.cache.popitem(last=False)
+
+    def findBlocks(self, dbsApi, lfns, skipInvalid=False):
+        """
+        find which of lfns are in the DBS instance dbsApi and in which block
+        returns a 2-element ntuple : (found, bad)
+          found : dictionary {lfn: block name} of files known to DBS
+          bad : if skipInvalid, set of lfns which DBS refuses to look up, e.g. illegal names (GH issue #6771)
+        other errors from DBS are raised, as well as invalid lfns if not skipInvalid
+        """
+        found = {}
+        bad = set()
+        toQuery = []
+        for lfn in lfns:
+            if (dbsApi.url, lfn) in self.cache:
+                self.cache.move_to_end((dbsApi.url, lfn))
+                found[lfn] = self.cache[(dbsApi.url, lfn)]
+            else:
+                toQuery.append(lfn)
+        batches = [toQuery[i:i + self.batchSize] for i in range(0, len(toQuery), self.batchSize)]
+        while batches:
+            batch = batches.pop()
+            try:
+                filesInDBS = dbsApi.listFileArray(logical_file_name=batch, detail=True)
+            except HTTPError as ex:
+                # DBS replies 400 to invalid LFN's, anything else is a real failure
+                if ex.code != 400 or not skipInvalid:
+                    raise
+                if len(batch) == 1:
+                    bad.update(batch)
+                else:
+                    # find the culprit(s) splitting the batch in halves
+                    half = len(batch) // 2
+                    batches.extend([batch[:half], batch[half:]])
+                continue
+            for fileInDBS in filesInDBS:
+                found[fileInDBS['logical_file_name']] = fileInDBS['block_name']
+                self.remember(dbsApi.url, fileInDBS['logical_file_name'], fileInDBS['block_name'])
+        return found, bad
+
+
+parentBlockResolver = ParentBlockResolver()
+
+
+class PublishedFilesCache():
+    """
+    remembers the LFN's of files already published in the closed blocks of each
+    output dataset, so that at each publication cycle only the blocks which were
+    added (or are still open) since the previous one need to be listed.
+    One cache is shared by all tasks published in the same process (see
+    publishedFilesCache below), least recently used datasets are dropped when
+    more than maxSize LFN's are kept
+    """
+    def __init__(self, maxSize=PUBLISHED_FILES_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.datasets = OrderedDict()  # (DBS url, dataset) : {'closedBlocks': set, 'lfns': set}
+
+    def getPublishedFiles(self, destReadApi, dataset, blocks, logger=None):
+        """
+        find the files in dataset
+        blocks is the output of destReadApi.listBlocks(dataset=dataset, detail=True)
+        returns the set of LFN's of all files in those blocks
+        """
+        key = (destReadApi.url, dataset)
+        cached = self.datasets.pop(key, {'closedBlocks': set(), 'lfns': set()})
+        newBlocks = [b for b in blocks if b['block_name'] not in cached['closedBlocks']]
+        closedBlocks = {b['block_name'] for b in blocks if not b['open_for_writing']}
+        if len(newBlocks) > MAX_BLOCKS_LISTED_ONE_BY_ONE:
+            # blocks were listed before files, so all files in the closed ones are here
+            filesInDBS = destReadApi.listFiles(dataset=dataset)
+            cached = {'closedBlocks': closedBlocks, 'lfns': {f['logical_file_name'] for f in filesInDBS}}
+        else:
+            for block in newBlocks:
+                filesInDBS = destReadApi.listFiles(block_name=block['block_name'])
+                cached['lfns'].update(f['logical_file_name'] for f in filesInDBS)
+                if block['block_name'] in closedBlocks:
+                    cached['closedBlocks'].add(block['block_name'])
+        if logger:
+            logger.info("Listed files of %d new blocks in %s", len(newBlocks), dataset)
+        self.datasets[key] = cached
+        while len(self.datasets) > 1 and sum(len(x['lfns']) for x in self.datasets.values()) > self.maxSize:
+            self.datasets.popitem(last=False)
+        return cached['lfns']
+
+
+publishedFilesCache = PublishedFilesCache()
+
+
 def findParentBlocks(listOfFileDicts=None, DBSApis=None,
-                     logger=None, verbose=None):
+                     logger=None, verbose=None, resolver=None):
     """ find parent blocks for a list of files"""
 
+    resolver = resolver or parentBlockResolver
+
     # Set of all the parent files from all the files requested to be published.
     parentFiles = set()
-    # Set of parent files for which the migration to the destination DBS instance
-    # should be skipped (because they were not found in DBS).
-    parentsToSkip = set()
-    # Set of parent files to migrate from the source DBS instance
-    # to the destination DBS instance.
-    localParentBlocks = set()
-    # Set of parent files to migrate from the global DBS instance
-    # to the destination DBS instance.
-    globalParentBlocks = set()
-
-    for file in listOfFileDicts:  # pylint: disable=too-many-nested-blocks
+    for file in listOfFileDicts:
         if verbose:
             logger.info(file)
-        # Get the parent files and for each parent file do the following:
-        # 1) Add it to the list of parent files.
-        # 2) Find the block to which it belongs and insert that block name in
-        #    (one of) the set of blocks to be migrated to the destination DBS.
-        for parentFile in list(file['parents']):
-            if parentFile not in parentFiles:
-                parentFiles.add(parentFile)
-                # Is this parent file already in the destination DBS instance?
-                # (If yes, then we don't have to migrate this block.)
-                # some parent files are illegal DBS names (GH issue #6771),
-                # skip them
-                try:
-                    blocksDict = DBSApis['destRead'].listBlocks(
-                        logical_file_name=parentFile)
-                except Exception:
-                    file['parents'].remove(parentFile)
-                    continue
-                if not blocksDict:
-                    # No, this parent file is not in the destination DBS instance.
-                    # Maybe it is in the same DBS instance as the input
-                    # dataset?
-                    blocksDict = DBSApis['source'].listBlocks(
-                        logical_file_name=parentFile)
-                    if blocksDict:
-                        # Yes, this parent file is in the same DBS instance as the input dataset.
-                        # Add the corresponding block to the set of blocks from the source DBS
-                        # instance that have to be migrated to the destination
-                        # DBS.
-                        localParentBlocks.add(blocksDict[0]['block_name'])
-                    else:
-                        # No, this parent file is not in the same DBS instance as input dataset.
-                        # Maybe it is in global DBS instance?
-                        blocksDict = DBSApis['global'].listBlocks(
-                            logical_file_name=parentFile)
-                        if blocksDict:
-                            # Yes, this parent file is in global DBS instance.
-                            # Add the corresponding block to the set of blocks from global DBS
-                            # instance that have to be migrated to the
-                            # destination DBS.
-                            globalParentBlocks.add(blocksDict[0]['block_name'])
-                # If this parent file is not in the destination DBS instance, is not
-                # the source DBS instance, and is not in global DBS instance, then it
-                # means it is not known to DBS and therefore we can not migrate it.
-                # Put it in the set of parent files for which migration should
-                # be skipped.
-                if not blocksDict:
-                    parentsToSkip.add(parentFile)
-            # If this parent file should not be migrated because it is not known to DBS,
-            # we remove it from the list of parents in the file-to-publish info dictionary
-            # (so that when publishing, this "parent" file will not appear as a parent).
-            if parentFile in parentsToSkip:
-                msg = f"Skipping parent file {parentFile}, as it doesn't seem to be known to DBS."
-                logger.info(msg)
-                if parentFile in file['parents']:
-                    file['parents'].remove(parentFile)
+        parentFiles.update(file['parents'])
+
+    # Which parent files are already in the destination DBS instance?
+    # (For those we don't have to migrate the block.)
+    # some parent files are illegal DBS names (GH issue #6771), skip them
+    inDestination, badParents = resolver.findBlocks(DBSApis['destRead'], parentFiles, skipInvalid=True)
+    toFind = parentFiles - set(inDestination) - badParents
+    # The others may be in the same DBS instance as the input dataset: those
+    # blocks have to be migrated from the source DBS instance to the destination DBS.
+    inSource, _ = resolver.findBlocks(DBSApis['source'], toFind)
+    toFind -= set(inSource)
+    localParentBlocks = set(inSource.values())
+    # Or else in global DBS instance, and have to be migrated from there.
+    inGlobal, _ = resolver.findBlocks(DBSApis['global'], toFind)
+    toFind -= set(inGlobal)
+    globalParentBlocks = set(inGlobal.values())
+    # If a parent file is not in the destination DBS instance, is not in
+    # the source DBS instance, and is not in global DBS instance, then it
+    # means it is not known to DBS and therefore we can not migrate it.
+    parentsToSkip = toFind
+
+    # Parent files which should not be migrated are removed from the list of parents
+    # in the file-to-publish info dictionary (so that when publishing, these "parent"
+    # files will not appear as parents).
+    for parentFile in parentsToSkip:
+        msg = f"Skipping parent file {parentFile}, as it doesn't seem to be known to DBS."
+        logger.info(msg)
+    for file in listOfFileDicts:
+        file['parents'] = [x for x in file['parents'] if x not in parentsToSkip and x not in badParents]
     return (localParentBlocks, globalParentBlocks)
 
 
@@ -333,11 +425,173 @@ def createBulkBlock(output_config, processing_era_config, primds_config,
     return blockDump
 
 
+class MigrationTracker():
+    """
+    keeps track of the block migrations requested by all tasks of this publisher
+    in a JSON file in the migrations log directory:
+      { migrate API url : { block : {'tasks', 'status', 'updated', 'nextCheck', 'interval'} } }
+    where status is one of 'inProgress', 'done', 'failed'.
+    A block which is already being migrated for a task is not submitted again for
+    another one, and each time a task asks, the status of all migrations due for a
+    check is queried, whichever task they were requested for. Checks of a migration
+    become less frequent the longer it takes.
+    Terminally failed migrations go in the FailedMigrationAccounter as before.
+    """
+    def __init__(self, migLogDir=None, migrationAccounter=None, logger=None):
+        self.migLogDir = migLogDir
+        self.stateFile = os.path.join(migLogDir, 'migrationsInProgress.json')
+        self.migrationAccounter = migrationAccounter
+        self.logger = logger
+        self.nextChecks = {}  # (migrate API url, block) : time of next check, for the blocks of this task
+
+    def load(self):
+        """
+        read the state of all migrations, to be called holding the lock
+        """
+        try:
+            with open(self.stateFile, 'r', encoding='utf8') as fd:
+                return json.load(fd)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self, state):
+        """
+        write the state of all migrations, to be called holding the lock
+        """
+        tmpFile = self.stateFile + '.tmp'
+        with open(tmpFile, 'w', encoding='utf8') as fd:
+            json.dump(state, fd)
+        os.rename(tmpFile, self.stateFile)
+
+    def claim(self, taskname, migrateUrl, blocks, now):
+        """
+        under the lock, register the blocks of this task and pick what this process has
+        to do: the blocks to submit a migration request for and the migrations in progress
+        which are due for a check. Both are marked in the state file, so that other
+        processes do not submit or check them too while this one talks to DBS.
+        returns a 2-element ntuple of lists : (toRequest, toCheck), with toCheck a list
+        of (block, task which requested the migration)
+        """
+        toRequest = []
+        toCheck = []
+        with getLock(self.stateFile):
+            state = self.load()
+            migrations = state.setdefault(migrateUrl, {})
+            # forget results which nobody waits for anymore
+            for block, migration in list(migrations.items()):
+                if migration['status'] != 'inProgress' and now - migration['updated'] > MIGRATION_RESULT_KEEP:
+                    del migrations[block]
+            for block in blocks:
+                migration = migrations.get(block)
+                if migration and migration['status'] != 'failed':
+                    if taskname not in migration['tasks']:
+                        self.logger.info("Migration of %s was already requested for %s",
+                                         block, migration['tasks'][0])
+                        migration['tasks'].append(taskname)
+                    continue
+                toRequest.append(block)
+                migrations[block] = {'tasks': [taskname], 'status': 'inProgress',
+                                     'updated': now, 'nextCheck': now + MIGRATION_POLL_MIN,
+                                     'interval': MIGRATION_POLL_MIN}
+            for block, migration in migrations.items():
+                if migration['status'] != 'inProgress' or migration['nextCheck'] > now:
+                    continue
+                toCheck.append((block, migration['tasks'][0]))
+                migration['interval'] = min(2 * migration['interval'], MIGRATION_POLL_MAX)
+                migration['nextCheck'] = now + migration['interval']
+            self.save(state)
+        return toRequest, toCheck
+
+    def pollStatus(self, migrateApi, block, taskname):
+        """
+        check the status of one migration in progress
+        returns the new status, or None if it is still in progress or could not be checked
+        """
+        try:
+            _, atDestination, failed = checkBlockMigration(
+                taskname, migrateApi, block, self.migLogDir, self.migrationAccounter)
+        except Exception as ex:
+            self.logger.error("Could not get migration status for %s:\n%s", block, ex)
+            return None  # will check status next time
+        if atDestination:
+            self.logger.info('Migration completed for %s', block)
+            return 'done'
+        if failed:
+            self.logger.error('Migration failed for %s', block)
+            return 'failed'
+        return None
+
+    def migrate(self, taskname, migrateApi, sourceApi, blocks):
+        """
+        make sure that blocks are being migrated by migrateApi from sourceApi, submitting a
+        request only for the blocks which are not being migrated already (or failed),
+        then check the migrations which are due for a check.
+        The lock on the state file is only held to read and update it, not while
+        talking to DBS, so that other processes are not stuck behind slow DBS calls.
+        returns a 3-element ntuple of sets of blocks : (inProgress, atDestination, failed)
+        """
+        now = time.time()
+        toRequest, toCheck = self.claim(taskname, migrateApi.url, blocks, now)
+        notRequested = list(toRequest)
+        newStatus = {}
+        try:
+            for block in toRequest:
+                if not requestBlockMigration(taskname, migrateApi, sourceApi, block, self.migrationAccounter):
+                    newStatus[block] = 'failed'
+                notRequested.remove(block)
+            for block, requestedBy in toCheck:
+                status = self.pollStatus(migrateApi, block, requestedBy)
+                if status:
+                    newStatus[block] = status
+        finally:
+            # record what was found even if a DBS call raised, and forget the blocks
+            # which were claimed but not submitted, so that they are submitted next time
+            with getLock(self.stateFile):
+                state = self.load()
+                migrations = state.setdefault(migrateApi.url, {})
+                for block in notRequested:
+                    migrations.pop(block, None)
+                for block, status in newStatus.items():
+                    if block in migrations:
+                        migrations[block]['status'] = status
+                        migrations[block]['updated'] = now
+                self.save(state)
+        inProgress = set()
+        atDestination = set()
+        failed = set()
+        for block in blocks:
+            # a block claimed by another process which could not submit it is gone,
+            # it will be submitted at the next call
+            migration = migrations.get(block, {'status': 'inProgress', 'nextCheck': now})
+            status = migration['status']
+            if status == 'inProgress':
+                inProgress.add(block)
+                self.nextChecks[(migrateApi.url, block)] = migration['nextCheck']
+                continue
+            self.nextChecks.pop((migrateApi.url, block), None)
+            if status == 'done':
+                atDestination.add(block)
+            else:
+                failed.add(block)
+        return inProgress, atDestination, failed
+
+    def timeToNextCheck(self):
+        """
+        returns how many seconds to wait before one of the migrations this task
+        waits for is due for a check, at least MIGRATION_POLL_MIN
+        """
+        if not self.nextChecks:
+            return MIGRATION_POLL_MIN
+        return max(MIGRATION_POLL_MIN, min(self.nextChecks.values()) - time.time())
+
+
 def migrateByBlockDBS3(taskname, migrateApi, destReadApi, sourceApi, blocks,  # pylint: disable=too-many-arguments
-                       migLogDir, migrationAccounter,logger=None, verbose=False):
+                       migLogDir, migrationAccounter,logger=None, verbose=False, tracker=None, wait=True):
     """
-    Submit one migration request for each block that needs to be migrated.
+    Make sure that there is one migration request for each block that needs to be migrated.
     If blocks argument is not specified, migrate the whole dataset.
+    Unless wait is False, wait up to MIGRATION_MAX_WAIT seconds for the migrations to complete.
+    Migrations are submitted and checked via tracker, a MigrationTracker.
     Returns a 2-element ntuple : (exitcode, message)
     exit codes:  0 OK, 1 taking too long, 2 failure
     """
@@ -365,83 +619,37 @@ def migrateByBlockDBS3(taskname, migrateApi, destReadApi, sourceApi, blocks,  #
     badBlocks = migrationAccounter.checkForDoomedBlocks(list(blocksToMigrate))
     if badBlocks:
         raise CannotMigrateException(f"Some blocks have persistently failed migration:\n{badBlocks}")
-    msg = f"Submitting {numBlocksToMigrate} block migration requests to DBS3 ..."
-    logger.info(msg)
-    numFailedSubmissions = 0
-    migrationsInProgress = []
-    for block in list(blocksToMigrate):
-        # Submit migration request for this block.
-        ok = requestBlockMigration(taskname, migrateApi, sourceApi, block, migrationAccounter)
-        if ok:
-            migrationsInProgress.append(block)
-        else:
-            numFailedSubmissions += 1
+    if not tracker:
+        tracker = MigrationTracker(migLogDir=migLogDir, migrationAccounter=migrationAccounter, logger=logger)
 
-    numMigrationsInProgress = len(migrationsInProgress)
-    msg = f"{numMigrationsInProgress} block migration requests successfully submitted."
-    if numFailedSubmissions:
-        msg = f"{numFailedSubmissions} block migration requests failed to be submitted."
-    logger.info(msg)
-    if not migrationsInProgress:
-        return 2, f"Migration of {datasetToMigrate} failed."
-
-    # Wait for up to 300 seconds, then return to the main loop. Note that we
+    # Wait for up to MIGRATION_MAX_WAIT seconds, then return to the main loop. Note that we
     # don't fail or cancel any migration request, but just retry it next time.
     # In the case of failure, we expect the publisher daemon to try again in
     # the future.
-    numFailedMigrations = 0
-    numSuccessfulMigrations = 0
-    waitTime = 30
-    numTimes = 10
-    msg = f"Will monitor their status for up to {waitTime * numTimes} seconds."
-    logger.info(msg)
-    for _ in range(numTimes):
-        msg = f"{numMigrationsInProgress} block migrations in progress."
-        msg += f" Will check migrations status in {waitTime} seconds."
+    deadline = time.time() + MIGRATION_MAX_WAIT
+    while True:
+        migrationsInProgress, successfulMigrations, failedMigrations = tracker.migrate(
+            taskname, migrateApi, sourceApi, blocksToMigrate)
+        if not migrationsInProgress or not wait or time.time() >= deadline:
+            break
+        waitTime = tracker.timeToNextCheck()
+        msg = f"{len(migrationsInProgress)} block migrations in progress."
+        msg += f" Will check migrations status in {int(waitTime)} seconds."
         logger.info(msg)
         time.sleep(waitTime)
-        # Check the migration status of each block migration request.
-        # If a block migration has succeeded or terminally failes, remove the
-        # migration request id from the list of migration requests in progress.
-        for block in migrationsInProgress.copy(
-        ):  # make a copy to allow manipulating original list
-            try:
-                inProgress, atDestination, failed = checkBlockMigration(
-                    taskname, migrateApi, block, migLogDir, migrationAccounter)
-            except Exception as ex:
-                msg = f"Could not get migration status for {block}:\n{ex}"
-                logger.error(msg)
-                continue  # will check status next time
-            if atDestination:
-                logger.info('Migration completed for %s', block)
-                migrationsInProgress.remove(block)
-                numSuccessfulMigrations += 1
-            if failed:
-                logger.error('Migration failed for %s', block)
-                migrationsInProgress.remove(block)
-                numFailedMigrations += 1
-            if inProgress:
-                pass  # will check again later
-        # update counter at the end of loop
-        numMigrationsInProgress = len(migrationsInProgress)
-        # Stop waiting if there are no more migrations in progress.
-        if numMigrationsInProgress == 0:
-            break
-    # If after the 300 seconds there are still some migrations in progress, return
-    # with status 1.
-    if numMigrationsInProgress > 0:
+    # If there are still some migrations in progress, return with status 1.
+    if migrationsInProgress:
         msg = f"Migration of {datasetToMigrate} is taking too long - will delay the publication."
         logger.info(msg)
         return 1, f"Migration of {datasetToMigrate} is taking too long."
     msg = f"Migration of {datasetToMigrate} has finished."
     logger.info(msg)
     msg = f"Migration status summary (from {numBlocksToMigrate} input blocks to migrate):"
-    msg += f" succeeded = {numSuccessfulMigrations},"
-    msg += f" failed = {numFailedMigrations},"
-    msg += f" submission failed = {numFailedSubmissions},"
+    msg += f" succeeded = {len(successfulMigrations)},"
+    msg += f" failed = {len(failedMigrations)},"
     logger.info(msg)
     # If there were failed migrations, return with status 2.
-    if numFailedMigrations > 0 or numFailedSubmissions > 0:
+    if failedMigrations:
         msg = "Some blocks failed to be migrated."
         logger.info(msg)
         return 2, f"Migration of {datasetToMigrate} failed."
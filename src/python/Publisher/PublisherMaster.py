@@ -5,8 +5,8 @@ Here's the algorithm
 
 1. get active users
 2. choose N users where N is from the config
-3. create a multiprocessing Pool of size N
-4. spawn a process per task that publish their files
+3. create a pool of N long lived worker processes
+4. hand out tasks to the workers, which publish their files
 """
 
 import argparse
@@ -17,7 +17,6 @@ import tempfile
 from datetime import datetime
 import time
 from pathlib import Path
-from multiprocessing import Process
 
 from WMCore.Configuration import loadConfigurationFile
 from WMCore.Services.Requests import Requests
@@ -28,7 +27,7 @@ from ServerUtilities import getProxiedWebDir
 from TaskWorker.WorkerUtilities import getCrabserver
 
 from Publisher.PublisherUtils import createLogdir, setRootLogger, setSlaveLogger, logVersionAndConfig
-from Publisher.PublisherUtils import getInfoFromFMD
+from Publisher.PublisherUtils import getInfoFromFMD, WorkerPool
 
 
 class Master():  # pylint: disable=too-many-instance-attributes
@@ -46,6 +45,7 @@ class Master():  # pylint: disable=too-many-instance-attributes
 
         self.configurationFile = confFile         # remember this, will have to pass it to TaskPublish
         config = loadConfigurationFile(confFile)
+        self.RESTconfig = config.REST  # workers need it to talk to CRAB REST
         self.config = config.General
         self.TPconfig = config.TaskPublisher
 
@@ -73,6 +73,8 @@ class Master():  # pylint: disable=too-many-instance-attributes
         self.crabServer = getCrabserver(restConfig=config.REST, agentName='CRABPublisher', logger=self.logger)
 
         self.max_files_per_block = self.config.max_files_per_block
+        # workers are created at first use
+        self.pool = None
         self.startTime = time.time()
 
         # tasks which are too loarge for us to deal with are
@@ -223,7 +225,7 @@ class Master():  # pylint: disable=too-many-instance-attributes
         """
         1. Get a list of files to publish from the REST and organize by taskname
         2. For each taks get a suitably sized input for publish
-        3. Submit the publish to a subprocess
+        3. Hand out the publish to the worker pool
         """
 
         self.startTime = time.time()
@@ -249,8 +251,8 @@ class Master():  # pylint: disable=too-many-instance-attributes
             flag = '  OK' if acquiredFiles < 1000 else 'WARN'  # mark suspicious tasks
             self.logger.info('acquired_files: %s %5d : %s', flag, acquiredFiles, taskName)
 
-        processes = []
-        try:  # pylint: disable=too-many-nested-blocks
+        tasksToDo = []
+        try:
             for task in tasks:
                 taskname = str(task[0][3])
                 # this IF is for testing on preprod or dev DB's, which are full of old unpublished tasks
@@ -264,30 +266,16 @@ class Master():  # pylint: disable=too-many-instance-attributes
                 if self.sequential:
                     self.startSlave(task)   # sequentially do one task after another
                     continue
-                # else deal with each task in a separate process
-                p = Process(target=self.startSlave, args=(task,))
-                p.start()
-                self.logger.info('Starting process %s  pid=%s', p, p.pid)
-                self.logger.info('PID %s will work on task %s', p.pid, taskname)
-                processes.append(p)
-                if len(processes) == maxSlaves:
-                    while len(processes) == maxSlaves:
-                        # wait until one process has completed
-                        time.sleep(10)
-                        for proc in processes.copy():
-                            if not proc.is_alive():
-                                self.logger.info('Terminated: %s pid=%s', proc, proc.pid)
-                                processes.remove(proc)
-
+                # else hand it out to the worker pool
+                tasksToDo.append((taskname, task))
+            if tasksToDo:
+                if not self.pool:
+                    self.pool = WorkerPool(numWorkers=maxSlaves, initializer=self.initWorker,
+                                           work=self.startSlave, logger=self.logger)
+                self.logger.info('Send %d tasks to the worker pool', len(tasksToDo))
+                self.pool.run(tasksToDo)
         except Exception:  # pylint: disable=broad-except
             self.logger.exception("Error during process mapping")
-        self.logger.info('No more tasks to care for. Wait for remaining %d processes to terminate', len(processes))
-        while processes:
-            time.sleep(10)
-            for proc in processes.copy():
-                if not proc.is_alive():
-                    self.logger.info('Terminated: %s pid=%s', proc, proc.pid)
-                    processes.remove(proc)
 
         self.logger.info("Algorithm iteration completed")
         self.logger.info("Wait %d sec for next cycle", self.pollInterval())
@@ -296,6 +284,13 @@ class Master():  # pylint: disable=too-many-instance-attributes
         # a change in Publisher/stop.sh otherwise that script will break
         self.logger.info("Next cycle will start at %s", newStartTime)
 
+    def initWorker(self):
+        """
+        runs once in each worker process, before it starts working on tasks.
+        Open a connection to CRAB REST for this worker, rather than sharing the one of the master
+        """
+        self.crabServer = getCrabserver(restConfig=self.RESTconfig, agentName='CRABPublisher', logger=self.logger)
+
     def startSlave(self, task):  # pylint: disable=too-many-branches, too-many-locals, too-many-statements
         """
         start a slave process to deal with publication for a single task
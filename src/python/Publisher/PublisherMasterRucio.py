@@ -5,8 +5,8 @@ Here's the algorithm
 
 1. get active users
 2. choose N users where N is from the config
-3. create a multiprocessing Pool of size N
-4. spawn a process per task that publish their files
+3. create a pool of N long lived worker processes
+4. hand out tasks to the workers, which publish their files
 """
 
 import argparse
@@ -15,17 +15,19 @@ import json
 import time
 
 from pathlib import Path
-from multiprocessing import Process
 
 from WMCore.Configuration import loadConfigurationFile
 
-from ServerUtilities import encodeRequest, oracleOutputMapping, executeCommand
+from ServerUtilities import encodeRequest, oracleOutputMapping
 from TaskWorker.WorkerUtilities import getCrabserver
 from RucioUtils import getNativeRucioClient
 
 from Publisher.PublisherUtils import createLogdir, setRootLogger, setSlaveLogger, logVersionAndConfig
-from Publisher.PublisherUtils import getInfoFromFMD, markFailed
+from Publisher.PublisherUtils import getInfoFromFMD, markFailed, closeTaskLogFile, WorkerPool
+from Publisher.TaskPublishRucio import publishInDBS3
 
+# number of acquired publications retrieved from REST with each query
+PUBLICATION_PAGE_SIZE = 10000
 
 class Master():  # pylint: disable=too-many-instance-attributes
     """I am the main daemon kicking off all Publisher work via slave Publishers"""
@@ -42,6 +44,7 @@ class Master():  # pylint: disable=too-many-instance-attributes
 
         self.configurationFile = confFile         # remember this, will have to pass it to TaskPublish
         config = loadConfigurationFile(confFile)
+        self.fullConfig = config  # TaskPublishRucio needs all of it
         self.config = config.General
         self.TPconfig = config.TaskPublisher
 
@@ -71,6 +74,11 @@ class Master():  # pylint: disable=too-many-instance-attributes
         # Rucio Client
         self.rucio = getNativeRucioClient(config=config.Rucio, logger=self.logger)
 
+        # DBS API's used by TaskPublishRucio, by (sourceURL, publishURL)
+        self.DBSApisCache = {}
+        # workers are created at first use
+        self.pool = None
+
         self.startTime = time.time()
 
         # tasks which are too loarge for us to deal with
@@ -83,13 +91,14 @@ class Master():  # pylint: disable=too-many-instance-attributes
                 in filetransfersdb: [{'task':taskname, 'username':username , 'scope':rucioScope,
                                      'fileDicts':list_of_filedicts}, ...].
                  First three keys are obvious, 'fileDicts' is a list of dictionaries, one per file with keys:
-                   'username', 'cache_url', 'source_lfn', 'publication_state', 'destination',
+                   'id', 'username', 'cache_url', 'source_lfn', 'publication_state', 'destination',
                    'last_update', 'input_dataset', 'dbs_url', 'aso_worker',
                    'transfer_state', 'destination_lfn', 'dbs_blockname', 'block_complete'
         """
 
         self.logger.debug("Retrieving publications from oracleDB")
-        filesToPublish = []
+        # one entry per (username, taskname), filled while reading the files
+        tasks = {}
         asoworkers = self.config.asoworker
         # it is far from obvious that we will ever have same Publisher code for multiple asoworkers.. anyhow
         # asoworkers can be a string or a list of strings
@@ -108,62 +117,71 @@ class Master():  # pylint: disable=too-many-instance-attributes
                 self.logger.error("Failed to acquire publications from crabserver: %s", ex)
                 return []
 
-            self.logger.debug("Retrieving max.100000 acquired publications from oracleDB")
-            fileDoc = {}
-            fileDoc['asoworker'] = asoworker
-            fileDoc['subresource'] = 'acquiredPublication'
-            fileDoc['grouping'] = 0
-            fileDoc['limit'] = 100000
-            data = encodeRequest(fileDoc)
-            try:
-                results = crabServer.get(api='filetransfers', data=data)
-            except Exception as ex:  # pylint: disable=broad-except
-                self.logger.error("Failed to acquire publications from crabserver: %s", ex)
-                return []
-            files = oracleOutputMapping(results)
-            self.logger.info("%s acquired publications retrieved for asoworker %s", len(files), asoworker)
-            filesToPublish.extend(files)
-
-        # a list of unique tasknames
-        unique_tasks = list(set((x['taskname'] for x in filesToPublish)))
-
-        taskList = []
-        for task in unique_tasks:
-            taskDict = {'taskname': task}
-            fileList = []
-            for file in filesToPublish:
-                if file['taskname'] == task:
-                    taskDict['username'] = file['username']
+            # retrieve all acquired publications, in pages sorted by file id. Each page starts
+            # after the last id of the previous one
+            self.logger.debug("Retrieving acquired publications from oracleDB, %d per query", PUBLICATION_PAGE_SIZE)
+            numFiles = 0
+            lastId = None
+            while True:
+                fileDoc = {}
+                fileDoc['asoworker'] = asoworker
+                fileDoc['subresource'] = 'acquiredPublication'
+                fileDoc['grouping'] = 2
+                fileDoc['limit'] = PUBLICATION_PAGE_SIZE
+                if lastId:
+                    fileDoc['after_id'] = lastId
+                data = encodeRequest(fileDoc)
+                legacyQuery = False
+                try:
+                    results = crabServer.get(api='filetransfers', data=data)
+                except Exception as ex:  # pylint: disable=broad-except
+                    if lastId or getattr(ex, 'headers', {}).get('X-Error-Http', -1) != '400':
+                        self.logger.error("Failed to acquire publications from crabserver: %s", ex)
+                        return []
+                    # a REST server which does not know grouping=2 yet, get at most
+                    # 100000 publications in one query as before
+                    self.logger.warning("Paged query of acquired publications rejected by crabserver: %s."
+                                        " Retrieving max.100000 acquired publications instead", ex)
+                    fileDoc = {'asoworker': asoworker, 'subresource': 'acquiredPublication',
+                               'grouping': 0, 'limit': 100000}
+                    legacyQuery = True
+                    try:
+                        results = crabServer.get(api='filetransfers', data=encodeRequest(fileDoc))
+                    except Exception as ex2:  # pylint: disable=broad-except
+                        self.logger.error("Failed to acquire publications from crabserver: %s", ex2)
+                        return []
+                files = oracleOutputMapping(results)
+                for file in files:
+                    key = (file['username'], file['taskname'])
+                    if key not in tasks:
+                        tasks[key] = {'taskname': file['taskname'], 'username': file['username'], 'fileDicts': []}
+                    taskDict = tasks[key]
                     if file['dbs_blockname']:  # Ruio_ASO puts there a scope:name DID
                         (rucioScope, blockName) = file['dbs_blockname'].split(':')
                         taskDict['scope'] = rucioScope
                         file['dbs_blockname'] = blockName
                     taskDict['destination'] = file['destination']
-                    fileList.append(file)
-            taskDict['fileDicts'] = fileList
-            taskList.append(taskDict)
-        return taskList
+                    taskDict['fileDicts'].append(file)
+                numFiles += len(files)
+                if legacyQuery or len(files) < PUBLICATION_PAGE_SIZE:
+                    break
+                lastId = files[-1]['id']
+            self.logger.info("%s acquired publications retrieved for asoworker %s", numFiles, asoworker)
+
+        return list(tasks.values())
 
     def runTaskPublish(self, workflow, logger):
         """
-        forks a process which will run TaskPublishRucio.py
+        runs TaskPublishRucio in this process, reusing the CRAB REST and DBS
+        connections of previous tasks. The log of TaskPublishRucio goes in the
+        same file as when it is run from CLI
         """
-        # find the location in the current environment of the script we want to run
-        import Publisher.TaskPublishRucio as tp  # pylint: disable=import-outside-toplevel
-        taskPublishScript = tp.__file__
-        cmd = f"python3 {taskPublishScript}"
-        cmd += f" --configFile={self.configurationFile}"
-        cmd += f" --taskname={workflow}"
-        if self.TPconfig.dryRun:
-            cmd += " --dry"
-        logger.info("Now execute: %s", cmd)
-        stdout, stderr, exitcode = executeCommand(cmd)
-        if exitcode != 0:
-            errorMsg = f"Failed to execute command: {cmd}.\n StdErr:\n {stderr}."
-            raise Exception(errorMsg)
-        logger.info('TaskPublishScript done : %s', stdout)
-
-        jsonSummary = stdout.split()[-1]
+        logger.info("Now publish %s%s", workflow, " in DRY RUN mode" if self.TPconfig.dryRun else "")
+        jsonSummary = publishInDBS3(self.fullConfig, workflow, verbose=False, console=False,
+                                    crabServer=self.crabServer, DBSApisCache=self.DBSApisCache)
+        closeTaskLogFile(workflow)
+        logger.info('TaskPublishRucio done : %s', jsonSummary)
+
         with open(jsonSummary, 'r', encoding='utf8') as fd:
             summary = json.load(fd)
         result = summary['result']
@@ -193,7 +211,7 @@ class Master():  # pylint: disable=too-many-instance-attributes
         """
         1. Get a list of files to publish from the REST and organize by taskname
         2. For each taks get a suitably sized input for publish
-        3. Submit the publish to a subprocess
+        3. Hand out the publish to the worker pool
         """
 
         self.startTime = time.time()
@@ -219,8 +237,8 @@ class Master():  # pylint: disable=too-many-instance-attributes
             flag = '  OK' if acquiredFiles < 1000 else 'WARN'  # mark suspicious tasks
             self.logger.info('acquired_files: %s %5d : %s', flag, acquiredFiles, taskName)
 
-        processes = []
-        try:  # pylint: disable=too-many-nested-blocks
+        tasksToDo = []
+        try:
             for task in tasks:
                 taskname = str(task['taskname'])
                 # this IF is for testing on preprod or dev DB's, which are full of old unpublished tasks
@@ -234,30 +252,16 @@ class Master():  # pylint: disable=too-many-instance-attributes
                 if self.sequential:
                     self.startSlave(task)  # sequentially do one task after another
                     continue
-                # deal with each task in a separate process
-                p = Process(target=self.startSlave, args=(task,))
-                p.start()
-                self.logger.info('Starting process %s  pid=%s', p, p.pid)
-                self.logger.info('PID %s will work on task %s', p.pid, taskname)
-                processes.append(p)
-                if len(processes) == maxSlaves:
-                    while len(processes) == maxSlaves:
-                        # wait until one process has completed
-                        time.sleep(10)
-                        for proc in processes.copy():
-                            if not proc.is_alive():
-                                self.logger.info('Terminated: %s pid=%s', proc, proc.pid)
-                                processes.remove(proc)
-
+                # else hand it out to the worker pool
+                tasksToDo.append((taskname, task))
+            if tasksToDo:
+                if not self.pool:
+                    self.pool = WorkerPool(numWorkers=maxSlaves, initializer=self.initWorker,
+                                           work=self.startSlave, logger=self.logger)
+                self.logger.info('Send %d tasks to the worker pool', len(tasksToDo))
+                self.pool.run(tasksToDo)
         except Exception:  # pylint: disable=broad-except
             self.logger.exception("Error during process mapping")
-        self.logger.info('No more tasks to care for. Wait for remaining %d processes to terminate', len(processes))
-        while processes:
-            time.sleep(10)
-            for proc in processes.copy():
-                if not proc.is_alive():
-                    self.logger.info('Terminated: %s pid=%s', proc, proc.pid)
-                    processes.remove(proc)
 
         self.logger.info("Algorithm iteration completed")
         self.logger.info("Wait %d sec for next cycle", self.pollInterval())
@@ -266,6 +270,16 @@ class Master():  # pylint: disable=too-many-instance-attributes
         # a change in Publisher/stop.sh otherwise that script will break
         self.logger.info("Next cycle will start at %s", newStartTime)
 
+    def initWorker(self):
+        """
+        runs once in each worker process, before it starts working on tasks.
+        Open connections to CRAB REST and Rucio for this worker, rather than
+        sharing the ones of the master, and start with no DBS API's
+        """
+        self.crabServer = getCrabserver(restConfig=self.fullConfig.REST, agentName='CRABPublisher', logger=self.logger)
+        self.rucio = getNativeRucioClient(config=self.fullConfig.Rucio, logger=self.logger)
+        self.DBSApisCache = {}
+
     def startSlave(self, task):  # pylint: disable=too-many-branches, too-many-locals
         """
         start a slave process to deal with publication for a single task
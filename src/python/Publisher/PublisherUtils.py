@@ -7,6 +7,9 @@ mostly things which communicate with DBS or CRAB REST
 import os
 import subprocess
 from tempfile import mkstemp
+from collections import deque
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 
 import sys
 import time
@@ -20,6 +23,11 @@ from MultiProcessingLog import MultiProcessingLog
 from ServerUtilities import getHashLfn, encodeRequest, getLock
 from TaskWorker import __version__
 
+# a pool worker is replaced by a fresh one after this many tasks
+WORKER_MAX_TASKS = 100
+# after this many workers in a row fail to start, no more are started in this cycle
+WORKER_MAX_FAILED_STARTS = 3
+
 
 def createLogdir(dirname):
     """
@@ -54,8 +62,15 @@ def setupLogging(config, taskname, verbose, console):
         logger.addHandler(logging.StreamHandler())
         logger.setLevel(logging.INFO)
     else:
-        logger = logging.getLogger(taskname)
-        logging.basicConfig(filename=logfile, level=logging.INFO, format=config.TaskPublisher.logMsgFormat)
+        # in a publisher worker the logger named taskname is the slave logger, which
+        # goes to proc.c3id_<taskname>.txt and to log.txt: use a separate one
+        logger = logging.getLogger(taskPublishLoggerName(taskname))
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        closeTaskLogFile(taskname)
+        handler = FileHandler(logfile)
+        handler.setFormatter(logging.Formatter(config.TaskPublisher.logMsgFormat))
+        logger.addHandler(handler)
     if verbose:
         logger.setLevel(logging.DEBUG)
     # pass info around
@@ -66,6 +81,23 @@ def setupLogging(config, taskname, verbose, console):
     return log
 
 
+def taskPublishLoggerName(taskname):
+    """
+    name of the logger used by TaskPublish for taskname
+    """
+    return f"{taskname}.publish"
+
+
+def closeTaskLogFile(taskname):
+    """
+    close the log file opened by setupLogging for taskname, if any
+    """
+    logger = logging.getLogger(taskPublishLoggerName(taskname))
+    for handler in logger.handlers.copy():
+        logger.removeHandler(handler)
+        handler.close()
+
+
 def setMasterLogger(logsDir, name='master'):
     """ Set the logger for the master process. The file used for it is logs/processes/proc.name.txt and it
         can be retrieved with logging.getLogger(name) in other parts of the code
@@ -93,6 +125,16 @@ def setSlaveLogger(logsDir, name):
     return logger
 
 
+def closeSlaveLogger(name):
+    """
+    close the log file opened by setSlaveLogger for name
+    """
+    logger = logging.getLogger(name)
+    for handler in logger.handlers.copy():
+        logger.removeHandler(handler)
+        handler.close()
+
+
 def setRootLogger(logsDir, logDebug=False, console=False):
     """Sets the root logger with the desired verbosity level
        The root logger logs to logs/log.txt and every single
@@ -404,3 +446,147 @@ class FailedMigrationAccounter():
                 && echo '{info}' >> {tmpFile} && mv {tmpFile} {self.accountFile}"
             with getLock(self.accountFile):
                 subprocess.run(cmd, shell=True, check=True)
+
+
+def workerLoop(initializer, work, maxTasks, conn):
+    """
+    main loop of a WorkerPool process: calls initializer() once and tells the
+    master via conn whether it worked, then calls work(task) for each
+    (taskname, task) received from the master, reporting when it is done.
+    Exits after maxTasks tasks.
+    """
+    try:
+        if initializer:
+            initializer()
+    except Exception as ex:  # pylint: disable=broad-except
+        conn.send(('failed', str(ex)))
+        return
+    conn.send(('ready', None))
+    for _ in range(maxTasks):
+        taskname, task = conn.recv()
+        try:
+            work(task)
+        except Exception:  # pylint: disable=broad-except
+            logging.getLogger(taskname).exception("Unexpected error while working on %s", taskname)
+        # slaves used to be short lived, do not keep one open log file for each task
+        closeSlaveLogger(taskname)
+        closeTaskLogFile(taskname)
+        conn.send(('done', taskname))
+
+
+class WorkerPool():
+    """
+    a pool of long lived processes which work on one task at a time.
+    Workers are forked when the pool is first used and stay around for the
+    following cycles, so that whatever initializer() sets up (e.g. connections
+    to CRAB REST, Rucio and DBS) is reused for all tasks a worker gets.
+    The master keeps the queue of tasks and hands one to each idle worker, which
+    reports back as soon as it is done, so the master never waits for an idle slot
+    and always knows which task was lost when a worker dies.
+    Workers which die or exit after maxTasks tasks are replaced, unless
+    WORKER_MAX_FAILED_STARTS workers in a row fail to start: then the
+    remaining tasks are left to the live workers, or to the next cycle.
+    """
+    def __init__(self, numWorkers=1, initializer=None, work=None, maxTasks=WORKER_MAX_TASKS, logger=None):
+        self.numWorkers = numWorkers
+        self.initializer = initializer
+        self.work = work
+        self.maxTasks = maxTasks
+        self.logger = logger
+        # pid : {'proc', 'conn', 'ready': initialized, 'task': name of the task it is on, 'done': number of tasks}
+        self.workers = {}
+        self.failedStarts = 0
+
+    def startWorker(self):
+        """
+        fork one more worker
+        """
+        conn, workerConn = Pipe()
+        proc = Process(target=workerLoop, daemon=True,
+                       args=(self.initializer, self.work, self.maxTasks, workerConn))
+        proc.start()
+        workerConn.close()  # only used by the worker
+        self.workers[proc.pid] = {'proc': proc, 'conn': conn, 'ready': False, 'task': None, 'done': 0}
+        self.logger.info('Started worker pid=%s', proc.pid)
+
+    def readReports(self, pid):
+        """
+        process all reports sent by a worker so far
+        """
+        worker = self.workers[pid]
+        try:
+            while worker['conn'].poll():
+                event, info = worker['conn'].recv()
+                if event == 'ready':
+                    worker['ready'] = True
+                    self.failedStarts = 0
+                elif event == 'failed':
+                    self.logger.error('Worker pid=%s failed to start: %s', pid, info)
+                elif event == 'done':
+                    worker['task'] = None
+                    worker['done'] += 1
+                    self.logger.info('PID %s completed task %s', pid, info)
+        except (EOFError, OSError):
+            pass
+
+    def removeWorker(self, pid):
+        """
+        clean up after a worker which is gone and start a new one, unless too many failed to start
+        """
+        worker = self.workers.pop(pid)
+        worker['proc'].join()
+        worker['conn'].close()
+        if worker['proc'].exitcode:
+            self.logger.error('Worker pid=%s died with exitcode %s', pid, worker['proc'].exitcode)
+        if worker['task']:
+            self.logger.error('Task %s was not completed by worker pid=%s', worker['task'], pid)
+        if not worker['ready']:
+            self.failedStarts += 1
+        if self.failedStarts < WORKER_MAX_FAILED_STARTS:
+            self.startWorker()
+        else:
+            self.logger.error('%d workers in a row failed to start. Do not start new ones in this cycle',
+                              self.failedStarts)
+
+    def dispatch(self, tasks):
+        """
+        hand out tasks from the tasks deque to the idle workers
+        """
+        for pid, worker in self.workers.items():
+            if not tasks:
+                return
+            if not worker['ready'] or worker['task'] or worker['done'] >= self.maxTasks:
+                continue
+            taskname, task = tasks.popleft()
+            try:
+                worker['conn'].send((taskname, task))
+            except OSError:
+                # worker is gone, the task will go to another one
+                tasks.appendleft((taskname, task))
+                continue
+            worker['task'] = taskname
+            self.logger.info('PID %s will work on task %s', pid, taskname)
+
+    def run(self, tasks):
+        """
+        work on all tasks, a list of (taskname, task), and return when they are all done
+        """
+        self.failedStarts = 0
+        while len(self.workers) < self.numWorkers:
+            self.startWorker()
+        tasks = deque(tasks)
+        while tasks or any(w['task'] for w in self.workers.values()):
+            self.dispatch(tasks)
+            if not self.workers:
+                self.logger.error('No worker left. %d tasks will wait for next cycle', len(tasks))
+                break
+            conns = {w['conn']: pid for pid, w in self.workers.items()}
+            sentinels = {w['proc'].sentinel: pid for pid, w in self.workers.items()}
+            ready = wait(list(conns) + list(sentinels))
+            for pid in {conns[x] for x in ready if x in conns}:
+                self.readReports(pid)
+            for pid in {sentinels[x] for x in ready if x in sentinels}:
+                # the worker may have sent something before exiting
+                self.readReports(pid)
+                self.removeWorker(pid)
+            self.logger.debug('%d tasks left to hand out', len(tasks))
@@ -1,6 +1,6 @@
 # pylint: disable=invalid-name, broad-except, too-many-branches
 """
-this is a standalone script. It is spawned by PushisherMaster or could
+this is a standalone script. It is called by PushisherMasterRucio workers or could
 be executed from CLI (in the Publisher environment) to retry or debug failures
 """
 import os
@@ -19,14 +19,18 @@ from Publisher.PublisherUtils import setupLogging, prepareDummySummary, saveSumm
     markGood, markFailed, getDBSInputInformation, FailedMigrationAccounter
 
 from Publisher.PublisherDbsUtils import format_file_3, setupDbsAPIs, findParentBlocks, \
-    prepareDbsPublishingConfigs, createBulkBlock, migrateByBlockDBS3
+    prepareDbsPublishingConfigs, createBulkBlock, migrateByBlockDBS3, MigrationTracker, MIGRATION_MAX_WAIT, \
+    publishedFilesCache
 
 
-def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-many-statements, too-many-locals
+def publishInDBS3(config, taskname, verbose, console,  # pylint: disable=too-many-statements, too-many-locals, too-many-arguments
+                  crabServer=None, DBSApisCache=None):
     """
     Publish output from one task in DBS
     It must return the name of the SummaryFile where result of the pbulication attempt is saved
     Any exception must be catched
+    When called by a long lived process for many tasks, the CRAB REST client can be passed in
+    and DBSApisCache, a dictionary, is used to keep the DBS API's for the next tasks
     """
     # a few dictionaries to pass global information around all these functions
     # initialized here to None simply as documentation
@@ -35,7 +39,7 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
     DBSApis = {'source': None, 'destRead': None, 'destWrite': None, 'global': None, 'migrate': None}
     nothingToDo = {}  # a pre-filled SummaryFile in case of no useful input or errors
 
-    def publishOneBlockInDBS(blockDict=None, DBSConfigs=None, logger=None):
+    def publishOneBlockInDBS(blockDict=None, DBSConfigs=None, logger=None, canWait=False):
         """
         get one complete block info and publish it
         blockDict is a dictionary  {'block_name':name, 'files':[{},..,{}]}
@@ -45,9 +49,11 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
         DBSConfigs is a dictionary with common information to be inserted in DBS
         as returned returned by  prepareDbsPublishingConfigs
 
-        it has 2 possible outcomes and returns a dictionary:
+        it has 3 possible outcomes and returns a dictionary:
          if OK : {'status': 'OK', 'reason': None, 'dumpFile': None}
          if FAIL : {'status': 'FAIL', 'reason': reason, 'dumpFile': dumpFileName}
+         if WAIT : {'status': 'WAIT', 'reason': reason, 'dumpFile': None}
+           only if canWait is True: parent blocks are being migrated, call again later
          When 'reason' is 'failedToInsertInDBS', 'dumpFile' is the full path to the
           file with the dump of the block. Otherwise is None.
         """
@@ -77,6 +83,7 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
         logger.info(msg)
 
         # Migrate parent blocks before publishing.
+        migrationsInProgress = False
         # First migrate the parent blocks that are in the same DBS instance
         # as the input dataset.
         if localParentBlocks:
@@ -91,16 +98,20 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
                         taskname,
                         DBSApis['migrate'], DBSApis['destRead'], DBSApis['source'],
                         localParentBlocks, log['migrationLogDir'],
-                        migrationAccounter, logger=logger, verbose=verbose)
+                        migrationAccounter, logger=logger, verbose=verbose,
+                        tracker=migrationTracker, wait=False)
                 except CannotMigrateException as ex:
                     # there is nothing we can do in this case
                     failureMsg = 'Cannot migrate. ' + str(ex)
                     return {'status': 'FAIL', 'reason': failureMsg, 'dumpFile': None}
                 except Exception as ex:
                     logger.exception('Exception raised inside migrateByBlockDBS3\n%s', ex)
-                    statusCode = 1
+                    # a failure, not a migration taking long: do not wait for it
+                    statusCode = 2
                     failureMsg = 'Exception raised inside migrateByBlockDBS3'
-                if statusCode:
+                if statusCode == 1 and canWait:
+                    migrationsInProgress = True
+                elif statusCode:
                     failureMsg += " Not publishing any files."
                     logger.info(failureMsg)
                     return {'status': 'FAIL', 'reason': failureMsg, 'dumpFile': None}
@@ -117,16 +128,24 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
                         taskname,
                         DBSApis['migrate'], DBSApis['destRead'], DBSApis['global'],
                         globalParentBlocks, log['migrationLogDir'],
-                        migrationAccounter, logger=logger, verbose=verbose)
+                        migrationAccounter, logger=logger, verbose=verbose,
+                        tracker=migrationTracker, wait=False)
                 except Exception as ex:
                     logger.exception('Exception raised inside migrateByBlockDBS3\n%s', ex)
-                    statusCode = 1
+                    # a failure, not a migration taking long: do not wait for it
+                    statusCode = 2
                     failureMsg = 'Exception raised inside migrateByBlockDBS3'
-                if statusCode:
+                if statusCode == 1 and canWait:
+                    migrationsInProgress = True
+                elif statusCode:
                     failureMsg += " Not publishing any files."
                     logger.info(failureMsg)
                     return {'status': 'FAIL', 'reason': failureMsg, 'dumpFile': None}
 
+        if migrationsInProgress:
+            logger.info("Parent blocks are being migrated. Will try again later")
+            return {'status': 'WAIT', 'reason': 'Migration in progress', 'dumpFile': None}
+
         block_name = blockDict['block_name']
         originSite = blockDict['origin_site']
         files_to_publish = dbsFiles
@@ -210,7 +229,8 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
         return summaryFileName
 
     # initialize CRABServer REST
-    crabServer = getCrabserver(restConfig=config.REST, agentName='CRABPublisher', logger=logger)
+    if not crabServer:
+        crabServer = getCrabserver(restConfig=config.REST, agentName='CRABPublisher', logger=logger)
 
     # retrieve info on DBS from TaskDB table
     try:
@@ -223,19 +243,27 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
         return summaryFileName
     logger.info("inputDataset: %s", inputDataset)
 
-    # prepare DBS API's
-    try:
-        DBSApis = setupDbsAPIs(sourceURL=sourceURL, publishURL=publishURL,
-                               DBSHost=config.TaskPublisher.DBShost, logger=logger)
-    except Exception as ex:
-        logger.exception('Error creating DBS APIs, likely wrong DBS URL %s\n%s', publishURL, ex)
-        nothingToDo['result'] = 'FAIL'
-        nothingToDo['reason'] = 'Error contacting DBS'
-        summaryFileName = saveSummaryJson(nothingToDo, log['logdir'])
-        return summaryFileName
+    # prepare DBS API's, unless we have them already from a previous task
+    if DBSApisCache and (sourceURL, publishURL) in DBSApisCache:
+        DBSApis = DBSApisCache[(sourceURL, publishURL)]
+    else:
+        try:
+            DBSApis = setupDbsAPIs(sourceURL=sourceURL, publishURL=publishURL,
+                                   DBSHost=config.TaskPublisher.DBShost, logger=logger)
+        except Exception as ex:
+            logger.exception('Error creating DBS APIs, likely wrong DBS URL %s\n%s', publishURL, ex)
+            nothingToDo['result'] = 'FAIL'
+            nothingToDo['reason'] = 'Error contacting DBS'
+            summaryFileName = saveSummaryJson(nothingToDo, log['logdir'])
+            return summaryFileName
+        if DBSApisCache is not None:
+            DBSApisCache[(sourceURL, publishURL)] = DBSApis
 
     # instantiate an accounter for failed migrations
     migrationAccounter = FailedMigrationAccounter(config=config, logger=logger)
+    # and a tracker for the migrations requested by all tasks
+    migrationTracker = MigrationTracker(migLogDir=log['migrationLogDir'], migrationAccounter=migrationAccounter,
+                                        logger=logger)
 
     # pick a few params which are common to all blocks and files to be published
     aBlock = blocksToPublish[0]
@@ -246,9 +274,10 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
     # Find all blocks and files already published in this dataset.
     try:
         existingDBSBlocks = DBSApis['destRead'].listBlocks(dataset=outputDataset, detail=True)
-        existingDBSFiles = DBSApis['destRead'].listFiles(dataset=outputDataset, detail=True)
-        existingBlocks = [f['block_name'] for f in existingDBSBlocks]
-        existingFiles = [f['logical_file_name'] for f in existingDBSFiles]
+        existingBlocks = {b['block_name'] for b in existingDBSBlocks}
+        # only blocks which are new since previous cycle are listed again
+        existingFiles = publishedFilesCache.getPublishedFiles(DBSApis['destRead'], outputDataset,
+                                                              existingDBSBlocks, logger=logger)
         msg = f"Dataset {outputDataset} already contains {len(existingBlocks)} blocks"
         # msg += " (%d valid, %d invalid)." % (len(existingFile), len(existingFiles) - len(existingFile))
         logger.info(msg)
@@ -304,33 +333,52 @@ def publishInDBS3(config, taskname, verbose, console):  # pylint: disable=too-ma
 
     dumpList = []  # keep a list of files where blocks which fail publication are dumped
 
-    # Publish one block at a time
-    for block in blocksToPublish:
-        blockDict = {'block_name': block['block_name']}
-        blockDict['origin_site'] = block['origin_site']
-        blockDict['files'] = block['files']
-        lfnsInBlock = [f['source_lfn'] for f in blockDict['files']]
-        result = publishOneBlockInDBS(blockDict=blockDict, DBSConfigs=DBSConfigs, logger=logger)
-        if result['status'] == 'OK':
-            logger.info('Publish OK   for Block: %s', blockDict['block_name'])
-            publishedBlocks += 1
-            publishedFiles += len(blockDict['files'])
-            if not dryRun:
-                markGood(files=lfnsInBlock, crabServer=crabServer, asoworker=config.General.asoworker, logger=logger)
-            listOfPublishedLFNs.extend(lfnsInBlock)
-        elif result['status'] == 'FAIL':
-            failedBlocks += 1
-            logger.error('Publish FAIL for Block: %s', blockDict['block_name'])
-            failedBlocks += 1
-            failedFiles += len(blockDict['files'])
-            if not dryRun:
-                markFailed(files=lfnsInBlock, crabServer=crabServer, asoworker=config.General.asoworker, logger=logger)
-            listOfFailedLFNs.extend(lfnsInBlock)
-            if result['reason'] == 'failedToInsertInDBS':
-                logger.error("Failed to insert block in DBS. Block Dump saved")
-                dumpList.append(result['dumpFile'])
-            else:
-                logger.error("Could not publish block because %s", result['reason'])
+    # Publish one block at a time. Blocks whose parents are being migrated are
+    # tried again after the others, for up to MIGRATION_MAX_WAIT seconds
+    blocksToDo = blocksToPublish
+    migrationDeadline = None
+    while blocksToDo:
+        canWait = migrationDeadline is None or time.time() < migrationDeadline
+        blocksWaiting = []
+        for block in blocksToDo:
+            blockDict = {'block_name': block['block_name']}
+            blockDict['origin_site'] = block['origin_site']
+            blockDict['files'] = block['files']
+            lfnsInBlock = [f['source_lfn'] for f in blockDict['files']]
+            result = publishOneBlockInDBS(blockDict=blockDict, DBSConfigs=DBSConfigs, logger=logger,
+                                          canWait=canWait)
+            if result['status'] == 'WAIT':
+                blocksWaiting.append(block)
+                continue
+            if result['status'] == 'OK':
+                logger.info('Publish OK   for Block: %s', blockDict['block_name'])
+                publishedBlocks += 1
+                publishedFiles += len(blockDict['files'])
+                if not dryRun:
+                    markGood(files=lfnsInBlock, crabServer=crabServer, asoworker=config.General.asoworker,
+                             logger=logger)
+                listOfPublishedLFNs.extend(lfnsInBlock)
+            elif result['status'] == 'FAIL':
+                failedBlocks += 1
+                logger.error('Publish FAIL for Block: %s', blockDict['block_name'])
+                failedBlocks += 1
+                failedFiles += len(blockDict['files'])
+                if not dryRun:
+                    markFailed(files=lfnsInBlock, crabServer=crabServer, asoworker=config.General.asoworker,
+                               logger=logger)
+                listOfFailedLFNs.extend(lfnsInBlock)
+                if result['reason'] == 'failedToInsertInDBS':
+                    logger.error("Failed to insert block in DBS. Block Dump saved")
+                    dumpList.append(result['dumpFile'])
+                else:
+                    logger.error("Could not publish block because %s", result['reason'])
+        if blocksWaiting and migrationDeadline is None:
+            migrationDeadline = time.time() + MIGRATION_MAX_WAIT
+        blocksToDo = blocksWaiting
+        if blocksToDo:
+            waitTime = migrationTracker.timeToNextCheck()
+            logger.info("%d blocks wait for parent migrations. Try again in %d seconds", len(blocksToDo), waitTime)
+            time.sleep(waitTime)
 
     # Print a publication status summary for this dataset.
     msg = "End of publication status:"
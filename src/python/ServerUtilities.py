@@ -84,6 +84,10 @@ NUM_DAYS_FOR_RESUBMITDRAIN = 7
 MAX_DAYS_FOR_TAPERECALL = 15
 # Threshold (in TB) to split a dataset among multiple sites when recalling from tape
 MAX_TB_TO_RECALL_AT_A_SINGLE_SITE = 1000  # effectively no limit. See https://github.com/dmwm/CRABServer/issues/7610
+# In automatic splitting, the job wrapper input files (input_args.json, run_and_lumis.tar.gz,
+# input_files.tar.gz) of the jobs created by PreDAG are in one bundle per stage, this file in
+# SPOOL_DIR maps each job id to the name of its bundle
+JOB_WRAPPER_INPUTS_INDEX = 'job_wrapper_inputs.json'
 
 # These are all possible statuses of a task in the TaskDB.
 TASKDBSTATUSES_TMP = ['WAITING', 'NEW', 'HOLDING', 'QUEUED', 'TAPERECALL', 'KILLRECALL']
@@ -23,6 +23,7 @@ from urllib.parse import urlencode
 
 from ServerUtilities import MAX_DISK_SPACE, MAX_IDLE_JOBS, MAX_POST_JOBS, TASKLIFETIME
 from ServerUtilities import checkS3Object, getColumn, pythonListToClassAdExprTree, atomicReplaceAcrossFS
+from ServerUtilities import JOB_WRAPPER_INPUTS_INDEX
 
 from CRABUtils.Utils import addToGZippedTarfile
 
@@ -735,29 +736,23 @@ class DagmanCreator(TaskAction):
 
     def createOrUpdateFilesForJobWrapper(self, dagSpecs):
         """
-        deal with files to be possibly changed inside CMSRunAnalysis.tar.gz
-        in case createSubdag is called on the AP by PreDag (automatic splitting).
-        If that tarball exists already, expand it and update files in there
-        (which can be themselves other tarballs), tar it again and copy to
-        cwd. Otherwise simply create new files and copy them to cwd. When running
-        in TW the CMSRunAnalysis.tar.gz will be created later on.
+        create the files with the arguments, lumis and input files of each job
+        which are used by the job wrapper.
+        When running in TW they are created in cwd and the CMSRunAnalysis.tar.gz
+        will be created later on with them.
+        When createSubdag is called on the AP by PreDag (automatic splitting) the
+        CMSRunAnalysis.tar.gz is not changed: the files for the jobs of this stage
+        only are packed in a new job wrapper inputs bundle which is transferred to
+        those jobs along with CMSRunAnalysis.tar.gz, see createJobWrapperInputsBundle.
+        The run_and_lumis.tar.gz and input_files.tar.gz for all jobs of the task are
+        still updated in SPOOL_DIR, since they are used by PostJob, PreDag and via WEB_DIR.
         """
         workingDir = os.getcwd()  # remember current cwd: tmp dir in TW, SPOOL_DIR in the AP
         tarballDir = tempfile.mkdtemp()
-        if not self.runningInTW:
-            with tarfile.open('CMSRunAnalysis.tar.gz') as tf:
-                tf.extractall(tarballDir)
         os.chdir(tarballDir)
         # use new tmp directory to create run_and_lumis.tar.gz and input_files.tar.gz
         runAndLumisDir = tempfile.mkdtemp()
         inputFilesDir = tempfile.mkdtemp()
-        if not self.runningInTW:
-            # pre-populate those directories with files from previous DagmanCreator steps
-            with tarfile.open('run_and_lumis.tar.gz') as tf:
-                tf.extractall(runAndLumisDir)
-            with tarfile.open('input_files.tar.gz') as tf:
-                tf.extractall(inputFilesDir)
-        # now add run_lumi and input_files from this DAG
         # add current runs_and_lumis and input_files lists in the temp directories
         for dagSpec in dagSpecs:
             # run and lumis, one file for each job in standard lumi format
@@ -772,48 +767,76 @@ class DagmanCreator(TaskAction):
             job_input_file_list = os.path.join(inputFilesDir, f"job_input_file_list_{dagSpec['count']}.txt")
             with open(job_input_file_list, "w", encoding='utf-8') as fd:
                 fd.write(str(dagSpec['inputFiles']))
-        # make tarballs, if those file exists in tarballDir, they will be overwritten
-        os.chdir(tarballDir)
+        # make tarballs with the files of this DAG only
         with tarfile.open('run_and_lumis.tar.gz', "w:gz") as tf:
             # use arcname='' to have only filename in the archive. w/o dir
             tf.add(runAndLumisDir, arcname='')
         with tarfile.open('input_files.tar.gz', 'w:gz') as tf:
             tf.add(inputFilesDir, arcname='')
-        shutil.rmtree(runAndLumisDir)
-        shutil.rmtree(inputFilesDir)
-        if self.runningInTW:
-            # simply put tarballs in correct directory, CMSRunAnalysis.tar.gz will be created later on
-            shutil.copy('run_and_lumis.tar.gz', workingDir)
-            shutil.copy('input_files.tar.gz', workingDir)
-        else:
-            # still need to put run_and_lumis in SPOOL_DIR since automatic splitting code will
-            # need access e.g. in PostJob.saveAutomaticSplittingData
-            atomicReplaceAcrossFS('run_and_lumis.tar.gz', workingDir)
-            atomicReplaceAcrossFS('input_files.tar.gz', workingDir)
-        # now list of input arguments needed for each jobs, again prepare it in the temp dir
+        # now list of input arguments needed for each jobs
         argdicts = self.prepareJobArguments(dagSpecs)
         argFileName = "input_args.json"
-        if not self.runningInTW:  # add to argument list from previous stage
-            with open(argFileName, 'r', encoding='utf-8') as fd:
-                oldArgs = json.load(fd)
-            argdicts = oldArgs + argdicts
-        # create (updated) file
         with open(argFileName, 'w', encoding='utf-8') as fd:
             json.dump(argdicts, fd)
+        jobWrapperFiles = ['run_and_lumis.tar.gz', 'input_files.tar.gz', argFileName]
         if self.runningInTW:
-            # simply move file to working dir
-            shutil.copy(argFileName, workingDir)
+            # simply put files in correct directory, CMSRunAnalysis.tar.gz will be created later on
+            for fileName in jobWrapperFiles:
+                shutil.copy(fileName, workingDir)
         else:  # i.e. not running in TW but in the AP
-            # last effort, create new job wrapper tarball and replace old one
-            localTempDir = tempfile.mkdtemp()
-            os.chdir(localTempDir)
-            with tarfile.open('CMSRunAnalysis.tar.gz', 'w:gz') as tf:
-                tf.add(tarballDir, arcname='')
-            atomicReplaceAcrossFS('CMSRunAnalysis.tar.gz', workingDir)
-            shutil.rmtree(localTempDir)
+            self.createJobWrapperInputsBundle([str(dagSpec['count']) for dagSpec in dagSpecs],
+                                              jobWrapperFiles, workingDir)
+            # add the files from previous DagmanCreator steps to the task-wide tarballs, those
+            # from this DAG have different names. Automatic splitting code will need access to
+            # run_and_lumis in SPOOL_DIR e.g. in PostJob.saveAutomaticSplittingData
+            with tarfile.open(os.path.join(workingDir, 'run_and_lumis.tar.gz')) as tf:
+                tf.extractall(runAndLumisDir)
+            with tarfile.open(os.path.join(workingDir, 'input_files.tar.gz')) as tf:
+                tf.extractall(inputFilesDir)
+            with tarfile.open('run_and_lumis.tar.gz', "w:gz") as tf:
+                tf.add(runAndLumisDir, arcname='')
+            with tarfile.open('input_files.tar.gz', 'w:gz') as tf:
+                tf.add(inputFilesDir, arcname='')
+            atomicReplaceAcrossFS('run_and_lumis.tar.gz', workingDir)
+            atomicReplaceAcrossFS('input_files.tar.gz', workingDir)
+        shutil.rmtree(runAndLumisDir)
+        shutil.rmtree(inputFilesDir)
         os.chdir(workingDir)
         shutil.rmtree(tarballDir)
 
+    @staticmethod
+    def createJobWrapperInputsBundle(jobIds, fileNames, workingDir):
+        """
+        pack files from cwd in a bundle named after their content and place it in workingDir
+        (SPOOL_DIR). A bundle is never modified once created, each PreDag stage adds its own
+        and records which jobs use it in JOB_WRAPPER_INPUTS_INDEX. PreJob adds the bundle
+        to the input files of the job and the job wrapper expands it after CMSRunAnalysis.tar.gz,
+        replacing the files of the TW stage with those of the stage which created the job.
+        Returns the bundle name
+        """
+        digest = hashlib.sha1()
+        for fileName in fileNames:
+            digest.update(fileName.encode('utf-8'))
+            with open(fileName, 'rb') as fd:
+                digest.update(fd.read())
+        bundleName = f"JobWrapperInputs.{digest.hexdigest()}.tar.gz"
+        if not os.path.exists(os.path.join(workingDir, bundleName)):
+            with tarfile.open(bundleName, 'w:gz') as tf:
+                for fileName in fileNames:
+                    tf.add(fileName)
+            atomicReplaceAcrossFS(bundleName, workingDir)
+        indexFileName = os.path.join(workingDir, JOB_WRAPPER_INPUTS_INDEX)
+        index = {}
+        if os.path.exists(indexFileName):
+            with open(indexFileName, 'r', encoding='utf-8') as fd:
+                index = json.load(fd)
+        for jobId in jobIds:
+            index[jobId] = bundleName
+        with open(indexFileName + '.tmp', 'w', encoding='utf-8') as fd:
+            json.dump(index, fd)
+        os.rename(indexFileName + '.tmp', indexFileName)
+        return bundleName
+
     def createSubdag(self, splitterResult, **kwargs):
         """ beware the "Sub" in the name ! This is used also for Main DAG
         Does the actual DAG file creation and writes out relevant files
@@ -851,9 +874,9 @@ class DagmanCreator(TaskAction):
         Those side effects require special care when this is called by PreDag during automatic splitting,
         since following files already exists in the CMSRunAnalysis.tar.gz tarball which was sent byt TW
           input_args.json, run_and_lumis.tar.gz, input_files.tar.gz
-         Therefore when running in the scheduler (HTC AccessPoing) we will move to a temp directory,
-         expand CMSRunAnalysis.tar.gz in there, do all the work, and create a new tarball to be places
-         in SPOOL_DIR to be used in next submissions by the created DAGs
+         Therefore when running in the scheduler (HTC AccessPoing) those files are created for the new
+         jobs only and packed in a JobWrapperInputs.<hash>.tar.gz bundle in SPOOL_DIR, which is listed in
+         job_wrapper_inputs.json and used by the jobs of the created DAGs together with CMSRunAnalysis.tar.gz
          Files in TaskManagerRun.tar.gz do not require special handling since that tarball is expanded
          in the SPOOL_DIR when the task is initially bootstrapped in dag_bootstrap_startup.sh
         """
@@ -1177,6 +1200,10 @@ class DagmanCreator(TaskAction):
             maxpost = int(max(MAX_POST_JOBS, self.task['jobcount']*.1))
         jobSubmit['My.CRAB_MaxPost'] = str(maxpost)
 
+        # run PRE/POST scripts in a per-task server which keeps python modules loaded
+        useTaskManagerServer = getattr(self.config.TaskWorker, 'useTaskManagerServer', False)
+        jobSubmit['My.CRAB_TaskManagerServer'] = "1" if useTaskManagerServer else "0"
+
         if not 'My.CRAB_FailedNodeLimit' in jobSubmit:
             jobSubmit['My.CRAB_FailedNodeLimit'] = "-1"
         elif int(jobSubmit['My.CRAB_FailedNodeLimit']) < 0:
@@ -50,6 +50,7 @@ def addJobSubmitInfoToDagJobJDL(dagJdl, jobSubmit):
         'My.CRAB_MaxIdle',
         'My.CRAB_MaxPost',
         'My.CRAB_FailedNodeLimit',
+        'My.CRAB_TaskManagerServer',
         'My.CRAB_SaveLogsFlag',
         'My.CRAB_TransferOutputs',
         'My.CRAB_SiteBlacklist',
@@ -85,6 +85,7 @@ import json
 import uuid
 import pprint
 import signal
+import sqlite3
 import tarfile
 import logging
 import logging.handlers
@@ -111,6 +112,8 @@ from WMCore.DataStructs.LumiList import LumiList
 from TaskWorker import __version__
 from TaskWorker.Actions.RetryJob import RetryJob
 from TaskWorker.Actions.RetryJob import JOB_RETURN_CODES
+from TaskWorker.Actions import TransferStatusBroker
+from TaskWorker.Actions.TaskBookkeeping import TaskBookkeeping, DEFER_NUM, DOCS_IN_TRANSFER, RETRY_INFO, TASK_STATISTICS_JOBS
 from ServerUtilities import TRANSFERDB_STATES, PUBLICATIONDB_STATES
 from ServerUtilities import isFailurePermanent, mostCommon, encodeRequest, oracleOutputMapping
 from ServerUtilities import getLock, getHashLfn
@@ -371,6 +374,7 @@ class ASOServerJob():
         self.db_instance = db_instance
         self.rest_url = rest_host + '/crabserver/' + db_instance + '/'  # used in logging
         self.found_doc_in_db = False
+        self.bookkeeping = TaskBookkeeping()
         try:
             self.crabserver = CRABRest(self.rest_host, proxy, proxy, retry=2, userAgent='CRABSchedd')
             self.crabserver.setDbInstance(self.db_instance)
@@ -382,13 +386,12 @@ class ASOServerJob():
     # = = = = = ASOServerJob = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
     def save_docs_in_transfer(self):
-        """ The function is used to save into a file the documents we are transfering so
+        """ The function is used to save into the task bookkeeping the documents we are transfering so
             we do not have to query the DB to get this list every time the postjob is restarted.
         """
         try:
-            filename = 'transfer_info/docs_in_transfer.%s.%d.json' % (self.job_id, self.crab_retry)
-            with open(filename, 'w') as fd:
-                json.dump(self.docs_in_transfer, fd)
+            key = '%s.%d' % (self.job_id, self.crab_retry)
+            self.bookkeeping.put(DOCS_IN_TRANSFER, key, self.docs_in_transfer)
         except:
             #Only printing a generic message, the full stacktrace is printed in execute()
             self.logger.error("Failed to save the docs in transfer. Aborting the postjob")
@@ -397,12 +400,13 @@ class ASOServerJob():
     # = = = = = ASOServerJob = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
     def load_docs_in_transfer(self):
-        """ Function that loads the object saved as a json by save_docs_in_transfer
+        """ Function that loads the object saved by save_docs_in_transfer
         """
         try:
-            filename = 'transfer_info/docs_in_transfer.%s.%d.json' % (self.job_id, self.crab_retry)
-            with open(filename) as fd:
-                self.docs_in_transfer = json.load(fd)
+            key = '%s.%d' % (self.job_id, self.crab_retry)
+            self.docs_in_transfer = self.bookkeeping.get(DOCS_IN_TRANSFER, key)
+            if self.docs_in_transfer is None:
+                raise ValueError("No docs in transfer found for %s" % key)
         except Exception as ex:  # pylint: disable=broad-except
             #Only printing a generic message, the full stacktrace is printed in execute()
             self.logger.error("Failed to load the docs in transfer. Aborting the postjob")
@@ -420,9 +424,13 @@ class ASOServerJob():
         if first_pj_execution():
             self.logger.info("====== Starting to monitor ASO transfers.")
         try:
-            with getLock('get_transfers_statuses'):
-                # Get the transfer status in all documents listed in self.docs_in_transfer.
-                transfers_statuses = self.get_transfers_statuses()
+            if TransferStatusBroker.brokerIsAlive():
+                # the snapshot is replaced atomically by the broker, no need to lock
+                transfers_statuses = self.get_transfers_statuses_from_broker()
+            else:
+                with getLock('get_transfers_statuses'):
+                    # Get the transfer status in all documents listed in self.docs_in_transfer.
+                    transfers_statuses = self.get_transfers_statuses()
         except TransferCacheLoadError as e:
             self.logger.info("Error getting the status of the transfers. Deferring PJ. Got: %s" % e)
             return 4
@@ -998,7 +1006,8 @@ class ASOServerJob():
             #if not os.path.exists('task_process/rest_filetransfers.txt'):
                 restInfo = {'host': self.rest_host,
                             'dbInstance': self.db_instance,
-                            'proxyfile': os.path.basename(self.proxy)}
+                            'proxyfile': os.path.basename(self.proxy),
+                            'username': str(self.job_ad['CRAB_UserHN'])}
                 with open('task_process/RestInfoForFileTransfers.json', 'w') as fp:
                     json.dump(restInfo, fp)
         else:
@@ -1017,7 +1026,8 @@ class ASOServerJob():
             #if not os.path.exists('task_process/rest_filetransfers.txt'):
                 restInfo = {'host': self.rest_host,
                             'dbInstance': self.db_instance,
-                            'proxyfile': os.path.basename(self.proxy)}
+                            'proxyfile': os.path.basename(self.proxy),
+                            'username': str(self.job_ad['CRAB_UserHN'])}
                 with open('task_process/RestInfoForFileTransfers.json', 'w') as fp:
                     json.dump(restInfo, fp)
         return returnMsg
@@ -1128,6 +1138,23 @@ class ASOServerJob():
 
     # = = = = = ASOServerJob = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
+    def get_transfers_statuses_from_broker(self):
+        """
+        Retrieve the status of all transfers from the snapshot maintained by the
+        task transfer status broker. If the snapshot is older than the transfer
+        submission or misses some document, ask for a refresh and wait a bit for it.
+        """
+        doc_ids = [doc_info['doc_id'] for doc_info in self.docs_in_transfer]
+        aso_info = TransferStatusBroker.waitForSnapshot(doc_ids, self.aso_start_timestamp or 0,
+                                                        timeout=60, logger=self.logger)
+        if not aso_info:
+            msg = "Transfer status broker did not provide a snapshot with all documents in time. Deferring PJ."
+            raise TransferCacheLoadError(msg)
+        self.logger.debug("Using transfer statuses from broker snapshot taken at %s.", aso_info['query_timestamp'])
+        return [aso_info['results'][doc_id][0]['state'] for doc_id in doc_ids]
+
+    # = = = = = ASOServerJob = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
     def load_transfer_document(self, doc_id):
         """
         Wrapper to load a document from RDBMS, catching exceptions.
@@ -1356,6 +1383,10 @@ class PostJob():
         # number in self.dag_jobid.
         self.dag_clusterid       = None
         self.schedd = htcondor.Schedd()
+        # Per-task store for defer counters, retry counts, etc.
+        self.bookkeeping = TaskBookkeeping()
+        # False once the REST server rejected a bulk filemetadata upload
+        self.bulk_filemetadata = True
 
         # Set a logger for the post-job. Use a memory handler by default. Once we know
         # the name of the log file where all the logging should go, we will flush the
@@ -1377,44 +1408,16 @@ class PostJob():
 
     def get_defer_num(self):
 
-        DEFER_INFO_FILE = 'defer_info/defer_num.%s.%d.txt' % (self.job_id, self.dag_retry)
-        defer_num = 0
-
-        #read retry number
-        if os.path.exists(DEFER_INFO_FILE):
-            try:
-                with open(DEFER_INFO_FILE) as fd:
-                    line = fd.readline().strip()
-                    #Protect from empty files, see https://github.com/dmwm/CRABServer/issues/5199
-                    if line:
-                        defer_num = int(line)
-                    else:
-                        #if the line is empty we are sure it's the first try. See comment 10 lines below
-                        defer_num = 0
-            except IOError as e:
-                self.logger.error("I/O error(%d): %s", e.errno, e.strerror)
-                raise
-            except ValueError:
-                self.logger.error("Could not convert data to an integer.")
-                raise
-            except:
-                self.logger.exception("Unexpected error: %s", sys.exc_info()[0])
-                raise
-        else:
-            #create the file if it does not exist
-            with open(DEFER_INFO_FILE, 'w') as dummyFD:
-                pass
+        defer_key = '%s.%d' % (self.job_id, self.dag_retry)
 
-
-        #update retry number
+        #read and update the retry number in one transaction, the counter starts at 0
         try:
-            #open in rb+ mode instead of w so if the schedd crashes between the open and the write
-            #we do not end up with an empty (corrupted) file. (Well, this can only happens the first try)
-            with open(DEFER_INFO_FILE, 'r+') as fd:
-                #put some spaces to overwrite possibly longer numbers (should never happen, but..)
-                fd.write(str(defer_num + 1) + ' '*10)
-        except IOError as e:
-            self.logger.error("I/O error(%d): %s", e.errno, e.strerror)
+            defer_num = self.bookkeeping.increment(DEFER_NUM, defer_key)
+        except sqlite3.Error as e:
+            self.logger.error("Failed to update the defer number in the task bookkeeping: %s", e)
+            raise
+        except ValueError:
+            self.logger.error("Could not convert data to an integer.")
             raise
         except:
             self.logger.exception("Unexpected error: %s", sys.exc_info()[0])
@@ -2361,6 +2364,41 @@ class PostJob():
 
     # = = = = = PostJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
+    def upload_files_metadata(self, records):
+        """
+        Upload the metadata of many files with a single request to the filemetadata API.
+        Each record is a dictionary with the same parameters used to upload a single file,
+        with outfileruns, outfilelumis and inparentlfns as lists.
+        A REST server which does not know the filesmetadata parameter answers with a 400,
+        in that case the files are uploaded one by one as before.
+        """
+        rest_api = 'filemetadata'
+        if self.bulk_filemetadata:
+            msg = "Uploading metadata for %d files to https://%s" % (len(records), self.rest_url+rest_api)
+            self.logger.debug(msg)
+            try:
+                self.crabserver.put(api=rest_api, data=encodeRequest({'filesmetadata': json.dumps(records)}))
+                return
+            except HTTPException as hte:
+                if not hte.headers.get('X-Error-Http', -1) == '400':
+                    raise
+                msg = "Bulk upload of file metadata rejected: %s. Will upload one file at a time" % (str(hte.headers))
+                self.logger.warning(msg)
+                self.bulk_filemetadata = False
+        for record in records:
+            # make a real list of (k,v) pairs as rest_api requires, with one pair per list element
+            configreq = []
+            for key, value in record.items():
+                if isinstance(value, list):
+                    configreq.extend((key, item) for item in value)
+                else:
+                    configreq.append((key, value))
+            msg = "Uploading file metadata to https://%s: %s" % (self.rest_url+rest_api, configreq)
+            self.logger.debug(msg)
+            self.crabserver.put(api=rest_api, data=encodeRequest(configreq))
+
+    # = = = = = PostJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
     def upload_log_file_metadata(self):
         """
         Upload the logs archive file metadata.
@@ -2392,12 +2430,10 @@ class PostJob():
                      'outdatasetname'  : G_FAKE_OUTDATASET,
                      'directstageout'  : int(self.job_report.get('direct_stageout', 0))
                     }
-        rest_api = 'filemetadata'
-        msg = "Uploading file metadata for %s to https://%s: %s"
-        msg = msg % (self.logs_arch_file_name, self.rest_url+rest_api, configreq)
+        msg = "Uploading file metadata for %s" % self.logs_arch_file_name
         self.logger.debug(msg)
         try:
-            self.crabserver.put(api=rest_api, data=encodeRequest(configreq))
+            self.upload_files_metadata([configreq])
         except HTTPException as hte:
             msg = "Error uploading logs file metadata: %s" % (str(hte.headers))
             self.logger.error(msg)
@@ -2422,6 +2458,7 @@ class PostJob():
             self.logger.info("Skipping input filemetadata upload as no inputs were found")
             return
         direct_stageout = int(self.job_report.get('direct_stageout', 0))
+        records = []
         for ifile in self.job_report['steps']['cmsRun']['input']['source']:
             if ifile['input_source_class'] != 'PoolSource' or ifile.get('input_type', '') != "primaryFiles":
                 continue
@@ -2459,32 +2496,24 @@ class PostJob():
                          "outdatasetname"  : G_FAKE_OUTDATASET,
                          "directstageout"  : direct_stageout
                         }
-            #TODO: there could be a better py3 way to get lists of outfileruns/lumis
-            outfileruns = []
-            outfilelumis = []
+            configreq['outfileruns'] = []
+            configreq['outfilelumis'] = []
             for run, lumis in ifile['runs'].items():
-                outfileruns.append(str(run))
-                outfilelumis.append(','.join(map(str, lumis)))
-
-            # make a real list of (k,v) pairs as rest_api requires (not sure pylint is right to complain !)
-            configreq = [item for item in configreq.items()]  # pylint: disable=unnecessary-comprehension
-            #configreq['outfileruns'] = [run for run in outfileruns]
-            #configreq['outfilelumis'] = [lumis for lumis in outfilelumis]
-            for run in outfileruns:
-                configreq.append(("outfileruns", run))
-            for lumis in outfilelumis:
-                configreq.append(("outfilelumis", lumis))
-
-            rest_api = 'filemetadata'
-            msg = "Uploading input metadata for %s to https://%s: %s" % (lfn, self.rest_url+rest_api, configreq)
-            self.logger.debug(msg)
-            try:
-                self.crabserver.put(api=rest_api, data=encodeRequest(configreq))
-            except HTTPException as hte:
-                msg = "HTTP Error uploading input file metadata: %s" % (str(hte.headers))
-                self.logger.error(msg)
-                raise
-            self.logger.info("====== Finished upload of input files metadata.")
+                configreq['outfileruns'].append(str(run))
+                configreq['outfilelumis'].append(','.join(map(str, lumis)))
+            records.append(configreq)
+
+        if not records:
+            return
+        msg = "Uploading input metadata for %d files" % len(records)
+        self.logger.debug(msg)
+        try:
+            self.upload_files_metadata(records)
+        except HTTPException as hte:
+            msg = "HTTP Error uploading input file metadata: %s" % (str(hte.headers))
+            self.logger.error(msg)
+            raise
+        self.logger.info("====== Finished upload of input files metadata.")
 
     # = = = = = PostJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -2496,6 +2525,7 @@ class PostJob():
         if os.environ.get('TEST_POSTJOB_NO_STATUS_UPDATE', False):
             return
         output_datasets = set()
+        records = []
         for file_info in self.output_files_info:
             outdataset = file_info['output_dataset']
             if not 'FakeDataset' in outdataset:
@@ -2525,34 +2555,30 @@ class PostJob():
                          'directstageout'  : int(file_info['direct_stageout']),
                          'globalTag'       : 'None'
                         }
-            # make a real list of (k,v) pairs as rest_api requires (not sure pylint is rigth to complain !)
-            configreq = [item for item in configreq.items()]  # pylint: disable=unnecessary-comprehension
-            #configreq = configreq.items()
             if 'outfileruns' in file_info:
-                for run in file_info['outfileruns']:
-                    configreq.append(("outfileruns", run))
+                configreq['outfileruns'] = list(file_info['outfileruns'])
             if 'outfilelumis' in file_info:
-                for lumis in file_info['outfilelumis']:
-                    configreq.append(("outfilelumis", lumis))
+                configreq['outfilelumis'] = list(file_info['outfilelumis'])
             if 'inparentlfns' in file_info:
-                for lfn in file_info['inparentlfns']:
-                    # If the user specified a PFN as input, then the LFN is an empty string
-                    # and does not pass validation.
-                    if lfn:
-                        configreq.append(("inparentlfns", lfn))
+                # If the user specified a PFN as input, then the LFN is an empty string
+                # and does not pass validation.
+                configreq['inparentlfns'] = [lfn for lfn in file_info['inparentlfns'] if lfn]
             filename = file_info['pfn'].split('/')[-1]
-            rest_api = 'filemetadata'
-            msg = "Uploading output metadata for %s to https://%s: %s" % (filename, self.rest_url+rest_api, configreq)
+            msg = "Adding output metadata for %s: %s" % (filename, configreq)
             self.logger.debug(msg)
-            try:
-                self.crabserver.put(api=rest_api, data=encodeRequest(configreq))
-            except HTTPException as hte:
-                # BrianB. Suppressing this exception is a tough decision.
-                # If the file made it back alright, I suppose we can proceed.
-                msg = "HTTP Error uploading output file metadata: %s" % (str(hte.headers))
-                self.logger.error(msg)
-                raise
-            self.logger.info("====== Finished upload of output files metadata.")
+            records.append(configreq)
+
+        if not records:
+            return
+        try:
+            self.upload_files_metadata(records)
+        except HTTPException as hte:
+            # BrianB. Suppressing this exception is a tough decision.
+            # If the file made it back alright, I suppose we can proceed.
+            msg = "HTTP Error uploading output file metadata: %s" % (str(hte.headers))
+            self.logger.error(msg)
+            raise
+        self.logger.info("====== Finished upload of output files metadata.")
 
     # = = = = = PostJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -2981,38 +3007,26 @@ class PostJob():
         """
         Calculate the retry number we're on. See the notes in PreJob.
         """
-        fname = "retry_info/job.%s.txt" % (self.job_id)
-        if os.path.exists(fname):
-            try:
-                with open(fname, 'r') as fd:
-                    retry_info = json.load(fd)
-            except Exception:
-                msg = "Unable to calculate post-job retry count."
-                msg += " Failed to load file %s." % (fname)
-                msg += "\nDetails follow:"
-                self.logger.exception(msg)
-                return 1, None
-        else:
-            retry_info = {'pre': 0, 'post': 0}
-        if 'pre' not in retry_info or 'post' not in retry_info:
+        crab_retry = None
+        try:
+            with self.bookkeeping.transaction():
+                retry_info = self.bookkeeping.get(RETRY_INFO, self.job_id, {'pre': 0, 'post': 0})
+                if 'pre' not in retry_info or 'post' not in retry_info:
+                    msg = "Unable to calculate post-job retry count."
+                    msg += " The retry info of job %s doesn't contain the expected information." % (self.job_id)
+                    self.logger.warning(msg)
+                    return 1, None
+                if not first_pj_execution():
+                    return 0, retry_info['post'] - 1
+                crab_retry = retry_info['post']
+                retry_info['post'] += 1
+                self.bookkeeping.put(RETRY_INFO, self.job_id, retry_info)
+        except Exception:
             msg = "Unable to calculate post-job retry count."
-            msg += " File %s doesn't contain the expected information." % (fname)
-            self.logger.warning(msg)
-            return 1, None
-        if first_pj_execution():
-            crab_retry = retry_info['post']
-            retry_info['post'] += 1
-            try:
-                with open(fname + '.tmp', 'w') as fd:
-                    json.dump(retry_info, fd)
-                os.rename(fname + '.tmp', fname)
-            except Exception:
-                msg = "Failed to update file %s with increased post-job count by +1." % (fname)
-                msg += "\nDetails follow:"
-                self.logger.exception(msg)
-                return 1, crab_retry
-        else:
-            crab_retry = retry_info['post'] - 1
+            msg += " Failed to load or update the retry info of job %s." % (self.job_id)
+            msg += "\nDetails follow:"
+            self.logger.exception(msg)
+            return 1, crab_retry
         return 0, crab_retry
 
     # = = = = = PostJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -3079,14 +3093,10 @@ class PostJob():
 
     def check_abort_dag(self, rval):
         """
-        For each job that failed with a fatal error, its id is written into the file
-        task_statistics.FATAL_ERROR. For each job that didn't fail with a fatal or
-        recoverable error, its id is written into the file task_statistics.OK.
-        Notice that these files may contain repeated job ids.
-        Based on these statistics we may decide to abort the whole DAG.
+        For each job that failed with a fatal error or that didn't fail with a fatal or
+        recoverable error, RetryJob counts its id in the task bookkeeping (each job id
+        only once per state). Based on these statistics we may decide to abort the whole DAG.
         """
-        file_name_jobs_fatal = "task_statistics.FATAL_ERROR"
-        file_name_jobs_ok = "task_statistics.OK"
         # Return code 3 is reserved to abort the entire DAG. Don't let the code
         # otherwise use it.
         if rval == 3:
@@ -3095,18 +3105,11 @@ class PostJob():
             return rval
         try:
             limit = int(self.job_ad['CRAB_FailedNodeLimit'])
-            fatal_failed_jobs = []
-            with open(file_name_jobs_fatal, 'r') as fd:
-                for job_id in fd.readlines():
-                    if job_id not in fatal_failed_jobs:
-                        fatal_failed_jobs.append(job_id)
-            num_fatal_failed_jobs = len(fatal_failed_jobs)
-            successful_jobs = []
-            with open(file_name_jobs_ok, 'r') as fd:
-                for job_id in fd.readlines():
-                    if job_id not in successful_jobs:
-                        successful_jobs.append(job_id)
-            num_successful_jobs = len(successful_jobs)
+            num_fatal_failed_jobs = self.bookkeeping.get(TASK_STATISTICS_JOBS, 'FATAL_ERROR')
+            num_successful_jobs = self.bookkeeping.get(TASK_STATISTICS_JOBS, 'OK')
+            # as before, no decision until there is at least one job in each state
+            if num_fatal_failed_jobs is None or num_successful_jobs is None:
+                return rval
             if (num_successful_jobs + num_fatal_failed_jobs) > limit:
                 if num_fatal_failed_jobs > num_successful_jobs:
                     msg = "There are %d (fatal) failed nodes and %d successful nodes,"
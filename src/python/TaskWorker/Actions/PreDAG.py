@@ -36,7 +36,7 @@ from ast import literal_eval
 
 from WMCore.DataStructs.LumiList import LumiList
 
-from ServerUtilities import getLock, newX509env, MAX_IDLE_JOBS, MAX_POST_JOBS, uploadToS3
+from ServerUtilities import getLock, newX509env, MAX_IDLE_JOBS, MAX_POST_JOBS, uploadToS3, JOB_WRAPPER_INPUTS_INDEX
 from RESTInteractions import CRABRest
 from RucioUtils import getNativeRucioClient
 from CRABUtils.Utils import addToGZippedTarfile
@@ -328,7 +328,10 @@ class PreDAG():
             return 1
         self.saveProcessedJobs(unprocessed)
 
-        addToGZippedTarfile(['CMSRunAnalysis.tar.gz'], 'InputFiles.tar.gz')
+        # CMSRunAnalysis.tar.gz is not changed by DagmanCreator, only add the new job wrapper inputs
+        with open(JOB_WRAPPER_INPUTS_INDEX, 'r', encoding='utf-8') as fd:
+            bundles = sorted(set(json.load(fd).values()))
+        addToGZippedTarfile([JOB_WRAPPER_INPUTS_INDEX] + bundles, 'InputFiles.tar.gz')
         uploadToS3(crabserver=self.crabserver, filepath='InputFiles.tar.gz',
                    objecttype='runtimefiles', taskname=task['tm_taskname'],
                    logger=self.logger)
@@ -14,11 +14,17 @@ import logging
 from ast import literal_eval
 
 from ServerUtilities import getWebdirForDb, insertJobIdSid, pythonListToClassAdExprTree, getLock, MAX_MEMORY_AUTOMATIC_RESUBMIT, MAX_JOB_RUNTIME_AUTOMATIC_RESUBMIT
+from ServerUtilities import JOB_WRAPPER_INPUTS_INDEX
 from TaskWorker.Actions.RetryJob import JOB_RETURN_CODES
+from TaskWorker.Actions.TaskBookkeeping import TaskBookkeeping, RETRY_INFO, TASK_STATISTICS
 
 import htcondor2 as htcondor
 import classad2 as classad
 
+JOB_SUBMIT_FILE = "Job.submit"
+# Job.submit parsed by the first pre-job, see load_submit_template
+JOB_SUBMIT_CACHE_FILE = "Job.submit.cache.json"
+
 
 class PreJob:
     """
@@ -40,6 +46,7 @@ class PreJob:
         self.logger = logging.getLogger()
         self.rrn           = None
         self.reuse_rrn     = False
+        self.bookkeeping   = TaskBookkeeping()
 
 
     def calculate_crab_retry(self):
@@ -53,18 +60,23 @@ class PreJob:
         restarted before the post-job was run and after the job completed.
         """
         retmsg = ""
+        try:
+            ## Read and update the retry_info in one transaction, so that it can not change
+            ## in between.
+            with self.bookkeeping.transaction():
+                crab_retry, retmsg = self.update_retry_info(retmsg)
+        except Exception:
+            retmsg += "\n\tFailed to load or save the retry_info of job %s" % (self.job_id)
+            retmsg += "\n\tWill use DAGMan retry number (%s)" % (self.dag_retry)
+            return self.dag_retry, retmsg
+        return crab_retry, retmsg
+
+    def update_retry_info(self, retmsg):
+        """
+        Do the work of calculate_crab_retry. Must be called in a bookkeeping transaction.
+        """
         ## Load the retry_info.
-        retry_info_file_name = "retry_info/job.%s.txt" % (self.job_id)
-        if os.path.exists(retry_info_file_name):
-            try:
-                with open(retry_info_file_name, 'r', encoding='utf-8') as fd:
-                    retry_info = json.load(fd)
-            except Exception:
-                retmsg += "\n\tFailed to load file %s" % (retry_info_file_name)
-                retmsg += "\n\tWill use DAGMan retry number (%s)" % (self.dag_retry)
-                return self.dag_retry, retmsg
-        else:
-            retry_info = {'pre': 0, 'post': 0}
+        retry_info = self.bookkeeping.get(RETRY_INFO, self.job_id, {'pre': 0, 'post': 0})
 
         retmsg += "\n\tLoaded retry_info = %s" % (retry_info)
 
@@ -118,15 +130,13 @@ class PreJob:
                 retry_info['pre'] = retry_info['post'] + 1
                 retmsg += "\n\tUpdated retry_info = %s" % (retry_info)
 
-        ## Save the retry_info dictionary to file.
-        retmsg += "\n\tSaving retry_info = %s to %s" % (retry_info, retry_info_file_name)
+        ## Save the retry_info dictionary.
+        retmsg += "\n\tSaving retry_info = %s" % (retry_info)
         try:
-            with open(retry_info_file_name + ".tmp", 'w', encoding='utf-8') as fd:
-                json.dump(retry_info, fd)
-            os.rename(retry_info_file_name + ".tmp", retry_info_file_name)
-            retmsg += "\n\tSuccessfully saved %s" % (retry_info_file_name)
+            self.bookkeeping.put(RETRY_INFO, self.job_id, retry_info)
+            retmsg += "\n\tSuccessfully saved retry_info"
         except Exception:
-            retmsg += "\n\tFailed to save %s" % (retry_info_file_name)
+            retmsg += "\n\tFailed to save retry_info"
 
         return crab_retry, retmsg
 
@@ -237,10 +247,7 @@ class PreJob:
         results = {}
         try:
             for state in JOB_RETURN_CODES._fields:
-                count = 0
-                with open("task_statistics.%s" % (state), 'r', encoding='utf-8') as fd:
-                    count = len(fd.read().split(b'\n')) - 1
-                results[state] = count
+                results[state] = self.bookkeeping.get(TASK_STATISTICS, state, 0)
         except Exception:
             return {}
         return results
@@ -253,10 +260,7 @@ class PreJob:
         results = {}
         try:
             for state in JOB_RETURN_CODES._fields:
-                count = 0
-                with open("task_statistics.%s.%s" % (site, state), 'r', encoding='utf-8') as fd:
-                    count = len(fd.read().split(b'\n')) - 1
-                results[state] = count
+                results[state] = self.bookkeeping.get(TASK_STATISTICS, "%s.%s" % (site, state), 0)
         except Exception:
             return {}
         return results
@@ -269,7 +273,7 @@ class PreJob:
         (e.g. MaxWallTimeMins, RequestMemory, RequestCores, JobPrio, DESIRED_SITES).
         """
         ## Start the Job.<job_id>.submit content with the CRAB_Retry.
-        newJobSubmit = htcondor.Submit()
+        newJobSubmit = {}
         msg = "Setting CRAB_Retry = %s" % (crab_retry)
         self.logger.info(msg)
         newJobSubmit['My.CRAB_Retry'] = str(crab_retry)
@@ -402,18 +406,62 @@ class PreJob:
         if os.path.isfile('TOKEN_OK'):
             newJobSubmit['use_oauth_services'] = 'cms_crab'
 
-        ## Finally read in the content of the generic Job.submit file as a string
-        with open("Job.submit", 'r', encoding='utf-8') as fd:
-            jobSubmitFileContent = fd.read()
-        ## and turn it into a submit object
-        jobSubmit = htcondor.Submit(jobSubmitFileContent)
-        # add modifications and additions
+        ## Finally get the content of the generic Job.submit file
+        jobSubmit = self.load_submit_template()
+        ## Jobs created by PreDAG (automatic splitting) also need the job wrapper
+        ## inputs bundle of the stage which created them.
+        bundle = self.get_job_wrapper_inputs_bundle()
+        if bundle:
+            transfer_input_files = dict((k.lower(), v) for k, v in jobSubmit)['transfer_input_files']
+            newJobSubmit['transfer_input_files'] = "%s, %s" % (transfer_input_files, bundle)
+        # add modifications and additions. Submit commands are case insensitive
+        positions = {key.lower(): i for i, (key, _) in enumerate(jobSubmit)}
         for k, v in newJobSubmit.items():
-            jobSubmit[k] = v
-        ## Write the Job.<job_id>.submit file. the htcondor.Submit streaming method will take
-        ## care of putting 'queue' statement at the enbd
+            if k.lower() in positions:
+                jobSubmit[positions[k.lower()]][1] = v
+            else:
+                jobSubmit.append([k, v])
+        ## Write the Job.<job_id>.submit file, with the 'queue' statement at the end
+        ## as the htcondor.Submit streaming method does
         with open("Job.%s.submit" % (self.job_id), 'w', encoding='utf-8') as fd:
-            print(jobSubmit, file=fd)
+            for k, v in jobSubmit:
+                fd.write("%s = %s\n" % (k, v))
+            fd.write("queue\n")
+
+    def get_job_wrapper_inputs_bundle(self):
+        """
+        Return the name of the job wrapper inputs bundle for this job, or None
+        if the job uses those in CMSRunAnalysis.tar.gz
+        """
+        if not os.path.exists(JOB_WRAPPER_INPUTS_INDEX):
+            return None
+        with open(JOB_WRAPPER_INPUTS_INDEX, 'r', encoding='utf-8') as fd:
+            return json.load(fd).get(str(self.job_id))
+
+    def load_submit_template(self):
+        """
+        Return the commands in the generic Job.submit file as a list of [key, value].
+        Job.submit is the same for all jobs of the task, so it is parsed by htcondor
+        only by the first pre-job, which saves the result in JOB_SUBMIT_CACHE_FILE.
+        """
+        stat = os.stat(JOB_SUBMIT_FILE)
+        signature = [stat.st_mtime, stat.st_size]
+        try:
+            with open(JOB_SUBMIT_CACHE_FILE, 'r', encoding='utf-8') as fd:
+                cache = json.load(fd)
+            if cache['signature'] == signature:
+                return cache['commands']
+        except (IOError, ValueError, KeyError):
+            pass
+        self.logger.info("Parsing %s and caching it in %s", JOB_SUBMIT_FILE, JOB_SUBMIT_CACHE_FILE)
+        with open(JOB_SUBMIT_FILE, 'r', encoding='utf-8') as fd:
+            jobSubmitFileContent = fd.read()
+        commands = [[k, v] for k, v in htcondor.Submit(jobSubmitFileContent).items()]
+        tmp_file_name = "%s.%d" % (JOB_SUBMIT_CACHE_FILE, os.getpid())
+        with open(tmp_file_name, 'w', encoding='utf-8') as fd:
+            json.dump({'signature': signature, 'commands': commands}, fd)
+        os.rename(tmp_file_name, JOB_SUBMIT_CACHE_FILE)
+        return commands
 
     def redoSites(self, crab_retry, use_resubmit_info):
         """
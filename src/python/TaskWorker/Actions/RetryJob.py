@@ -2,6 +2,7 @@ import os
 import re
 import sys
 import json
+import sqlite3
 import shutil
 import subprocess
 import socket
@@ -9,8 +10,9 @@ import time
 import datetime
 from collections import namedtuple
 from ast import literal_eval
-from ServerUtilities import executeCommand, getLock
+from ServerUtilities import executeCommand
 from ServerUtilities import MAX_DISK_SPACE, MAX_WALLTIME, MAX_MEMORY
+from TaskWorker.Actions.TaskBookkeeping import TaskBookkeeping, BAD_INPUT_FILE_COUNT, JOB_OUT_SUMMARY
 
 import classad2 as classad
 
@@ -66,6 +68,12 @@ NOT_FILE_RELATED_FATAL_ROOT_ERRORS = [
     "already deleted (list name = TList)",
 ]
 
+# lines in job stdout looked for by the retry policy handlers, see scan_job_out
+SIGILL_LINE_PREFIX = "== CMSSW:  A fatal system signal has occurred: illegal instruction"
+CVMFS_ISSUE_RE = re.compile(r"== CMSSW:  unable to load /cvmfs/.*file too short")
+# max number of lines of the fatal exception message kept from job stdout
+MAX_FATAL_EXCEPTION_LINES = 500
+
 # Without this environment variable set, HTCondor takes a write lock per logfile entry
 os.environ['_condor_ENABLE_USERLOG_LOCKING'] = 'false'
 
@@ -105,6 +113,7 @@ class RetryJob():
         self.report = {}
         self.validreport = True
         self.integrated_job_time = 0
+        self.job_out_summary = None
 
         self.MAX_DISK_SPACE = MAX_DISK_SPACE
         self.MAX_WALLTIME = MAX_WALLTIME
@@ -201,12 +210,7 @@ class RetryJob():
         """
         recoverable_signal = False
         try:
-            fname = os.path.realpath("WEB_DIR/job_out.%s.%d.txt" % (self.job_id, self.crab_retry))
-            with open(fname, encoding='utf-8') as fd:
-                for line in fd:
-                    if line.startswith("== CMSSW:  A fatal system signal has occurred: illegal instruction"):
-                        recoverable_signal = True
-                        break
+            recoverable_signal = self.get_job_out_summary(['sigill'])['sigill']
         except Exception:  # pylint: disable=broad-except
             msg = "Error analyzing abort signal.\nDetails follow:"
             self.logger.exception(msg)
@@ -224,13 +228,7 @@ class RetryJob():
         """
         cvmfs_issue = False
         try:
-            fname = os.path.relpath("WEB_DIR/job_out.%s.%d.txt" % (self.job_id, self.crab_retry))
-            cvmfs_issue_re = re.compile(r"== CMSSW:  unable to load /cvmfs/.*file too short")
-            with open(fname, encoding='utf-8') as fd:
-                for line in fd:
-                    if cvmfs_issue_re.match(line):
-                        cvmfs_issue = True
-                        break
+            cvmfs_issue = self.get_job_out_summary(['cvmfsIssue'])['cvmfsIssue']
         except Exception:  # pylint: disable=broad-except
             msg = "Error analyzing output for CVMFS issues.\nDetails follow:"
             self.logger.exception(msg)
@@ -319,14 +317,7 @@ class RetryJob():
             if code == job_status:
                 job_status_name = name
         try:
-            with os.fdopen(os.open("task_statistics.%s.%s" % (self.site, job_status_name), os.O_APPEND | os.O_CREAT | os.O_RDWR, 0o644), 'a') as fd:
-                fd.write("%s\n" % (self.job_id))
-        except Exception as ex:  # pylint: disable=broad-except
-            self.logger.error(str(ex))
-            # Swallow the exception - record_site is advisory only
-        try:
-            with os.fdopen(os.open("task_statistics.%s" % (job_status_name), os.O_APPEND | os.O_CREAT | os.O_RDWR, 0o644), 'a') as fd:
-                fd.write("%s\n" % (self.job_id))
+            TaskBookkeeping().recordJobResult(self.job_id, job_status_name, self.site)
         except Exception as ex:  # pylint: disable=broad-except
             self.logger.error(str(ex))
             # Swallow the exception - record_site is advisory only
@@ -480,27 +471,17 @@ class RetryJob():
         truncatedFile = False
         corruptedFile = False
         suspiciousFile = False
-        fatalLine = False
-        inputFileName = 'NotAvailable'
         errorLines = []
         RSE = self.site
         RSE = RSE if not RSE.startswith('T1') else f"{RSE}_Disk"
-        fname = os.path.realpath("WEB_DIR/job_out.%s.%d.txt" % (self.job_id, self.crab_retry))
-        self.logger.debug(f'exit code {exitCode}, look for corrupted file in {fname}')
-        with open(fname, encoding='utf-8') as fd:
-            for line in fd:
-                line = line.rstrip()  # remove trailing new-line
-                # remember last opened file, in case of 8021 that's the one that matters
-                if line.startswith("== CMSSW:") and ' Successfully opened file' in line:
-                    inputFileName = f"/store/{line.split('/store/')[1]}"  # strip protocol part
-                # extract the Exception message
-                if fatalLine:
-                    fatalExceptionLines.append(line)
-                if line.startswith("== CMSSW:") and " ----- Begin Fatal Exception" in line:
-                    fatalExceptionLines = []
-                    fatalLine = True
-                if  line.startswith("== CMSSW:") and " ----- End Fatal Exception" in line:
-                    break
+        self.logger.debug(f'exit code {exitCode}, look for corrupted file in job stdout')
+        summary = self.get_job_out_summary(['lastOpenedFile', 'fatalExceptionLines'])
+        # in case of 8021 the last opened file is the one that matters
+        inputFileName = summary['lastOpenedFile'] or 'NotAvailable'
+        fatalExceptionLines = summary['fatalExceptionLines']
+        if fatalExceptionLines is None:
+            self.logger.info("No fatal exception found in job stdout")
+            return False
         # parse fatal exception text
         for line in fatalExceptionLines:
             for falsePositive in NOT_FILE_RELATED_FATAL_ROOT_ERRORS:
@@ -545,6 +526,102 @@ class RetryJob():
 
     # = = = = = RetryJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
+    def get_job_out_summary(self, fields):
+        """
+        Return what the checks need from the stdout of this job retry, see scan_job_out.
+        :param fields: the keys of the summary needed by the caller
+        The job stdout can be tens of MB, so it is read at most once for each check and only
+        as far as needed: the summary is kept in the task bookkeeping, where it is also found
+        if the post-job runs again, and a later check only reads the file again if it needs
+        a field which the previous scans did not look for.
+        """
+        fname = os.path.realpath("WEB_DIR/job_out.%s.%d.txt" % (self.job_id, self.crab_retry))
+        summary = self.job_out_summary
+        if summary is None:
+            fileStat = os.stat(fname)
+            signature = [fileStat.st_size, fileStat.st_mtime]
+            summary = TaskBookkeeping().get(JOB_OUT_SUMMARY, "%s.%d" % (self.job_id, self.crab_retry))
+            if summary and (summary['signature'] != signature or 'fields' not in summary):
+                summary = None
+        if not summary or not set(fields) <= set(summary['fields']):
+            # also look again for what is known already, so that all of it is kept
+            wanted = set(fields) | set(summary['fields'] if summary else [])
+            fileStat = os.stat(fname)
+            summary = self.scan_job_out(fname, wanted)
+            summary['signature'] = [fileStat.st_size, fileStat.st_mtime]
+            try:
+                TaskBookkeeping().put(JOB_OUT_SUMMARY, "%s.%d" % (self.job_id, self.crab_retry), summary)
+            except sqlite3.Error as ex:
+                self.logger.warning(f"Could not save summary of {fname}: {ex}")
+        self.job_out_summary = summary
+        return summary
+
+    # = = = = = RetryJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+    @staticmethod
+    def scan_job_out(fname, fields):
+        """
+        read job stdout in one pass and extract:
+          lastOpenedFile: the last input file opened before the end of the first fatal exception
+          fatalExceptionLines: the lines of the first fatal exception message, None if there is none
+          sigill: True if cmsRun got a SIGILL
+          cvmfsIssue: True if cmsRun failed to load a truncated file from CVMFS
+        stops reading as soon as the values of the requested fields are known:
+        after the end of the first fatal exception for lastOpenedFile and fatalExceptionLines,
+        at the first matching line for sigill and cvmfsIssue.
+        The 'fields' key of the returned summary lists the fields whose value is known,
+        all of them if the whole file was read.
+        """
+        summary = {'lastOpenedFile': None, 'fatalExceptionLines': None, 'sigill': False, 'cvmfsIssue': False}
+        wanted = set(fields)
+        fatalLine = False
+        fatalDone = False
+        with open(fname, encoding='utf-8', errors='replace') as fd:
+            for line in fd:
+                line = line.rstrip()  # remove trailing new-line
+                if line.startswith(SIGILL_LINE_PREFIX):
+                    summary['sigill'] = True
+                    wanted.discard('sigill')
+                if CVMFS_ISSUE_RE.match(line):
+                    summary['cvmfsIssue'] = True
+                    wanted.discard('cvmfsIssue')
+                if not wanted:
+                    break
+                if fatalDone:
+                    continue
+                if not line.startswith("== CMSSW:"):
+                    if fatalLine and len(summary['fatalExceptionLines']) < MAX_FATAL_EXCEPTION_LINES:
+                        summary['fatalExceptionLines'].append(line)
+                    continue
+                # remember last opened file
+                if ' Successfully opened file' in line:
+                    summary['lastOpenedFile'] = f"/store/{line.split('/store/')[1]}"  # strip protocol part
+                # extract the Exception message
+                if fatalLine and len(summary['fatalExceptionLines']) < MAX_FATAL_EXCEPTION_LINES:
+                    summary['fatalExceptionLines'].append(line)
+                if " ----- Begin Fatal Exception" in line:
+                    summary['fatalExceptionLines'] = []
+                    fatalLine = True
+                if " ----- End Fatal Exception" in line:
+                    fatalDone = True
+                    wanted -= {'lastOpenedFile', 'fatalExceptionLines'}
+                    if not wanted:
+                        break
+            else:
+                # read the whole file, everything is known
+                fields = list(summary)
+        known = set(fields)
+        if fatalDone:
+            known |= {'lastOpenedFile', 'fatalExceptionLines'}
+        if summary['sigill']:
+            known.add('sigill')
+        if summary['cvmfsIssue']:
+            known.add('cvmfsIssue')
+        summary['fields'] = sorted(known)
+        return summary
+
+    # = = = = = RetryJob = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
     def reportBadInputFile(self, corruptedFile, truncatedFile, suspiciousFile, corruptionMessage):
         """
         report bad file via a file on EOS
@@ -556,21 +633,16 @@ class RetryJob():
         if username == 'sciaba':
             return
         # count reports for this task, too many indicates software error, not bad file(s)
-        fname = 'BadInputFileCount.json'
-        with getLock(fname):  # use lock to avoid races with concurrent PostJobs
-            if os.path.exists(fname):
-                with open(fname, 'r', encoding='utf-8') as fp:
-                    count = json.load(fp)
-            else:
-                count = {'corrupted': 0, 'truncated': 0, 'suspicious': 0}
+        bookkeeping = TaskBookkeeping()
+        with bookkeeping.transaction():  # avoid races with concurrent PostJobs
+            count = bookkeeping.get(BAD_INPUT_FILE_COUNT, 'task', {'corrupted': 0, 'truncated': 0, 'suspicious': 0})
             if corruptedFile:
                 count['corrupted'] += 1
             if truncatedFile:
                 count['truncated'] += 1
             else:
                 count['suspicious'] += 1
-            with open(fname, 'w', encoding='utf-8') as fp:
-                json.dump(count, fp)
+            bookkeeping.put(BAD_INPUT_FILE_COUNT, 'task', count)
         # always report truncated files. Other only up to 30 per task (beware false positives)
         if not truncatedFile and \
                 ( (corruptedFile and count['corrupted'] < 30) \
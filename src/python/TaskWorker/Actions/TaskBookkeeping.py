@@ -0,0 +1,204 @@
+"""
+Per-task bookkeeping store for the DAGMan scripts (PreJob, PostJob, RetryJob).
+
+PreJob and PostJob used to keep their state in many small files in the task spool
+directory (one defer counter per job retry, one list of transfer documents per job
+retry, one retry_info file per job, ...). For large tasks this means hundreds of
+thousands of tiny files and a lot of open/write/rename traffic on the schedd.
+All those documents are now kept in one SQLite database in WAL mode, which allows
+concurrent readers while one writer updates it. Read-modify-write sequences
+(e.g. counters) are done inside an exclusive transaction, which replaces the
+lock files used before.
+
+Documents are JSON values identified by (kind, key). For tasks which started with
+the file based bookkeeping, a document which is not in the database yet is read
+from its legacy file, so the switch can happen while the task is running. The
+first update stores it in the database, which is used from then on.
+"""
+import os
+import json
+import sqlite3
+from contextlib import contextmanager
+
+DB_FILE = 'task_bookkeeping.db'
+# seconds to wait for another process to release the write lock
+BUSY_TIMEOUT = 600
+
+DEFER_NUM = 'defer_num'
+DOCS_IN_TRANSFER = 'docs_in_transfer'
+RETRY_INFO = 'retry_info'
+BAD_INPUT_FILE_COUNT = 'bad_input_file_count'
+# number of job results recorded by RetryJob, key is <state> or <site>.<state>
+TASK_STATISTICS = 'task_statistics'
+# number of distinct job ids with a result recorded, key is <state>
+TASK_STATISTICS_JOBS = 'task_statistics_jobs'
+# marks the job ids counted in TASK_STATISTICS_JOBS, key is <state>.<job_id>
+TASK_STATISTICS_JOB = 'task_statistics_job'
+STATISTICS_KINDS = [TASK_STATISTICS, TASK_STATISTICS_JOBS, TASK_STATISTICS_JOB]
+# what RetryJob found in the stdout of a job, key is <job_id>.<crab_retry>
+JOB_OUT_SUMMARY = 'job_out_summary'
+
+
+def readLegacyFile(fileName):
+    """
+    :return: the content of a file, or None if the file does not exist
+    """
+    if not os.path.exists(fileName):
+        return None
+    with open(fileName, 'r', encoding='utf-8') as fd:
+        return fd.read()
+
+
+def loadLegacyDeferNum(key):
+    content = readLegacyFile('defer_info/defer_num.%s.txt' % key)
+    if content is None:
+        return None
+    # the counter was written padded with spaces, an empty file means first try
+    content = content.strip()
+    return int(content) if content else 0
+
+
+def loadLegacyJson(fileName):
+    content = readLegacyFile(fileName)
+    return None if content is None else json.loads(content)
+
+
+def loadLegacyStatisticsIds(state):
+    """
+    :return: the job ids, one per line, appended by RetryJob to task_statistics.<state>
+    """
+    content = readLegacyFile('task_statistics.%s' % state)
+    return None if content is None else content.splitlines()
+
+
+def loadLegacyStatisticsCount(key):
+    jobIds = loadLegacyStatisticsIds(key)
+    return None if jobIds is None else len(jobIds)
+
+
+# how to read each kind of document from the file where it was stored before,
+# relative to the spool directory
+LEGACY_LOADERS = {
+    DEFER_NUM: loadLegacyDeferNum,
+    DOCS_IN_TRANSFER: lambda key: loadLegacyJson('transfer_info/docs_in_transfer.%s.json' % key),
+    RETRY_INFO: lambda key: loadLegacyJson('retry_info/job.%s.txt' % key),
+    BAD_INPUT_FILE_COUNT: lambda key: loadLegacyJson('BadInputFileCount.json'),
+    TASK_STATISTICS: loadLegacyStatisticsCount,
+    # TASK_STATISTICS_JOBS and TASK_STATISTICS_JOB are migrated together in recordJobResult
+}
+
+
+class TaskBookkeeping():
+    """
+    Transactional key/value store of JSON documents for one task
+    """
+    def __init__(self, dbFile=DB_FILE):
+        self.dbFile = dbFile
+        self.conn = None
+        self.inTransaction = False
+
+    def connection(self):
+        """
+        open the database the first time it is needed, creating it if needed
+        """
+        if self.conn is None:
+            # isolation_level=None: transactions are only started explicitly in transaction()
+            conn = sqlite3.connect(self.dbFile, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS documents "
+                         "(kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (kind, key))")
+            self.conn = conn
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the write lock of the database for a read-modify-write sequence.
+        Everything done in the with block is committed at the end, or rolled back
+        if an exception is raised. Nested calls join the outer transaction.
+        """
+        if self.inTransaction:
+            yield self
+            return
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        self.inTransaction = True
+        try:
+            yield self
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self.inTransaction = False
+
+    def get(self, kind, key, default=None):
+        """
+        :return: the document, from the database or from its legacy file,
+                 or default if it does not exist
+        """
+        row = self.connection().execute("SELECT value FROM documents WHERE kind = ? AND key = ?",
+                                        (kind, str(key))).fetchone()
+        if row:
+            return json.loads(row[0])
+        if kind == TASK_STATISTICS_JOBS:
+            jobIds = loadLegacyStatisticsIds(key)
+            if jobIds is not None:
+                return len(set(jobIds))
+        if kind in LEGACY_LOADERS:
+            value = LEGACY_LOADERS[kind](str(key))
+            if value is not None:
+                return value
+        return default
+
+    def put(self, kind, key, value):
+        """
+        store (or replace) a document
+        """
+        self.connection().execute("INSERT OR REPLACE INTO documents (kind, key, value) VALUES (?, ?, ?)",
+                                  (kind, str(key), json.dumps(value)))
+
+    def delete(self, kind):
+        """
+        remove all documents of one kind
+        """
+        self.connection().execute("DELETE FROM documents WHERE kind = ?", (kind,))
+
+    def increment(self, kind, key):
+        """
+        add one to a counter, which starts at 0
+        :return: the value of the counter before the increment
+        """
+        with self.transaction():
+            value = self.get(kind, key, 0)
+            self.put(kind, key, value + 1)
+        return value
+
+    def recordJobResult(self, jobId, state, site):
+        """
+        Count one more result for this job in the task and site statistics.
+        Readers get the counts in O(1) instead of counting the lines of the
+        task_statistics.* files which were used before.
+        """
+        with self.transaction():
+            self.increment(TASK_STATISTICS, state)
+            self.increment(TASK_STATISTICS, '%s.%s' % (site, state))
+            if not self.connection().execute("SELECT 1 FROM documents WHERE kind = ? AND key = ?",
+                                             (TASK_STATISTICS_JOBS, state)).fetchone():
+                # first result for this state since the switch from task_statistics.<state>:
+                # import the job ids already listed there
+                jobIds = set(loadLegacyStatisticsIds(state) or [])
+                for legacyJobId in jobIds:
+                    self.put(TASK_STATISTICS_JOB, '%s.%s' % (state, legacyJobId), True)
+                self.put(TASK_STATISTICS_JOBS, state, len(jobIds))
+            jobKey = '%s.%s' % (state, jobId)
+            if not self.get(TASK_STATISTICS_JOB, jobKey):
+                self.put(TASK_STATISTICS_JOB, jobKey, True)
+                self.put(TASK_STATISTICS_JOBS, state, self.get(TASK_STATISTICS_JOBS, state) + 1)
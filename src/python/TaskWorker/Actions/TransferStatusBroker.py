@@ -0,0 +1,256 @@
+"""
+Per-task broker of ASO transfer statuses.
+
+Without the broker every PostJob which monitors transfers decides on its own
+whether aso_status.json is stale and, if so, queries the
+fileusertransfers?subresource=getTransferStatus REST API for the whole task.
+When thousands of PostJobs are deferred at the same time this results in bursts
+of identical queries.
+
+The broker is a long lived process started by task_process/task_proc_wrapper.sh.
+It refreshes the transfer statuses of the task once per interval (or earlier, when
+a PostJob asks for it) and atomically replaces aso_status.json, whose format is
+unchanged. A PostJob which finds the broker alive only reads the snapshot; if the
+snapshot is too old or misses one of its documents, it asks for a refresh and waits
+a short time for a new snapshot instead of querying REST itself. If the broker is
+not running PostJob falls back to querying REST as before.
+"""
+import os
+import sys
+import json
+import time
+import logging
+
+from ServerUtilities import TRANSFERDB_STATES, encodeRequest, oracleOutputMapping
+from RESTInteractions import CRABRest
+
+STATUS_FILE = 'aso_status.json'
+HEARTBEAT_FILE = 'task_process/transfer_status_broker.heartbeat'
+REFRESH_REQUEST_FILE = 'task_process/transfer_status_broker.request'
+REST_INFO_FILE = 'task_process/RestInfoForFileTransfers.json'
+TASK_PROCESS_RUNNING_FILE = 'task_process/task_process_running'
+
+# seconds between two regular refreshes of the snapshot
+REFRESH_INTERVAL = 300
+# minimum number of seconds between two queries, also for refreshes requested by PostJobs
+MIN_QUERY_INTERVAL = 60
+# how often the broker wakes up to look for refresh requests
+POLL_INTERVAL = 5
+# the broker is considered dead if it did not update its heartbeat for this many seconds
+HEARTBEAT_TIMEOUT = 3 * REFRESH_INTERVAL
+
+
+def brokerIsAlive():
+    """
+    Tell if a broker is serving this task, i.e. it updated its heartbeat recently
+    :return: True or False
+    """
+    try:
+        return time.time() - os.path.getmtime(HEARTBEAT_FILE) < HEARTBEAT_TIMEOUT
+    except OSError:
+        return False
+
+
+def requestRefresh():
+    """
+    Ask the broker to refresh the snapshot as soon as allowed by MIN_QUERY_INTERVAL
+    :return: nothing
+    """
+    with open(REFRESH_REQUEST_FILE, 'a', encoding='utf-8'):
+        pass
+    os.utime(REFRESH_REQUEST_FILE, None)
+
+
+def loadSnapshot():
+    """
+    Read the latest snapshot written by the broker (or by a PostJob)
+    :return: the content of aso_status.json as a dictionary, {} if it does not exist
+    """
+    if not os.path.exists(STATUS_FILE):
+        return {}
+    with open(STATUS_FILE, encoding='utf-8') as fd:
+        return json.load(fd)
+
+
+def writeSnapshot(asoInfo):
+    """
+    Atomically replace aso_status.json with the given content
+    :param asoInfo: dictionary with keys query_timestamp, query_succeded, query_jobid, results
+    :return: nothing
+    """
+    tmpName = "aso_status.%d.json" % os.getpid()
+    with open(tmpName, 'w', encoding='utf-8') as fd:
+        json.dump(asoInfo, fd)
+    os.rename(tmpName, STATUS_FILE)
+
+
+def snapshotCovers(asoInfo, docIds, notBefore):
+    """
+    Tell if a snapshot can be used to get the status of a list of documents
+    :param asoInfo: a snapshot as returned by loadSnapshot
+    :param docIds: list of transfer document ids
+    :param notBefore: the snapshot must have been taken after this time
+    :return: True or False
+    """
+    if not asoInfo or asoInfo.get('query_timestamp', 0) <= notBefore:
+        return False
+    if not asoInfo.get('query_succeded', True):
+        return False
+    results = asoInfo.get('results', {})
+    return all(docId in results for docId in docIds)
+
+
+def waitForSnapshot(docIds, notBefore, timeout=60, logger=None):
+    """
+    Return a snapshot which covers all documents, requesting a refresh to the broker
+    and waiting up to timeout seconds for it if the current one is not good enough
+    :param docIds: list of transfer document ids
+    :param notBefore: the snapshot must have been taken after this time
+    :param timeout: max number of seconds to wait
+    :param logger: a logger
+    :return: the snapshot, or None if no suitable one became available in time
+    """
+    deadline = time.time() + timeout
+    refreshRequested = False
+    while True:
+        try:
+            asoInfo = loadSnapshot()
+        except Exception:  # pylint: disable=broad-except
+            # may be caught while being replaced by another process, try again below
+            asoInfo = {}
+        if snapshotCovers(asoInfo, docIds, notBefore):
+            return asoInfo
+        if time.time() >= deadline:
+            return None
+        if not refreshRequested:
+            if logger:
+                logger.info("Transfer status snapshot is not usable yet. Asking the broker for a refresh.")
+            requestRefresh()
+            refreshRequested = True
+            # only accept snapshots taken after our request, the current one is of no use
+            notBefore = max(notBefore, asoInfo.get('query_timestamp', 0))
+        time.sleep(2)
+
+
+class TransferStatusBroker():
+    """
+    Refresh aso_status.json for one task at regular intervals
+    """
+    def __init__(self, taskname, logger):
+        self.taskname = taskname
+        self.logger = logger
+        self.crabserver = None
+        self.username = None
+        self.lastQuery = 0
+
+    def setup(self):
+        """
+        Prepare the REST client. Information is written by the first PostJob
+        which injects transfers, so this returns False until that happens.
+        :return: True if the broker is ready to query REST
+        """
+        if self.crabserver:
+            return True
+        if not os.path.exists(REST_INFO_FILE):
+            return False
+        with open(REST_INFO_FILE, encoding='utf-8') as fp:
+            restInfo = json.load(fp)
+        self.username = restInfo.get('username') or self.findUsername()
+        if not self.username:
+            return False
+        proxy = os.path.join(os.getcwd(), str(restInfo['proxyfile']))
+        self.crabserver = CRABRest(restInfo['host'], proxy, proxy, retry=2, userAgent='CRABSchedd')
+        self.crabserver.setDbInstance(restInfo['dbInstance'])
+        return True
+
+    @staticmethod
+    def findUsername():
+        """
+        Get the username from the first transfer document written by PostJob,
+        for tasks where RestInfoForFileTransfers.json does not contain it
+        """
+        for fileName in ['task_process/transfers.txt', 'task_process/transfers_direct.txt']:
+            if not os.path.exists(fileName):
+                continue
+            with open(fileName, encoding='utf-8') as fd:
+                line = fd.readline()
+            try:
+                return json.loads(line)['username']
+            except (ValueError, KeyError):
+                continue
+        return None
+
+    def refreshRequested(self):
+        """
+        Tell if a PostJob asked for a refresh after the last query
+        """
+        try:
+            return os.path.getmtime(REFRESH_REQUEST_FILE) > self.lastQuery
+        except OSError:
+            return False
+
+    def refresh(self):
+        """
+        Query REST for the status of all transfers of the task and replace the snapshot
+        """
+        self.lastQuery = time.time()
+        asoInfo = {
+            "query_timestamp": self.lastQuery,
+            "query_succeded": False,
+            "query_jobid": "broker",
+            "results": {},
+        }
+        try:
+            viewResults = self.crabserver.get(api='fileusertransfers',
+                                              data=encodeRequest({'subresource': 'getTransferStatus',
+                                                                  'username': self.username,
+                                                                  'taskname': self.taskname}))
+            viewResultsDict = oracleOutputMapping(viewResults, 'id')
+            for document in viewResultsDict:
+                viewResultsDict[document][0]['state'] = TRANSFERDB_STATES[viewResultsDict[document][0]['transfer_state']].lower()
+            asoInfo['results'] = viewResultsDict
+            asoInfo['query_succeded'] = True
+            self.logger.info("Got the status of %d transfers", len(viewResultsDict))
+        except Exception:  # pylint: disable=broad-except
+            # a failed snapshot makes PostJobs defer until the next query, as it did before
+            self.logger.exception("Error while querying transfer statuses")
+        writeSnapshot(asoInfo)
+
+    def heartbeat(self):
+        """
+        Let PostJobs know that the broker is alive
+        """
+        with open(HEARTBEAT_FILE, 'w', encoding='utf-8') as fd:
+            fd.write(str(os.getpid()))
+
+    def run(self):
+        """
+        Main loop. Exits when the task_process wrapper exits, i.e. when
+        task_process/task_process_running is removed.
+        """
+        self.logger.info("Starting transfer status broker for task %s", self.taskname)
+        while os.path.exists(TASK_PROCESS_RUNNING_FILE):
+            self.heartbeat()
+            now = time.time()
+            if now - self.lastQuery >= MIN_QUERY_INTERVAL and \
+               (now - self.lastQuery >= REFRESH_INTERVAL or self.refreshRequested()):
+                try:
+                    if self.setup():
+                        self.refresh()
+                except Exception:  # pylint: disable=broad-except
+                    self.logger.exception("Transfer status broker cycle failed")
+                    self.lastQuery = now
+            time.sleep(POLL_INTERVAL)
+        if os.path.exists(HEARTBEAT_FILE):
+            os.remove(HEARTBEAT_FILE)
+        self.logger.info("task_process is not running anymore. Transfer status broker exiting")
+
+
+def main():
+    """
+    Entry point used by task_process/transfer_status_broker.py
+    """
+    logging.basicConfig(filename='task_process/transfer_status_broker.log', level=logging.INFO,
+                        format='%(asctime)s:%(levelname)s:%(message)s')
+    taskname = sys.argv[1]
+    TransferStatusBroker(taskname, logging.getLogger()).run()
@@ -0,0 +1,223 @@
+"""
+ per-task server which runs TW actions (PREJOB, POSTJOB, PREDAG) for TaskManagerShim
+
+Each DAGMan script used to start a new python interpreter which imports htcondor,
+classad, WMCore, ServerUtilities and all of TaskWorker.Actions before doing
+anything useful. On schedds with many thousand DAG nodes this startup is a good
+part of the CPU used by CRAB. This server does the imports once and then, for each
+request from TaskManagerShim, forks a copy of itself which runs TaskManagerBootstrap
+exactly as a new process would: with the arguments, working directory, environment
+and stdin/stdout/stderr of the shim, and with its own copy of all module globals.
+The forked process returns the exit code directly to the shim, so the exit code
+contract with DAGMan (including 4 for DEFER) and the pre/post-job log files do
+not change.
+The server exits after IDLE_TIMEOUT seconds without requests, a new one is started
+by the next shim when needed.
+"""
+import os
+import sys
+import time
+import fcntl
+import errno
+import signal
+import socket
+import struct
+import logging
+import traceback
+
+from TaskWorker.TaskManagerShim import SOCKET_FILE, LOCK_FILE, ACK, EXIT_CODE_FORMAT, receiveRequest
+
+# PostJobs are deferred for 30 min, make sure the server survives one deferral
+IDLE_TIMEOUT = 3600
+# max number of seconds for a shim to send its request
+REQUEST_TIMEOUT = 10
+HANDLED_SIGNALS = [signal.SIGHUP, signal.SIGINT, signal.SIGTERM]
+
+
+def exitCode(code):
+    """ translate the argument of sys.exit() into a process exit code, like python does """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xff
+    print(code, file=sys.stderr)
+    return 1
+
+
+class TaskManagerServer():
+    """
+    fork a preloaded TaskManagerBootstrap for each request received on SOCKET_FILE
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.listener = None
+        self.lockFile = None
+        self.children = set()
+        self.bootstrap = None
+        # signal handlers as they are in a fresh TaskManagerBootstrap process
+        self.actionSignalHandlers = {}
+        self.stop = False
+
+    def lock(self):
+        """
+        make sure only one server runs for this task
+        :return: True if the lock was acquired
+        """
+        self.lockFile = open(LOCK_FILE, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def preload(self):
+        """
+        import everything which TaskManagerBootstrap needs. Importing PostJob
+        also installs its signal handlers, which are restored in each action.
+        """
+        from TaskWorker import TaskManagerBootstrap  # pylint: disable=import-outside-toplevel
+        self.bootstrap = TaskManagerBootstrap
+        for signum in HANDLED_SIGNALS:
+            self.actionSignalHandlers[signum] = signal.getsignal(signum)
+            signal.signal(signum, self.handleSignal)
+
+    def handleSignal(self, signum, frame):  # pylint: disable=unused-argument
+        self.logger.info("Received signal %d, exiting", signum)
+        self.stop = True
+
+    def listen(self):
+        """
+        bind the socket. Since the lock is held, an existing socket file is left over
+        by a server which did not exit cleanly.
+        """
+        if os.path.exists(SOCKET_FILE):
+            os.remove(SOCKET_FILE)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(SOCKET_FILE)
+        self.listener.listen(64)
+        self.listener.settimeout(1)
+
+    def reapChildren(self):
+        for pid in list(self.children):
+            try:
+                donePid, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                self.children.discard(pid)
+                continue
+            if donePid:
+                self.children.discard(pid)
+                self.logger.debug("Action process %d exited with status %d", pid, status)
+
+    def handleRequest(self, conn):
+        """
+        receive one request and fork the process which executes it
+        """
+        conn.settimeout(REQUEST_TIMEOUT)
+        request, fds = receiveRequest(conn)
+        if len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            raise ValueError(f"expected 3 file descriptors, received {len(fds)}")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.runAction(conn, request, fds)
+        for fd in fds:
+            os.close(fd)
+        self.children.add(pid)
+        self.logger.info("Started %s in process %d", ' '.join(request['args'][:3]), pid)
+
+    def runAction(self, conn, request, fds):
+        """
+        executed in the forked process: set up the same process state as the shim
+        and run TaskManagerBootstrap. Never returns.
+        """
+        code = 1
+        try:
+            self.listener.close()
+            for signum, handler in self.actionSignalHandlers.items():
+                signal.signal(signum, handler)
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            sys.argv = [self.bootstrap.__file__] + request['args']
+            conn.settimeout(None)
+            conn.sendall(ACK)
+        except Exception:  # pylint: disable=broad-except
+            # the shim did not get the ACK and will run the action itself
+            os._exit(1)  # pylint: disable=protected-access
+        try:
+            retval = self.bootstrap.bootstrap()
+            print(f"Ended TaskManagerBootstrap with code {retval}")
+            code = exitCode(retval)
+        except SystemExit as ex:
+            code = exitCode(ex.code)
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Got a fatal exception: {e}")
+            traceback.print_exc()
+        finally:
+            try:
+                logging.shutdown()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(struct.pack(EXIT_CODE_FORMAT, code))
+            finally:
+                os._exit(code)  # pylint: disable=protected-access
+
+    def run(self):
+        """
+        main loop
+        """
+        if not self.lock():
+            self.logger.info("Another TaskManagerServer is running for this task, exiting")
+            return
+        self.preload()
+        self.listen()
+        self.logger.info("TaskManagerServer listening on %s", SOCKET_FILE)
+        lastRequest = time.time()
+        try:
+            while not self.stop:
+                self.reapChildren()
+                if not self.children and time.time() - lastRequest > IDLE_TIMEOUT:
+                    self.logger.info("No requests in the last %d seconds, exiting", IDLE_TIMEOUT)
+                    break
+                try:
+                    conn, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+                except OSError as ex:
+                    if ex.errno == errno.EINTR:
+                        continue
+                    raise
+                lastRequest = time.time()
+                try:
+                    self.handleRequest(conn)
+                except Exception:  # pylint: disable=broad-except
+                    self.logger.exception("Failed to handle request")
+                finally:
+                    conn.close()
+        finally:
+            # stop accepting requests before releasing the lock, running actions are not affected
+            self.listener.close()
+            if os.path.exists(SOCKET_FILE):
+                os.remove(SOCKET_FILE)
+            self.lockFile.close()
+
+
+def main():
+    """ entry point used by TaskManagerShim """
+    logger = logging.getLogger('TaskManagerServer')
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(process)d %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    TaskManagerServer(logger).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+ run one TW action (PREJOB, POSTJOB, PREDAG) in the per-task TaskManagerServer
+
+This is what dag_bootstrap.sh executes instead of TaskManagerBootstrap when the
+task manager server is enabled for the task. It only uses the standard library,
+so that starting it is cheap: the arguments, working directory and environment
+are sent to the server together with stdin/stdout/stderr, the server runs
+TaskManagerBootstrap in a forked copy of itself where htcondor, classad, WMCore
+etc. are already imported, and the exit code of the action is returned to DAGMan
+as if TaskManagerBootstrap had been executed here.
+If the server is not running, it is started in the background and this action is
+executed the old way, via TaskManagerBootstrap.
+"""
+import os
+import sys
+import json
+import fcntl
+import array
+import socket
+import struct
+import subprocess
+
+# paths are relative to the task spool directory, which is the current directory
+# of all DAGMan scripts. Unix socket paths are limited to ~100 characters
+SOCKET_FILE = 'task_process/task_manager_server.sock'
+LOCK_FILE = 'task_process/task_manager_server.lock'
+LOG_FILE = 'task_process/task_manager_server.log'
+
+# the server acknowledges a request as soon as the action starts, then sends its exit code
+ACK = b'\x00'
+EXIT_CODE_FORMAT = '!i'
+# max number of seconds to wait for the server to start the action
+ACK_TIMEOUT = 60
+CONNECT_TIMEOUT = 5
+
+
+def sendRequest(sock, request, fds):
+    """
+    send a length prefixed JSON request and pass the file descriptors along with it
+    """
+    payload = json.dumps(request).encode('utf-8')
+    message = struct.pack('!I', len(payload)) + payload
+    sent = sock.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    if sent < len(message):
+        sock.sendall(message[sent:])
+
+
+def receiveRequest(sock, maxFds=3):
+    """
+    counterpart of sendRequest
+    :return: (request, fds) tuple
+    """
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(4096, socket.CMSG_LEN(maxFds * fds.itemsize))
+    for level, kind, cmsgData in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsgData[:len(cmsgData) - (len(cmsgData) % fds.itemsize)])
+    try:
+        if len(data) < 4:
+            raise ValueError("truncated request header")
+        length = struct.unpack('!I', data[:4])[0]
+        data = data[4:]
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise ValueError("truncated request")
+            data += chunk
+        return json.loads(data.decode('utf-8')), list(fds)
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def serverIsStarting():
+    """
+    the server holds LOCK_FILE as long as it runs
+    :return: True if a server process holds the lock
+    """
+    with open(LOCK_FILE, 'a', encoding='utf-8') as fd:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    return False
+
+
+def startServer():
+    """
+    start the server in the background, unless another process did already
+    """
+    if serverIsStarting():
+        return
+    with open(LOG_FILE, 'a', encoding='utf-8') as log:
+        subprocess.Popen([sys.executable, '-m', 'TaskWorker.TaskManagerServer'],  # pylint: disable=consider-using-with
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         close_fds=True, start_new_session=True)
+
+
+def runInServer(args):
+    """
+    ask the server to execute TaskManagerBootstrap with these arguments
+    :return: the exit code of the action, or None if the server did not accept the request
+    """
+    if not os.path.exists(SOCKET_FILE):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(SOCKET_FILE)
+            request = {'args': args, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+            sendRequest(sock, request, [0, 1, 2])
+            sock.settimeout(ACK_TIMEOUT)
+            if sock.recv(1) != ACK:
+                return None
+        except OSError as ex:
+            print(f"TaskManagerServer not available: {ex}")
+            return None
+        # from now on the action is running, wait for it however long it takes
+        sock.settimeout(None)
+        data = b''
+        size = struct.calcsize(EXIT_CODE_FORMAT)
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                print("TaskManagerServer closed the connection before returning the exit code", file=sys.stderr)
+                return 1
+            data += chunk
+        return struct.unpack(EXIT_CODE_FORMAT, data)[0]
+    finally:
+        sock.close()
+
+
+def main():
+    """ run the action in the server, or the old way if that is not possible """
+    args = sys.argv[1:]
+    retval = runInServer(args)
+    if retval is None:
+        try:
+            startServer()
+        except Exception as ex:  # pylint: disable=broad-except
+            print(f"Failed to start TaskManagerServer: {ex}")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable, '-m', 'TaskWorker.TaskManagerBootstrap'] + args)
+    sys.exit(retval)
+
+
+if __name__ == '__main__':
+    main()
@@ -53,7 +53,8 @@ def test_deleteFileFromTempArea(bookkeepingOKLock, LFN2transferItemMap):
     logPath = '/path/to/gfal.log'
     config.args = Namespace(gfal_log_path=logPath)
     expectedPFNs = LFN2PFNMap['T2_CH_CERN_Temp'].values()
-    with patch('ASO.Rucio.Actions.Cleanup.callGfalRm', autospec=True) as mo_callGfalRm:
+    with patch('ASO.Rucio.Actions.Cleanup.hasGfal2', return_value=False), \
+         patch('ASO.Rucio.Actions.Cleanup.callGfalRm', autospec=True) as mo_callGfalRm:
         m = Cleanup(t)
         m.deleteFileInTempArea(bookkeepingOKLock)
         mo_callGfalRm.assert_called_once()
@@ -62,3 +63,34 @@ def test_deleteFileFromTempArea(bookkeepingOKLock, LFN2transferItemMap):
         assert calledLogPath == logPath
         for pfn in expectedPFNs:
             assert pfn in calledPFNs
+        t.updateCleanedFiles.assert_called_once_with(bookkeepingOKLock)
+
+
+def test_deleteFileFromTempArea_gfal2Bulk():
+    t = create_autospec(Transfer, instance=True)
+    lfns = [f'/store/temp/user/cmsbot/output_{i}.root' for i in range(5)]
+    t.LFN2transferItemMap = {
+        f'/store/user/rucio/cmsbot/output_{i}.root': {
+            'source': 'T2_CH_CERN' if i < 3 else 'T2_US_Nebraska',
+            'source_lfn': lfn,
+        } for i, lfn in enumerate(lfns)
+    }
+    t.LFN2PFNMap = {
+        'T2_CH_CERN_Temp': {lfn: f'davs://eoscms.cern.ch:443/eos/cms{lfn}' for lfn in lfns[:3]},
+        'T2_US_Nebraska_Temp': {lfn: f'davs://xrootd-local.unl.edu:1094{lfn}' for lfn in lfns[3:]},
+    }
+    t.restProxyFile = '/path/to/proxy'
+    config.args = Namespace(gfal_log_path='/path/to/gfal.log', cleanup_workers=2, cleanup_chunk_size=2)
+    failedPFN = 'davs://eoscms.cern.ch:443/eos/cms/store/temp/user/cmsbot/output_1.root'
+    def mockGfalBulkRm(pfns, proxy):
+        assert len({p.split('/')[2] for p in pfns}) == 1
+        assert len(pfns) <= 2
+        return [p for p in pfns if p != failedPFN], {p: 'Permission denied' for p in pfns if p == failedPFN}
+    with patch('ASO.Rucio.Actions.Cleanup.hasGfal2', return_value=True), \
+         patch('ASO.Rucio.Actions.Cleanup.gfalBulkRm', side_effect=mockGfalBulkRm) as mo_gfalBulkRm:
+        m = Cleanup(t)
+        m.deleteFileInTempArea(list(t.LFN2transferItemMap))
+        # 2 chunks for CERN, 1 for Nebraska
+        assert mo_gfalBulkRm.call_count == 3
+    cleaned = [lfn for c in t.updateCleanedFiles.call_args_list for lfn in c.args[0]]
+    assert sorted(cleaned) == sorted(set(t.LFN2transferItemMap) - {'/store/user/rucio/cmsbot/output_1.root'})
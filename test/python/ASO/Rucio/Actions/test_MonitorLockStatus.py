@@ -51,16 +51,24 @@ def test_checkLockStatus_all_ok(mock_Transfer, mock_rucioClient):
             "ruleid": "b43a554244c54dba954aa29cb2fdde0a",
         }
     ]
-    listReplicaLocksReturnValue = [{
+    datasetName = '/GenericTTbar/tseethon-autotest-1679671056-94ba0e06145abd65ccb1d21786dc7e1d/USER#c9b28b96-5d16-41cd-89af-2678971132c9'
+    getLocksForDidsReturnValue = [{
         'name': '/store/user/rucio/tseethon/test-workflow/GenericTTbar/autotest-1679671056/230324_151740/0000/output_9.root',
         'state': 'OK',
+        'rule_id': 'b43a554244c54dba954aa29cb2fdde0a',
+    }, {
+        # lock of the publish container rule
+        'name': '/store/user/rucio/tseethon/test-workflow/GenericTTbar/autotest-1679671056/230324_151740/0000/output_9.root',
+        'state': 'REPLICATING',
+        'rule_id': '141a41b6b54f45f59dc0703182f1257f',
     }]
 
-    mock_rucioClient.list_replica_locks.side_effect = ((x for x in listReplicaLocksReturnValue), ) # list_replica_locks return generator
-    mock_Transfer.replicasInContainer = {
-        '/store/user/rucio/tseethon/test-workflow/GenericTTbar/autotest-1679671056/230324_151740/0000/output_9.root' : '/GenericTTbar/tseethon-autotest-1679671056-94ba0e06145abd65ccb1d21786dc7e1d/USER#c9b28b96-5d16-41cd-89af-2678971132c9'
-    }
+    mock_rucioClient.list_content.return_value = [{'name': datasetName}]
+    mock_rucioClient.get_locks_for_dids.return_value = getLocksForDidsReturnValue
+    mock_rucioClient.get_metadata.return_value = {'is_open': False, 'length': 1}
     mock_Transfer.containerRuleID = 'b43a554244c54dba954aa29cb2fdde0a'
+    mock_Transfer.lockOKDatasets = set()
+    mock_Transfer.bookkeepingOKLocks = set()
     mock_Transfer.LFN2transferItemMap = {
         '/store/user/rucio/tseethon/test-workflow/GenericTTbar/autotest-1679671056/230324_151740/0000/output_9.root': {
             'id': '98f353b91ec84f0217da80bde84d6b520c0c6640f60ad9aabb7b20ca',
@@ -69,6 +77,7 @@ def test_checkLockStatus_all_ok(mock_Transfer, mock_rucioClient):
     config.args = Namespace(max_file_per_dataset=1)
     m = MonitorLockStatus(mock_Transfer, mock_rucioClient, Mock())
     assert m.checkLockStatus() == (outputAllOK, [])
+    assert m.newLockOKDatasets == [datasetName]
 
 def test_checkLockStatus_all_replicating(mock_Transfer, mock_rucioClient):
     outputNotOK = [
@@ -80,20 +89,38 @@ def test_checkLockStatus_all_replicating(mock_Transfer, mock_rucioClient):
             "ruleid": "b43a554244c54dba954aa29cb2fdde0a",
         },
     ]
-    listReplicaLocksReturnValue = [{
+    getLocksForDidsReturnValue = [{
         'name': '/store/user/rucio/tseethon/test-workflow/GenericTTbar/autotest-1679671056/230324_151740/0000/output_9.root',
         'state': 'REPLICATING',
+        'rule_id': 'b43a554244c54dba954aa29cb2fdde0a',
     }]
     mock_Transfer.containerRuleID = 'b43a554244c54dba954aa29cb2fdde0a'
+    mock_Transfer.lockOKDatasets = set()
+    mock_Transfer.bookkeepingOKLocks = set()
     mock_Transfer.LFN2transferItemMap = {
         '/store/user/rucio/tseethon/test-workflow/GenericTTbar/autotest-1679671056/230324_151740/0000/output_9.root': {
             'id': '98f353b91ec84f0217da80bde84d6b520c0c6640f60ad9aabb7b20ca',
         }
     }
-    mock_rucioClient.list_replica_locks.side_effect = ((x for x in listReplicaLocksReturnValue), ) # list_replica_locks return generator
-    mock_Transfer.getIDFromLFN.return_value = '98f353b91ec84f0217da80bde84d6b520c0c6640f60ad9aabb7b20ca'
+    mock_rucioClient.list_content.return_value = [{'name': '/GenericTTbar/tseethon-autotest-1679671056-94ba0e06145abd65ccb1d21786dc7e1d/USER#c9b28b96-5d16-41cd-89af-2678971132c9'}]
+    mock_rucioClient.get_locks_for_dids.return_value = getLocksForDidsReturnValue
     m = MonitorLockStatus(mock_Transfer, mock_rucioClient, Mock())
     assert m.checkLockStatus() == ([], outputNotOK)
+    assert m.newLockOKDatasets == []
+    mock_rucioClient.get_metadata.assert_not_called()
+
+def test_checkLockStatus_skip_lockOKDatasets(mock_Transfer, mock_rucioClient):
+    lfn = '/store/user/rucio/tseethon/test-workflow/GenericTTbar/autotest-1679671056/230324_151740/0000/output_9.root'
+    mock_Transfer.containerRuleID = 'b43a554244c54dba954aa29cb2fdde0a'
+    mock_Transfer.lockOKDatasets = {'/GenericTTbar/tseethon-autotest-1679671056-94ba0e06145abd65ccb1d21786dc7e1d/USER#c9b28b96-5d16-41cd-89af-2678971132c9'}
+    mock_Transfer.bookkeepingOKLocks = {lfn}
+    mock_Transfer.LFN2transferItemMap = {lfn: {'id': '98f353b91ec84f0217da80bde84d6b520c0c6640f60ad9aabb7b20ca'}}
+    mock_rucioClient.list_content.return_value = [{'name': '/GenericTTbar/tseethon-autotest-1679671056-94ba0e06145abd65ccb1d21786dc7e1d/USER#c9b28b96-5d16-41cd-89af-2678971132c9'}]
+    m = MonitorLockStatus(mock_Transfer, mock_rucioClient, Mock())
+    okFileDocs, notOKFileDocs = m.checkLockStatus()
+    assert [x['name'] for x in okFileDocs] == [lfn]
+    assert notOKFileDocs == []
+    mock_rucioClient.get_locks_for_dids.assert_not_called()
 
 @pytest.mark.skip(reason="Skip it for now due deadline.")
 def test_checkLockStatus_mix():
@@ -143,7 +170,7 @@ def test_checkBlockCompleteStatus_close(mock_Transfer, mock_rucioClient):
             "ruleid": "b43a554244c54dba954aa29cb2fdde0a",
         }
     ]
-    config.args = Namespace(open_dataset_timeout=1*60*60)
+    config.args = Namespace(open_dataset_timeout=1*60*60, dataset_metadata_workers=2)
     mock_rucioClient.get_metadata.side_effect = [{
         'is_open': False,
         'updated_at': datetime.datetime.now()
@@ -170,7 +197,7 @@ def test_checkBlockCompleteStatus_shouldClose(mock_Transfer, mock_rucioClient):
             "ruleid": "b43a554244c54dba954aa29cb2fdde0a",
         }
     ]
-    config.args = Namespace(open_dataset_timeout=1*60*60)
+    config.args = Namespace(open_dataset_timeout=1*60*60, dataset_metadata_workers=2)
     mock_rucioClient.get_metadata.side_effect = [{
         'is_open': False,
         'updated_at': datetime.datetime.now() - datetime.timedelta(seconds=config.args.open_dataset_timeout - 1) # 1 hour and 1 second ago
@@ -188,7 +215,7 @@ def test_checkBlockCompleteStatus_notclose(mock_Transfer, mock_rucioClient):
             "ruleid": "b43a554244c54dba954aa29cb2fdde0a",
         }
     ]
-    config.args = Namespace(open_dataset_timeout=1*60*60)
+    config.args = Namespace(open_dataset_timeout=1*60*60, dataset_metadata_workers=2)
     mock_rucioClient.get_metadata.side_effect = [{
         'is_open': True,
         'updated_at': datetime.datetime.now() - datetime.timedelta(seconds=1) # 1 sec ago
@@ -233,7 +260,7 @@ def test_updateRESTFileDocsStateToDone(mock_updateToREST):
     rest = Mock()
     m = MonitorLockStatus(Mock(), Mock(), rest)
     m.updateRESTFileDocsStateToDone(outputOK)
-    mock_updateToREST.assert_called_with(rest, 'filetransfers', 'updateTransfers', expectedRestFileDocs)
+    mock_updateToREST.assert_called_with(rest, 'filetransfers', 'updateTransfers', expectedRestFileDocs, m.transfer.store)
 
 
 @patch('ASO.Rucio.Actions.MonitorLockStatus.updateToREST')
@@ -268,7 +295,7 @@ def test_updateRESTFileDocsBlockCompletionInfo(mock_updateToREST):
     rest = Mock()
     m = MonitorLockStatus(Mock(), Mock(), rest)
     m.updateRESTFileDocsBlockCompletionInfo(outputOK)
-    mock_updateToREST.assert_called_with(rest, 'filetransfers', 'updateRucioInfo', expectedRestFileDocs)
+    mock_updateToREST.assert_called_with(rest, 'filetransfers', 'updateRucioInfo', expectedRestFileDocs, m.transfer.store)
 
 
 @patch.object(RegisterReplicas, 'addReplicasToContainer')
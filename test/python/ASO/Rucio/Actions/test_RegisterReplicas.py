@@ -143,9 +143,9 @@ def test_prepare_single_xdict(mock_Transfer, mock_rucioClient):
             }
         ]
     }
-    with patch('ASO.Rucio.Actions.RegisterReplicas.RegisterReplicas.getSourcePFN', autospec=True) as mock_getSourcePFN:
+    with patch('ASO.Rucio.Actions.RegisterReplicas.RegisterReplicas.getSourcePFNs', autospec=True) as mock_getSourcePFNs:
         config.args = Namespace(force_replica_name_suffix=None)
-        mock_getSourcePFN.return_value = getSourcePFNReturnValue
+        mock_getSourcePFNs.return_value = {prepareInput[0]['source_lfn']: getSourcePFNReturnValue}
         mock_Transfer.replicasInContainer = []
         r = RegisterReplicas(mock_Transfer, mock_rucioClient, Mock())
         assert r.prepare(prepareInput) == expectedOutput
@@ -336,7 +336,7 @@ def test_addFilesToRucio_fail(mock_rucioClient):
         'ruleid': None,
         'failReason': f'RUCIO_Transfers.py raised an exception: RSEFileNameNotSupported'
     }
-    config.args = Namespace(replicas_chunk_size=5)
+    config.args = Namespace(replicas_chunk_size=5, register_replicas_workers=2)
     mock_rucioClient.add_replicas.side_effect = RSEFileNameNotSupported
     r = RegisterReplicas(Mock(), mock_rucioClient, Mock())
     _, fail = r.addFilesToRucio(prepared)
@@ -345,3 +345,29 @@ def test_addFilesToRucio_fail(mock_rucioClient):
     mock_rucioClient.add_replicas.side_effect = RSEProtocolNotSupported
     _, fail = r.addFilesToRucio(prepared)
     assert expectFailOutput == fail[0]
+
+
+def test_addFilesToRucio_multipleRSE_keepOrder(mock_rucioClient):
+    prepared = {}
+    for rse in ['T2_CH_CERN_Temp', 'T2_US_Nebraska_Temp', 'T3_US_FNALLPC_Temp']:
+        prepared[rse] = {
+            f'{rse}_{i}': {
+                'scope': 'user.cmscrab',
+                'pfn': f'davs://{rse}/store/temp/output_{i}.root',
+                'name': f'/store/user/rucio/{rse}/output_{i}.root',
+                'bytes': 628054,
+                'adler32': '812b8235',
+            } for i in range(5)
+        }
+    def add_replicas(rse, rs):
+        if rse == 'T2_US_Nebraska_Temp':
+            raise RSEProtocolNotSupported
+        return True
+    config.args = Namespace(replicas_chunk_size=2, register_replicas_workers=4)
+    mock_rucioClient.add_replicas.side_effect = add_replicas
+    r = RegisterReplicas(Mock(), mock_rucioClient, Mock())
+    success, fail = r.addFilesToRucio(prepared)
+    assert mock_rucioClient.add_replicas.call_count == 9
+    assert [x['id'] for x in success] == [f'{rse}_{i}' for rse in ['T2_CH_CERN_Temp', 'T3_US_FNALLPC_Temp'] for i in range(5)]
+    assert [x['id'] for x in fail] == [f'T2_US_Nebraska_Temp_{i}' for i in range(5)]
+    assert all(x['failReason'] == 'RUCIO_Transfers.py raised an exception: RSEProtocolNotSupported' for x in fail)
@@ -0,0 +1,207 @@
+"""
+Benchmark of the Rucio ASO process (RunTransfer) against FakeRucioClient.
+
+Writes a synthetic task_process directory with a transfers.txt of the
+requested size in a scratch directory, then runs several RunTransfer cycles
+in-process, like the task_process does every few minutes. Transfers complete
+on the virtual clock of the fake client, which advances by --cycle-interval
+seconds between cycles. For each cycle it prints the wall time, the number of
+Rucio and CRAB REST calls and the peak memory.
+
+Needs only rucio-clients and the CRAB python dependencies, no network and no
+grid proxy. Run from the top of the repository with:
+
+PYTHONPATH=src/python python3 test/python/ASO/Rucio/benchmarkRunTransfer.py --files 100000
+
+# 50 ms per Rucio call, transfers.txt filled in 5 steps, 10 cycles
+PYTHONPATH=src/python python3 test/python/ASO/Rucio/benchmarkRunTransfer.py --files 20000 \\
+--latency 0.05 --arrival-cycles 5 --cycles 10
+
+Arguments which are not known here are passed to ASO.Rucio.Main, e.g.
+--replicas-chunk-size 100
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from collections import Counter
+from unittest.mock import patch
+
+import ASO.Rucio.config as config
+from ASO.Rucio.Main import parseArgs
+from ASO.Rucio.RunTransfer import RunTransfer
+
+from fakeRucioClient import FakeRucioClient
+
+USERNAME = 'crabbench'
+TASKNAME = '230101_000000:crabbench_crab_benchmark'
+DESTINATION = 'T2_CH_CERN'
+OUTPUTDATASET = '/GenericTTbar/crabbench-benchmark-94ba0e06145abd65ccb1d21786dc7e1d/USER'
+
+
+class FakeCRABRest:
+    """
+    Accept all the REST calls of RunTransfer and count them.
+    """
+    def __init__(self):
+        self.calls = Counter()
+
+    def post(self, api, data):
+        self.calls[api] += 1
+
+
+class BenchmarkRunTransfer(RunTransfer):
+    """
+    RunTransfer with the clients replaced by the fakes.
+    """
+    def __init__(self, rucioClient, crabRESTClient):
+        super().__init__()
+        self.fakeRucioClient = rucioClient
+        self.fakeCRABRESTClient = crabRESTClient
+
+    def _initRucioClient(self, username, proxypath='/tmp/x509_uXXXX'):
+        return self.fakeRucioClient
+
+    def _initCrabRESTClient(self, host, dbInstance, proxypath='/tmp/x509_uXXXX'):
+        return self.fakeCRABRESTClient
+
+
+def transferDict(i, numSites):
+    """
+    :return: the transfer dict PostJob writes in transfers.txt for job i+1
+    """
+    jobID = i + 1
+    subdir = f'{jobID // 1000:04d}'
+    destinationLFN = f'/store/user/rucio/{USERNAME}/GenericTTbar/benchmark/230101_000000/{subdir}/output_{jobID}.root'
+    sourceLFN = f'/store/temp/user/{USERNAME}.0123456789abcdef/GenericTTbar/benchmark/230101_000000/{subdir}/output_{jobID}.root'
+    return {
+        'id': hashlib.sha224(sourceLFN.encode()).hexdigest(),
+        'username': USERNAME,
+        'taskname': TASKNAME,
+        'start_time': 1672531200,
+        'destination': DESTINATION,
+        'destination_lfn': destinationLFN,
+        'source': f'T2_XX_Site{i % numSites}',
+        'source_lfn': sourceLFN,
+        'filesize': 630710,
+        'publish': 1,
+        'transfer_state': 'NEW',
+        'publication_state': 'NEW',
+        'job_id': str(jobID),
+        'job_retry_count': 0,
+        'type': 'output',
+        'publishname': 'benchmark-94ba0e06145abd65ccb1d21786dc7e1d',
+        'checksums': {'adler32': f'{jobID & 0xffffffff:08x}', 'cksum': '3473488862'},
+        'outputdataset': OUTPUTDATASET,
+    }
+
+
+def prepareTaskDir(workDir):
+    os.makedirs(os.path.join(workDir, 'task_process/transfers'))
+    with open(os.path.join(workDir, 'task_process/RestInfoForFileTransfers.json'), 'w', encoding='utf-8') as w:
+        json.dump({'host': 'localhost:8443', 'dbInstance': 'dev', 'proxyfile': '/dev/null'}, w)
+
+
+def appendTransfers(path, start, end, numSites):
+    with open(path, 'a', encoding='utf-8') as w:
+        for i in range(start, end):
+            w.write(json.dumps(transferDict(i, numSites)) + '\n')
+
+
+def writeStatusCache(path, dagStatus):
+    with open(path, 'w', encoding='utf-8') as w:
+        json.dump({'overallDagStatus': dagStatus}, w)
+
+
+def main():
+    parser = argparse.ArgumentParser(usage=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--files', type=int, default=10000, help='number of lines in transfers.txt')
+    parser.add_argument('--sites', type=int, default=20, help='number of source sites')
+    parser.add_argument('--cycles', type=int, default=5, help='number of RunTransfer cycles')
+    parser.add_argument('--arrival-cycles', type=int, default=1,
+                        help='transfers.txt is filled in this many equal steps, one before each of the first cycles')
+    parser.add_argument('--cycle-interval', type=float, default=300, help='virtual seconds between cycles')
+    parser.add_argument('--transfer-time', type=float, default=600, help='average virtual seconds per transfer')
+    parser.add_argument('--stuck-fraction', type=float, default=0, help='fraction of transfers which never complete')
+    parser.add_argument('--latency', type=float, default=0, help='seconds per Rucio call')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also report the peak of python allocations per cycle (slows down the run)')
+    parser.add_argument('--work-dir', default=None, help='scratch directory, a temporary one is used by default')
+    parser.add_argument('--keep', action='store_true', help='do not delete the scratch directory at the end')
+    parser.add_argument('--verbose', action='store_true', help='show RunTransfer logs')
+    opts, asoArgs = parser.parse_known_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING, format='%(asctime)s %(levelname)-8s %(name)s: %(message)s')
+    logging.getLogger('RucioTransfer').setLevel(logging.INFO if opts.verbose else logging.WARNING)
+    config.args = parseArgs(asoArgs)
+
+    workDir = opts.work_dir or tempfile.mkdtemp(prefix='aso_benchmark_')
+    prepareTaskDir(workDir)
+    os.chdir(workDir)
+    print(f'Working in {workDir}')
+
+    virtualTime = [time.time()]
+    rucioClient = FakeRucioClient(latency=opts.latency, transferTime=opts.transfer_time,
+                                  stuckFraction=opts.stuck_fraction, clock=lambda: virtualTime[0])
+    crabRESTClient = FakeCRABRest()
+    # temp area files are not deleted, just counted
+    deleted = []
+    gfalRm = lambda pfns, proxy, logPath: deleted.extend(pfns)
+
+    arrivalCycles = max(1, min(opts.arrival_cycles, opts.cycles))
+    written = 0
+    totalWall = 0
+    print(f'{"cycle":>5} {"new files":>9} {"wall [s]":>9} {"rucio calls":>11} {"REST calls":>10} '
+          f'{"OK locks":>8} {"cleaned":>8} {"maxrss [MB]":>11}' + (f' {"py peak [MB]":>12}' if opts.trace_memory else ''))
+    for cycle in range(opts.cycles):
+        newFiles = 0
+        if cycle < arrivalCycles:
+            end = opts.files * (cycle + 1) // arrivalCycles
+            appendTransfers(config.args.transfers_txt_path, written, end, opts.sites)
+            newFiles = end - written
+            written = end
+        dagStatus = 'COMPLETED' if cycle == opts.cycles - 1 else 'RUNNING'
+        writeStatusCache('task_process/status_cache.json', dagStatus)
+        rucioCalls = sum(rucioClient.calls.values())
+        restCalls = sum(crabRESTClient.calls.values())
+        if opts.trace_memory:
+            tracemalloc.start()
+        run = BenchmarkRunTransfer(rucioClient, crabRESTClient)
+        start = time.perf_counter()
+        with patch('ASO.Rucio.Actions.Cleanup.hasGfal2', lambda: False), \
+             patch('ASO.Rucio.Actions.Cleanup.callGfalRm', gfalRm):
+            run.algorithm()
+        wall = time.perf_counter() - start
+        totalWall += wall
+        pyPeak = ''
+        if opts.trace_memory:
+            pyPeak = f' {tracemalloc.get_traced_memory()[1] / 2**20:12.1f}'
+            tracemalloc.stop()
+        maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{cycle:5d} {newFiles:9d} {wall:9.2f} {sum(rucioClient.calls.values()) - rucioCalls:11d} '
+              f'{sum(crabRESTClient.calls.values()) - restCalls:10d} {len(run.transfer.bookkeepingOKLocks):8d} '
+              f'{len(deleted):8d} {maxRSS:11.1f}' + pyPeak)
+        run.transfer.store.close()
+        virtualTime[0] += opts.cycle_interval
+
+    print(f'\nTotal wall time: {totalWall:.2f} s for {opts.files} files in {opts.cycles} cycles')
+    print('Rucio calls:')
+    for name, count in sorted(rucioClient.calls.items()):
+        print(f'  {name:24s} {count:8d}')
+    print('CRAB REST calls:')
+    for name, count in sorted(crabRESTClient.calls.items()):
+        print(f'  {name:24s} {count:8d}')
+    if not opts.keep and not opts.work_dir:
+        os.chdir('/')
+        shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+In-process stand-in of the Rucio server, for tests and benchmarks of the
+Rucio ASO actions without network.
+
+FakeRucioClient implements the subset of `rucio.client.client.Client` used by
+ASO.Rucio (DIDs, replicas, replication rules and replica locks) with the same
+arguments, return values and exceptions as the real client, so that it can be
+passed to the actions instead of `RunTransfer.rucioClient`:
+ - a replication rule on a container/dataset creates one lock per file below
+   it, including files attached later.
+ - a lock is REPLICATING until the replica is transferred to the rule RSE,
+   which takes `transferTime` seconds (+-50%, random with fixed seed) of the
+   client clock, then it is OK. A fraction `stuckFraction` of the files are
+   never transferred and their locks are STUCK.
+ - every call sleeps `latency` seconds (outside of the internal lock, so
+   concurrent calls overlap like HTTP requests would) and is counted in
+   `calls`.
+The clock is `time.time` by default. Benchmarks pass a function returning a
+virtual time, to let transfers complete without waiting.
+"""
+import random
+import threading
+import time
+import uuid
+import datetime
+from collections import Counter
+
+from rucio.common.exception import (DataIdentifierAlreadyExists, DataIdentifierNotFound, DuplicateContent,
+                                    DuplicateRule, InvalidObject, RSENotFound)
+
+
+class FakeRucioClient:
+    """
+    Rucio client backed by in-memory state.
+
+    :param latency: seconds spent in each call
+    :type latency: float
+    :param transferTime: average seconds needed to replicate a file to a rule RSE
+    :type transferTime: float
+    :param stuckFraction: fraction of the files whose transfer never completes
+    :type stuckFraction: float
+    :param clock: function returning the current time in seconds
+    :type clock: callable
+    :param seed: seed of the random generator for transfer times and stuck files
+    :type seed: int
+    """
+    def __init__(self, latency=0, transferTime=0, stuckFraction=0, clock=time.time, seed=0):
+        self.latency = latency
+        self.transferTime = transferTime
+        self.stuckFraction = stuckFraction
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        # (scope, name) -> did dict (type, is_open, updated_at, bytes, adler32)
+        self.dids = {}
+        # (scope, name) -> list of (scope, name) of children, in attach order
+        self.content = {}
+        # (scope, name) -> set of (scope, name) of parents
+        self.parents = {}
+        # (rse, scope, name) -> replica dict
+        self.replicas = {}
+        # rule id -> rule dict
+        self.rules = {}
+        # (scope, name) -> list of rule ids on this did
+        self.didRules = {}
+        # (rule id, scope, name) -> lock dict
+        self.locks = {}
+        # indexes of self.locks: rule id -> lock keys and (scope, name) -> lock keys
+        self.ruleLocks = {}
+        self.fileLocks = {}
+        # (rse, scope, name) -> time when the replica is available at rse, None if never
+        self.availableAt = {}
+
+    # - - - - - internals - - - - -
+
+    def _api(self, name):
+        """
+        Count the call and simulate the server round trip.
+        """
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _now(self):
+        return self.clock()
+
+    def _did(self, scope, name):
+        did = self.dids.get((scope, name))
+        if did is None:
+            raise DataIdentifierNotFound(f"Data identifier '{scope}:{name}' not found")
+        return did
+
+    def _files(self, key):
+        """
+        :return: (scope, name) of all files below a did, or the did itself if it is a file
+        """
+        if self.dids[key]['type'] == 'FILE':
+            return [key]
+        files = []
+        for child in self.content.get(key, []):
+            files += self._files(child)
+        return files
+
+    def _ancestors(self, key):
+        ancestors = set()
+        todo = [key]
+        while todo:
+            for parent in self.parents.get(todo.pop(), ()):
+                if parent not in ancestors:
+                    ancestors.add(parent)
+                    todo.append(parent)
+        return ancestors
+
+    def _lockState(self, lock):
+        ready = self.availableAt[(lock['rse'], lock['scope'], lock['name'])]
+        if ready is None:
+            return 'STUCK'
+        return 'OK' if ready <= self._now() else 'REPLICATING'
+
+    def _addLock(self, ruleID, fileKey):
+        rule = self.rules[ruleID]
+        if (ruleID,) + fileKey in self.locks:
+            return
+        replicaKey = (rule['rse_expression'],) + fileKey
+        if replicaKey not in self.availableAt:
+            if self.random.random() < self.stuckFraction:
+                self.availableAt[replicaKey] = None
+            else:
+                self.availableAt[replicaKey] = self._now() + self.transferTime * (0.5 + self.random.random())
+        self.ruleLocks.setdefault(ruleID, []).append((ruleID,) + fileKey)
+        self.fileLocks.setdefault(fileKey, []).append((ruleID,) + fileKey)
+        self.locks[(ruleID,) + fileKey] = {
+            'rule_id': ruleID,
+            'scope': fileKey[0],
+            'name': fileKey[1],
+            'rse': rule['rse_expression'],
+            'bytes': self.dids[fileKey]['bytes'],
+        }
+
+    def _lockDict(self, lock):
+        return dict(lock, state=self._lockState(lock))
+
+    def _attach(self, scope, name, dids, ignoreDuplicate=False):
+        parentKey = (scope, name)
+        parent = self._did(scope, name)
+        if parent['type'] == 'FILE':
+            raise InvalidObject(f'{scope}:{name} is a file')
+        if not parent['is_open']:
+            raise InvalidObject(f'{scope}:{name} is closed')
+        children = self.content.setdefault(parentKey, [])
+        for d in dids:
+            childKey = (d['scope'], d['name'])
+            self._did(*childKey)
+            if parentKey in self.parents.get(childKey, ()):
+                if ignoreDuplicate:
+                    continue
+                raise DuplicateContent(f'{d["scope"]}:{d["name"]} already attached to {scope}:{name}')
+            children.append(childKey)
+            self.parents.setdefault(childKey, set()).add(parentKey)
+            # rules of the new parents now cover the files of the child
+            ruleIDs = [ruleID for key in {parentKey} | self._ancestors(parentKey) for ruleID in self.didRules.get(key, [])]
+            for fileKey in self._files(childKey):
+                for ruleID in ruleIDs:
+                    self._addLock(ruleID, fileKey)
+        parent['updated_at'] = self._now()
+
+    # - - - - - DID client - - - - -
+
+    def add_container(self, scope, name, **kwargs):  # pylint: disable=unused-argument
+        self._api('add_container')
+        with self.lock:
+            self._addCollection(scope, name, 'CONTAINER')
+        return True
+
+    def add_dataset(self, scope, name, **kwargs):  # pylint: disable=unused-argument
+        self._api('add_dataset')
+        with self.lock:
+            self._addCollection(scope, name, 'DATASET')
+        return True
+
+    def _addCollection(self, scope, name, didType):
+        if (scope, name) in self.dids:
+            raise DataIdentifierAlreadyExists(f"Data Identifier '{scope}:{name}' already exists")
+        self.dids[(scope, name)] = {'type': didType, 'is_open': True, 'updated_at': self._now(),
+                                    'created_at': self._now(), 'bytes': None, 'adler32': None}
+
+    def attach_dids(self, scope, name, dids, rse=None):  # pylint: disable=unused-argument
+        self._api('attach_dids')
+        with self.lock:
+            self._attach(scope, name, dids)
+        return True
+
+    def add_files_to_datasets(self, attachments, ignore_duplicate=False):
+        self._api('add_files_to_datasets')
+        with self.lock:
+            for attachment in attachments:
+                self._attach(attachment['scope'], attachment['name'], attachment['dids'], ignore_duplicate)
+        return True
+
+    def list_content(self, scope, name):
+        self._api('list_content')
+        with self.lock:
+            self._did(scope, name)
+            content = []
+            for childKey in self.content.get((scope, name), []):
+                child = self.dids[childKey]
+                content.append({'scope': childKey[0], 'name': childKey[1], 'type': child['type'],
+                                'bytes': child['bytes'], 'adler32': child['adler32']})
+        return iter(content)
+
+    def get_metadata(self, scope, name, plugin='DID_COLUMN'):  # pylint: disable=unused-argument
+        self._api('get_metadata')
+        with self.lock:
+            return self._metadata(scope, name)
+
+    def _metadata(self, scope, name):
+        did = self._did(scope, name)
+        length = None
+        if did['type'] != 'FILE' and not did['is_open']:
+            length = len(self._files((scope, name)))
+        return {
+            'scope': scope,
+            'name': name,
+            'did_type': did['type'],
+            'is_open': did['is_open'],
+            'length': length,
+            'bytes': did['bytes'],
+            'adler32': did['adler32'],
+            'created_at': datetime.datetime.fromtimestamp(did['created_at']),
+            'updated_at': datetime.datetime.fromtimestamp(did['updated_at']),
+        }
+
+    def get_metadata_bulk(self, dids, inherit=False, plugin='JSON'):  # pylint: disable=unused-argument
+        self._api('get_metadata_bulk')
+        # same as the production server, see BuildDBSDataset.getOrCreateDataset
+        raise InvalidObject('Provided metadata is considered invalid.')
+
+    def close(self, scope, name):
+        self._api('close')
+        with self.lock:
+            did = self._did(scope, name)
+            did['is_open'] = False
+            did['updated_at'] = self._now()
+        return True
+
+    # - - - - - replica client - - - - -
+
+    def add_replicas(self, rse, files, ignore_availability=True):  # pylint: disable=unused-argument
+        self._api('add_replicas')
+        with self.lock:
+            for f in files:
+                key = (f['scope'], f['name'])
+                if key not in self.dids:
+                    self.dids[key] = {'type': 'FILE', 'is_open': False, 'updated_at': self._now(),
+                                      'created_at': self._now(), 'bytes': f['bytes'], 'adler32': f['adler32']}
+                if (rse,) + key not in self.replicas:
+                    self.replicas[(rse,) + key] = {'rse': rse, 'scope': f['scope'], 'name': f['name'],
+                                                   'pfn': f.get('pfn'), 'bytes': f['bytes'], 'state': 'AVAILABLE'}
+                    self.availableAt[(rse,) + key] = self._now()
+        return True
+
+    # - - - - - rule and lock clients - - - - -
+
+    def add_replication_rule(self, dids, copies, rse_expression, **kwargs):  # pylint: disable=unused-argument
+        self._api('add_replication_rule')
+        ruleIDs = []
+        with self.lock:
+            for d in dids:
+                key = (d['scope'], d['name'])
+                self._did(*key)
+                if any(self.rules[ruleID]['rse_expression'] == rse_expression for ruleID in self.didRules.get(key, [])):
+                    raise DuplicateRule('A duplicate rule for this account, did, rse_expression, copies already exists')
+                ruleID = uuid.uuid4().hex
+                self.rules[ruleID] = {'id': ruleID, 'scope': key[0], 'name': key[1], 'copies': copies,
+                                      'rse_expression': rse_expression, 'state': 'REPLICATING'}
+                self.didRules.setdefault(key, []).append(ruleID)
+                for fileKey in self._files(key):
+                    self._addLock(ruleID, fileKey)
+                ruleIDs.append(ruleID)
+        return ruleIDs
+
+    def list_did_rules(self, scope, name):
+        self._api('list_did_rules')
+        with self.lock:
+            self._did(scope, name)
+            rules = [dict(self.rules[ruleID]) for ruleID in self.didRules.get((scope, name), [])]
+        return iter(rules)
+
+    def list_replica_locks(self, rule_id):
+        self._api('list_replica_locks')
+        with self.lock:
+            locks = [self._lockDict(self.locks[key]) for key in self.ruleLocks.get(rule_id, [])]
+        return iter(locks)
+
+    def get_locks_for_dids(self, dids, **filter_args):
+        self._api('get_locks_for_dids')
+        rseExpression = filter_args.get('rse_expression')
+        with self.lock:
+            fileKeys = []
+            for d in dids:
+                self._did(d['scope'], d['name'])
+                fileKeys += self._files((d['scope'], d['name']))
+            locks = [self._lockDict(self.locks[key]) for fileKey in fileKeys for key in self.fileLocks.get(fileKey, [])
+                     if rseExpression is None or self.locks[key]['rse'] == rseExpression]
+        return locks
+
+    # - - - - - RSE client - - - - -
+
+    def get_protocols(self, rse, protocol_domain='ALL', operation=None, default=False, scheme=None):  # pylint: disable=unused-argument
+        self._api('get_protocols')
+        if not rse:
+            raise RSENotFound(f"RSE '{rse}' cannot be found")
+        allOperations = {op: 1 for op in ['read', 'write', 'delete', 'third_party_copy_read', 'third_party_copy_write']}
+        return [{
+            'scheme': 'davs',
+            'hostname': f'{rse.lower()}.example.org',
+            'port': 443,
+            'prefix': '/',
+            'impl': 'rucio.rse.protocols.gfal.Default',
+            'domains': {'lan': dict(allOperations), 'wan': dict(allOperations)},
+            'extended_attributes': None,
+        }]
+
+    def lfns2pfns(self, rse, lfns, protocol_domain='ALL', operation=None, scheme=None):  # pylint: disable=unused-argument
+        self._api('lfns2pfns')
+        pfns = {}
+        for did in lfns:
+            name = did.split(':', 1)[1]
+            pfns[did] = f'davs://{rse.lower()}.example.org:443{name}'
+        return pfns
@@ -0,0 +1,73 @@
+"""
+unittest
+"""
+from unittest.mock import Mock
+
+from ASO.Rucio.LFN2PFNCache import LFN2PFNCache, learnRule, applyRule
+
+SCOPE = 'user.cmscrab'
+LFN_DIR = '/store/temp/user/cmscrab.d6830fc3715ee01030105e83b81ff3068df7c8e0/cmscrab/GenericTTbar/230324_151740/0000'
+OPERATION = 'third_party_copy_read'
+
+
+def mockRucioClient(pfnPrefix):
+    """
+    lfns2pfns of a RSE where PFN is pfnPrefix + LFN
+    """
+    rucioClient = Mock()
+    rucioClient.lfns2pfns.side_effect = lambda rse, dids, operation, scheme: \
+        {did: pfnPrefix + did.split(':', 1)[1] for did in dids}
+    return rucioClient
+
+
+def test_learnRule_replacePrefix():
+    lfn = f'{LFN_DIR}/output_1.root'
+    pfn = f'davs://dcache-cms-webdav-wan.desy.de:2880/pnfs/desy.de/cms/tier2/temp/user/cmscrab.d6830fc3715ee01030105e83b81ff3068df7c8e0/cmscrab/GenericTTbar/230324_151740/0000/output_1.root'
+    rule = learnRule(lfn, pfn)
+    assert rule['lfnPrefix'] == '/store'
+    assert rule['pfnPrefix'] == 'davs://dcache-cms-webdav-wan.desy.de:2880/pnfs/desy.de/cms/tier2'
+    assert applyRule(rule, f'{LFN_DIR}/output_2.root') == pfn.replace('output_1', 'output_2')
+    assert applyRule(rule, '/other/output_2.root') is None
+
+
+def test_translate_learnThenLocal():
+    rucioClient = mockRucioClient('davs://eoscms.cern.ch:443/eos/cms')
+    lfns = [f'{LFN_DIR}/output_{i}.root' for i in range(100)]
+    cache = LFN2PFNCache(rucioClient, SCOPE)
+    pfns = cache.translate('T2_CH_CERN', lfns, OPERATION, 'davs')
+    assert pfns == {lfn: f'davs://eoscms.cern.ch:443/eos/cms{lfn}' for lfn in lfns}
+    # two samples to learn and confirm the rule, the rest is local
+    assert cache.numRemote == 2
+    assert rucioClient.lfns2pfns.call_count == 1
+    assert cache.rules['T2_CH_CERN:third_party_copy_read:davs']['confirmed']
+    # next run only uses the rule
+    cache = LFN2PFNCache(rucioClient, SCOPE, cache.rules)
+    cache.translate('T2_CH_CERN', [f'{LFN_DIR}/output_100.root'], OPERATION, 'davs')
+    assert cache.numRemote == 0
+
+
+def test_translate_verifyAndRelearn():
+    rucioClient = mockRucioClient('davs://eoscms.cern.ch:443/eos/cms')
+    lfns = [f'{LFN_DIR}/output_{i}.root' for i in range(10)]
+    cache = LFN2PFNCache(rucioClient, SCOPE, verifyInterval=5)
+    cache.translate('T2_CH_CERN', lfns, OPERATION, 'davs')
+    # the RSE changed its PFN, verification catches it and the rule is learned again
+    rucioClient.lfns2pfns.side_effect = lambda rse, dids, operation, scheme: \
+        {did: 'root://eoscms.cern.ch//eos/cms' + did.split(':', 1)[1] for did in dids}
+    pfns = cache.translate('T2_CH_CERN', lfns, OPERATION, 'davs')
+    assert pfns == {lfn: f'root://eoscms.cern.ch//eos/cms{lfn}' for lfn in lfns}
+    assert cache.rules['T2_CH_CERN:third_party_copy_read:davs']['pfnPrefix'] == 'root://eoscms.cern.ch//eos/cms'
+    assert cache.rules['T2_CH_CERN:third_party_copy_read:davs']['confirmed']
+
+
+def test_translate_noRule():
+    # PFN does not end with the file name, always ask Rucio
+    rucioClient = Mock()
+    rucioClient.lfns2pfns.side_effect = lambda rse, dids, operation, scheme: \
+        {did: f'srm://example.org/{hash(did)}' for did in dids}
+    lfns = [f'{LFN_DIR}/output_{i}.root' for i in range(10)]
+    cache = LFN2PFNCache(rucioClient, SCOPE)
+    pfns = cache.translate('T2_XX_Odd', lfns, OPERATION)
+    assert len(pfns) == 10
+    assert cache.numRemote == 10
+    assert 'T2_XX_Odd:third_party_copy_read:None' not in cache.rules
@@ -7,6 +7,7 @@ from unittest.mock import patch, mock_open, MagicMock
 from argparse import Namespace
 
 from ASO.Rucio.Transfer import Transfer
+from ASO.Rucio.StateStore import StateStore
 from ASO.Rucio.exception import RucioTransferException
 import ASO.Rucio.config as config
 #from .fixtures import mock_rucioClient
@@ -55,12 +56,6 @@ def containerRuleIDJSONContent():
         return r.read()
 
 # https://stackoverflow.com/a/57015304
-@pytest.fixture(name='LFN2PFNMapJSON')
-def fixture_LFN2PFNMapJSON():
-    path = 'test/assets/LFN2PFNMap.json'
-    with open(path, 'r', encoding='utf-8') as r:
-        return json.load(r)
-
 @pytest.fixture(name='cleanedFiles')
 def fixture_cleanedFiles():
     path = 'test/assets/transferDicts.json'
@@ -161,50 +156,94 @@ def test_readRESTInfo_FileNotFoundError():
         t.readRESTInfo()
 
 
-def test_readTransferItems(transfersTxtContent):
+def test_readTransferItems(transfersTxtContent, tmp_path):
     t = Transfer()
-    t.lastTransferLine = 0
-    path = '/path/to/transfers.txt'
-    config.args = Namespace(transfers_txt_path=path)
-    with patch('ASO.Rucio.Transfer.open', new_callable=mock_open, read_data=transfersTxtContent) as mo:
-        t.readTransferItems()
-        assert mo.call_args.args[0] == path
-        assert t.transferItems[5]['id'] == '5b5c6d9f2e99ae32191e2c702ca9bba32951d69027289a7cde884468'
-        assert t.transferItems[5]['source'] == 'T2_CH_CERN'
-        assert t.transferItems[5]['checksums']['adler32'] == 'cde8011f'
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    path = tmp_path / 'transfers.txt'
+    path.write_text(transfersTxtContent, encoding='utf-8')
+    config.args = Namespace(transfers_txt_path=str(path), force_publishname=None)
+    t.readTransferItems()
+    assert t.transferItems[5]['id'] == '5b5c6d9f2e99ae32191e2c702ca9bba32951d69027289a7cde884468'
+    assert t.transferItems[5]['source'] == 'T2_CH_CERN'
+    assert t.transferItems[5]['checksums']['adler32'] == 'cde8011f'
+
+def test_readTransferItems_continue_from_offset(tmp_path):
+    items = [{'id': f'{i:056x}', 'source': 'T2_CH_CERN', 'destination': 'T2_CH_CERN',
+              'source_lfn': f'/store/temp/user/tseethon/file_{i}.root',
+              'destination_lfn': f'/store/user/tseethon/file_{i}.root',
+              'checksums': {'adler32': f'{i:08x}'}} for i in range(5)]
+    lines = [json.dumps(item) + '\n' for item in items]
+    path = tmp_path / 'transfers.txt'
+    config.args = Namespace(transfers_txt_path=str(path), force_publishname=None)
+    # last line is still being written by PostJob
+    path.write_text(''.join(lines[:3]) + lines[3][:10], encoding='utf-8')
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.readTransferItems()
+    assert len(t.transferItems) == 3
+    path.write_text(''.join(lines), encoding='utf-8')
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.readTransferItems()
+    assert len(t.transferItems) == len(items)
+    assert list(t.transferItems) == items
 
-def test_readTransferItems_FileNotFoundError():
+def test_readTransferItems_FileNotFoundError(tmp_path):
     t = Transfer()
-    t.lastTransferLine = 0
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
     path = '/path/to/transfers.txt'
-    config.args = Namespace(transfers_txt_path=path)
+    config.args = Namespace(transfers_txt_path=path, force_publishname=None)
     with pytest.raises(RucioTransferException):
         t.readTransferItems()
 
-def test_readTransferItems_no_new_item(transfersTxtContent):
+def test_readTransferItems_no_new_item(tmp_path):
     # maybe another exception class to seperate between filenotfound and no new entry
     t = Transfer()
-    t.lastTransferLine = 20
-    path = '/path/to/transfers.txt'
-    config.args = Namespace(transfers_txt_path=path)
-    with patch('ASO.Rucio.Transfer.open', new_callable=mock_open, read_data=transfersTxtContent) as mo:
-        with pytest.raises(RucioTransferException):
-            t.readTransferItems()
-
-def test_readLastTransferLine():
-    config.args = Namespace(last_line_path='/path/to/last_transfer.txt')
-    with patch('ASO.Rucio.Transfer.open', new_callable=mock_open, read_data='5\n') as mo:
-        t = Transfer()
-        t.readLastTransferLine()
-        assert t.lastTransferLine == 5
-        assert mo.call_args.args[0] == '/path/to/last_transfer.txt'
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    path = tmp_path / 'transfers.txt'
+    path.write_text('', encoding='utf-8')
+    config.args = Namespace(transfers_txt_path=str(path), force_publishname=None)
+    with pytest.raises(RucioTransferException):
+        t.readTransferItems()
+
+def test_readLastTransferLine(tmp_path):
+    config.args = Namespace(force_last_line=None)
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.updateLastTransferLine(5)
+    t.readLastTransferLine()
+    assert t.lastTransferLine == 5
 
-def test_readLastTransferLine_file_not_found():
-    config.args = Namespace(last_line_path='/path/should/not/found')
+def test_readLastTransferLine_file_not_found(tmp_path):
+    config.args = Namespace(force_last_line=None)
     t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
     t.readLastTransferLine()
     assert t.lastTransferLine == 0
 
+def test_importLegacyBookkeeping(cleanedFiles, tmp_path):
+    LFN2PFNMap = {'T2_CH_CERN': {lfn: f'davs://eoscms.cern.ch:443/eos/cms{lfn}' for lfn in cleanedFiles}}
+    config.args = Namespace(last_line_path=str(tmp_path / 'last_transfer.txt'),
+                            container_ruleid_path=str(tmp_path / 'container_ruleid.json'),
+                            transfer_ok_path=str(tmp_path / 'transfer_ok.txt'),
+                            bookkeeping_block_complete_path=str(tmp_path / 'block_complete.txt'),
+                            lfn2pfn_map_path=str(tmp_path / 'lfn2pfn_map.json'),
+                            cleaned_files_path=str(tmp_path / 'cleaned_files.json'))
+    (tmp_path / 'last_transfer.txt').write_text('7', encoding='utf-8')
+    (tmp_path / 'transfer_ok.txt').write_text('\n'.join(cleanedFiles) + '\n', encoding='utf-8')
+    (tmp_path / 'lfn2pfn_map.json').write_text(json.dumps(LFN2PFNMap), encoding='utf-8')
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.importLegacyBookkeeping()
+    assert t.store.getMeta('lastTransferLine') == 7
+    assert t.store.getFiles('transfer_ok') == set(cleanedFiles)
+    assert t.store.getFiles('cleaned') == set()
+    assert t.store.getLFN2PFNMap() == LFN2PFNMap
+    # import only once
+    (tmp_path / 'last_transfer.txt').write_text('8', encoding='utf-8')
+    t.importLegacyBookkeeping()
+    assert t.store.getMeta('lastTransferLine') == 7
+
 # do we need to test this thing?
 # ======================
 # if not os.path.exists('task_process/transfers'):
@@ -295,89 +334,62 @@ def test_buildMultiPubContainerNames(transferDicts):
         '/GenericTTbar/tseethon-ruciotransfers-1697125324-94ba0e06145abd65ccb1d21786dc7e1d/USER',
     ])
 
-def test_updateContainerRuleID(containerRuleIDJSONContent, fs):
-    path = '/path/to/container_ruleid.json'
-    config.args = Namespace(container_ruleid_path=path)
-    # we should mock writePath(), not function inside writePath()
-    fs.create_file(path)
-    with open(path, 'w', encoding='utf-8') as mock_file:
-        with patch('ASO.Rucio.Transfer.writePath') as mock_writePath:
-            mock_writePath.return_value.__enter__.return_value = mock_file
-            t = Transfer()
-            t.containerRuleID = 'c88abb899f744efb8f33fd197ee77ecd'
-            t.publishRuleID = '141a41b6b54f45f59dc0703182f1257f'
-            t.multiPubRuleIDs = {
-                '/GenericTTbar/tseethon-ruciotransfers-1697125324-94ba0e06145abd65ccb1d21786dc7e1d_cmsRun.log.tar.gz/USER': '9653f39f686944128028fd25888ae2d3',
-                '/GenericTTbar/tseethon-ruciotransfers-1697125324-94ba0e06145abd65ccb1d21786dc7e1d_output.root/USER': 'e609d75e4a7a4fa3a880ea0bb6681371',
-                '/GenericTTbar/tseethon-ruciotransfers-1697125324-94ba0e06145abd65ccb1d21786dc7e1d_miniaodfake.root/USER': '6b159d7e5dc940daa2188658a68c4b23',
-            }
-            t.updateContainerRuleID()
-            mock_writePath.assert_called_once_with(path)
-    with open(path, 'r', encoding='utf-8') as mock_file:
-        x = json.loads(mock_file.read())
-        y = json.loads(containerRuleIDJSONContent)
-        assert x == y
-
-def test_readContainerRuleID(containerRuleIDJSONContent):
-    path = '/path/to/container_ruleid.json'
-    config.args = Namespace(container_ruleid_path=path, force_publishname=False)
-    with patch('ASO.Rucio.Transfer.open', new_callable=mock_open, read_data=containerRuleIDJSONContent):
-        t = Transfer()
-        t.readContainerRuleID()
-        assert t.containerRuleID == 'c88abb899f744efb8f33fd197ee77ecd'
-        assert t.publishRuleID == '141a41b6b54f45f59dc0703182f1257f'
-        assert t.multiPubRuleIDs == {
-            '/GenericTTbar/tseethon-ruciotransfers-1697125324-94ba0e06145abd65ccb1d21786dc7e1d_cmsRun.log.tar.gz/USER': '9653f39f686944128028fd25888ae2d3',
-            '/GenericTTbar/tseethon-ruciotransfers-1697125324-94ba0e06145abd65ccb1d21786dc7e1d_output.root/USER': 'e609d75e4a7a4fa3a880ea0bb6681371',
-            '/GenericTTbar/tseethon-ruciotransfers-1697125324-94ba0e06145abd65ccb1d21786dc7e1d_miniaodfake.root/USER': '6b159d7e5dc940daa2188658a68c4b23',
-        }
-
-def test_readLFN2PFNMap(LFN2PFNMapJSON):
-    path = '/path/to/lfn2pfn.json'
-    config.args = Namespace(lfn2pfn_map_path=path, ignore_lfn2pfn_map=False)
-    with patch('ASO.Rucio.Transfer.open', new_callable=mock_open, read_data=json.dumps(LFN2PFNMapJSON)) as mo:
-        t = Transfer()
-        t.readLFN2PFNMap()
-        # check if open correct file
-        mo.assert_called_once_with(path, 'r', encoding='utf-8')
-        assert t.LFN2PFNMap == LFN2PFNMapJSON
-
-def test_updateLFN2PFNMap(LFN2PFNMapJSON, fs):
-    path = '/path/to/lfn2pfn.json'
-    config.args = Namespace(lfn2pfn_map_path=path)
-    fs.create_file(path)
-    with open(path, 'w', encoding='utf-8') as mock_file:
-        with patch('ASO.Rucio.Transfer.writePath') as mock_writePath:
-            mock_writePath.return_value.__enter__.return_value = mock_file
-            t = Transfer()
-            t.LFN2PFNMap = LFN2PFNMapJSON
-            t.updateLFN2PFNMap()
-            mock_writePath.assert_called_once_with(path)
-    with open(path, 'r', encoding='utf-8') as mock_file:
-        fileContent = json.loads(mock_file.read())
-        assert fileContent == LFN2PFNMapJSON
-
-def test_readCleanedFiles(cleanedFiles):
-    path = '/path/to/files.txt'
-    config.args = Namespace(cleaned_files_path=path, ignore_cleaned_files=False)
-    with patch('ASO.Rucio.Transfer.open', new_callable=mock_open, read_data=json.dumps(cleanedFiles)) as mo:
-        t = Transfer()
-        t.readCleanedFiles()
-        # check if open correct file
-        mo.assert_called_once_with(path, 'r', encoding='utf-8')
-        assert t.cleanedFiles == cleanedFiles
-
-def test_updateCleanedFiles(cleanedFiles, fs):
-    path = '/path/to/files.txt'
-    config.args = Namespace(cleaned_files_path=path, ignore_cleaned_files=False)
-    fs.create_file(path)
-    with open(path, 'w', encoding='utf-8') as mock_file:
-        with patch('ASO.Rucio.Transfer.writePath') as mock_writePath:
-            mock_writePath.return_value.__enter__.return_value = mock_file
-            t = Transfer()
-            t.cleanedFiles = cleanedFiles
-            t.updateCleanedFiles()
-            mock_writePath.assert_called_once_with(path)
-    with open(path, 'r', encoding='utf-8') as mock_file:
-        fileContent = json.loads(mock_file.read())
-        assert fileContent == cleanedFiles
+def test_updateContainerRuleID(containerRuleIDJSONContent, tmp_path):
+    config.args = Namespace(force_publishname=False)
+    ruleIDs = json.loads(containerRuleIDJSONContent)
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.containerRuleID = ruleIDs['containerRuleID']
+    t.publishRuleID = ruleIDs['publishRuleID']
+    t.multiPubRuleIDs = ruleIDs['multiPubRuleIDs']
+    t.updateContainerRuleID()
+    assert t.store.getMeta('containerRuleID') == ruleIDs
+
+def test_readContainerRuleID(containerRuleIDJSONContent, tmp_path):
+    config.args = Namespace(force_publishname=False)
+    ruleIDs = json.loads(containerRuleIDJSONContent)
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.store.setMeta('containerRuleID', ruleIDs)
+    t.readContainerRuleID()
+    assert t.containerRuleID == 'c88abb899f744efb8f33fd197ee77ecd'
+    assert t.publishRuleID == '141a41b6b54f45f59dc0703182f1257f'
+    assert t.multiPubRuleIDs == ruleIDs['multiPubRuleIDs']
+
+def test_readLFN2PFNMap(cleanedFiles, tmp_path):
+    LFN2PFNMap = {'T2_CH_CERN': {lfn: f'davs://eoscms.cern.ch:443/eos/cms{lfn}' for lfn in cleanedFiles}}
+    config.args = Namespace(ignore_lfn2pfn_map=False)
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.store.addLFN2PFNMap(LFN2PFNMap)
+    t.readLFN2PFNMap()
+    assert t.LFN2PFNMap == LFN2PFNMap
+
+def test_updateLFN2PFNMap(cleanedFiles, tmp_path):
+    LFN2PFNMap = {'T2_CH_CERN': {lfn: f'davs://eoscms.cern.ch:443/eos/cms{lfn}' for lfn in cleanedFiles}}
+    config.args = Namespace(ignore_lfn2pfn_map=False)
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.LFN2PFNMap = LFN2PFNMap
+    t.updateLFN2PFNMap(LFN2PFNMap)
+    assert t.store.getLFN2PFNMap() == LFN2PFNMap
+
+def test_readCleanedFiles(cleanedFiles, tmp_path):
+    config.args = Namespace(ignore_cleaned_files=False)
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.store.setFiles('cleaned', cleanedFiles)
+    t.readCleanedFiles()
+    assert t.cleanedFiles == set(cleanedFiles)
+
+def test_updateCleanedFiles(cleanedFiles, tmp_path):
+    config.args = Namespace(ignore_cleaned_files=False)
+    t = Transfer()
+    t.store = StateStore(str(tmp_path / 'transfer_state.db'))
+    t.readCleanedFiles()
+    t.updateCleanedFiles(cleanedFiles[:2])
+    t.updateCleanedFiles(cleanedFiles[2:])
+    assert t.cleanedFiles == set(cleanedFiles)
+    # only cleaned flag is set
+    assert t.store.getFiles('cleaned') == set(cleanedFiles)
+    assert t.store.getFiles('transfer_ok') == set()
@@ -0,0 +1,46 @@
+"""
+unittest
+"""
+from unittest.mock import Mock, patch
+
+from ASO.Rucio.StateStore import StateStore
+from ASO.Rucio.utils import updateToREST
+
+
+def restFileDoc(ids, state):
+    return {
+        'asoworker': 'rucio',
+        'list_of_ids': ids,
+        'list_of_transfer_state': [state]*len(ids),
+        'list_of_fts_instance': ['https://fts3-cms.cern.ch:8446/']*len(ids),
+        'list_of_fts_id': ['NA']*len(ids),
+        'list_of_failure_reason': None,
+    }
+
+
+@patch('ASO.Rucio.utils.encodeRequest', lambda x: dict(x))
+def test_updateToREST_onlyChangedFiles(tmp_path):
+    store = StateStore(str(tmp_path / 'transfer_state.db'))
+    client = Mock()
+    updateToREST(client, 'filetransfers', 'updateTransfers', restFileDoc(['a', 'b'], 'SUBMITTED'), store)
+    assert client.post.call_count == 1
+    # same values, nothing to upload
+    updateToREST(client, 'filetransfers', 'updateTransfers', restFileDoc(['a', 'b'], 'SUBMITTED'), store)
+    assert client.post.call_count == 1
+    sent = []
+    def post(api, data):
+        sent.append(data)
+    client.post.side_effect = post
+    # only the new file and the file with a new state are uploaded
+    doc = restFileDoc(['a', 'b', 'c'], 'SUBMITTED')
+    doc['list_of_transfer_state'][1] = 'DONE'
+    updateToREST(client, 'filetransfers', 'updateTransfers', doc, store)
+    assert client.post.call_count == 2
+    assert sent[0]['list_of_ids'] == ['b', 'c']
+    assert sent[0]['list_of_transfer_state'] == ['DONE', 'SUBMITTED']
+    assert sent[0]['list_of_failure_reason'] is None
+    # a new transfer of the same file has to be uploaded again
+    store.appendTransferItems([{'id': 'a', 'destination_lfn': '/store/user/rucio/cmsbot/output_1.root'}], 100)
+    updateToREST(client, 'filetransfers', 'updateTransfers', restFileDoc(['a', 'c'], 'SUBMITTED'), store)
+    assert client.post.call_count == 3
+    assert sent[1]['list_of_ids'] == ['a']